@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""Benchmarks of grid-updates' network code against local gateway
+simulators. Run 'python benchmarks.py [name ...]'."""
+
+from __future__ import print_function
+import json
+import sys
+import threading
+import time
+
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from urllib2 import urlopen
+else:
+    from urllib.request import urlopen
+
+from gridupdates import client
+from gridupdates import functions
+from gridupdates import gateway
+from gridupdates.workers import WorkerPool
+from tests import FakeGateway
+
+
+class SlowGateway(object):
+    """
+    A gateway route that injects latency: requests beyond 'capacity' in
+    flight are queued up and take longer, and beyond 'overload' they fail
+    with '503 Service Unavailable' like an overloaded node. The capacity can
+    be changed while the benchmark runs, as I2P's does.
+    """
+
+    def __init__(self, base=0.02, capacity=6, overload=12):
+        self.base = base
+        self.capacity = capacity
+        self.overload = overload
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, method, query, body):
+        with self.lock:
+            self.inflight += 1
+            inflight = self.inflight
+        try:
+            if inflight > self.overload:
+                time.sleep(self.base)
+                return 503, 'Service Unavailable'
+            queued = max(0, inflight - self.capacity)
+            time.sleep(self.base * (1 + queued))
+            return 200, 'OK'
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+
+class FixedLimit(gateway.Controller):
+    """A Controller that never changes its limit, for comparison."""
+
+    def release(self, latency=None, error=False, kind=None):
+        with self.condition:
+            self.inflight -= 1
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self.condition.notify_all()
+
+
+def run_requests(url, count, workers):
+    """Send 'count' requests from 'workers' threads; returns the number of
+    failed requests. Every request has a URL of its own, so none of them
+    are coalesced."""
+    failed = []
+    def request(num):
+        try:
+            gateway.fetch('%s?n=%d' % (url, num))
+        except Exception:
+            failed.append(num)
+    with WorkerPool(workers) as pool:
+        for num in range(count):
+            pool.submit(request, num)
+    return len(failed)
+
+def bench_controller(count=400, workers=32):
+    """AIMD controller vs. fixed request limits on a gateway whose capacity
+    drops halfway through the run."""
+    route = SlowGateway()
+    server = FakeGateway({'/uri/URI:CHK:file': route})
+    url = server.url + '/uri/URI:CHK:file'
+    print('%-12s %8s %10s %8s %6s' % ('limit', 'seconds', 'requests/s',
+                                        'failed', 'final'))
+    try:
+        for name, controller in (('fixed 2', FixedLimit(2, 2)),
+                                 ('fixed 16', FixedLimit(16, 16)),
+                                 ('adaptive', gateway.Controller(16))):
+            gateway._controller = controller
+            route.capacity = 6
+            start = time.time()
+            failed = run_requests(url, count // 2, workers)
+            route.capacity = 2
+            failed += run_requests(url, count // 2, workers)
+            elapsed = time.time() - start
+            print('%-12s %8.2f %10.1f %8d %6d' % (name, elapsed,
+                    count / elapsed, failed, int(controller.limit)))
+    finally:
+        gateway.set_max_requests(gateway.DEFAULT_MAX_REQUESTS)
+        server.stop()
+
+def bench_keepalive(count=1000, workers=8):
+    """A new connection per request (urlopen) vs. the shared keep-alive
+    client."""
+    server = FakeGateway({'/uri/URI:CHK:file': lambda m, q, b: (200, 'OK')})
+    connections = []
+    get_request = server.get_request
+    def count_connections():
+        connections.append(1)
+        return get_request()
+    server.get_request = count_connections
+    url = server.url + '/uri/URI:CHK:file'
+    def plain(num):
+        response = urlopen(url)
+        response.read()
+        response.close()
+    def pooled(num):
+        http.open(url).read()
+    print('%-12s %8s %10s %12s' % ('client', 'workers', 'requests/s',
+                                    'connections'))
+    try:
+        for name, func in (('urlopen', plain), ('keep-alive', pooled)):
+            for threads in (1, workers):
+                http = client.HTTPClient()
+                del connections[:]
+                start = time.time()
+                with WorkerPool(threads) as pool:
+                    for num in range(count):
+                        pool.submit(func, num)
+                elapsed = time.time() - start
+                http.close()
+                print('%-12s %8d %10.1f %12d' % (name, threads,
+                                    count / elapsed, len(connections)))
+    finally:
+        server.stop()
+
+def synthetic_subscription(size):
+    """A repair list with 'size' entries."""
+    return json.dumps(dict(('URI:CHK:%032x:%064x:3:10:1024' % (num, num),
+                            {'name': 'file%d' % num, 'mode': 'one-check'})
+                           for num in range(size)))
+
+def parse_per_key(document, keys):
+    """What introducers.py and repairs.py used to do: decode the whole
+    document again for every access to an entry."""
+    for uri in keys:
+        json.loads(document)[uri]['name']
+        json.loads(document)[uri]['mode']
+
+def bench_subscription(sizes=(10000, 30000, 100000), sample=20):
+    """Loading a subscription list once vs. decoding it per entry. The old
+    way takes hours for big lists, so it is timed for 'sample' entries and
+    extrapolated."""
+    print('%-8s %12s %14s %12s' % ('entries', 'load (s)', 'per key (s)',
+                                    'entries/s'))
+    for size in sizes:
+        document = synthetic_subscription(size)
+        start = time.time()
+        entries = functions.load_subscription(document)
+        loaded = time.time() - start
+        keys = [entry.uri for entry in entries[:sample]]
+        start = time.time()
+        parse_per_key(document, keys)
+        per_key = (time.time() - start) / len(keys) * size
+        print('%-8d %12.3f %14.1f %12.0f' % (size, loaded, per_key,
+                                                    size / loaded))
+
+BENCHMARKS = {'controller': bench_controller,
+              'keepalive': bench_keepalive,
+              'subscription': bench_subscription}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('== %s ==' % name)
+        BENCHMARKS[name]()
@@ -0,0 +1,364 @@
+"""This module keeps results of previous runs on disk."""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from httplib import HTTPException
+    from urllib import unquote
+    from urllib2 import URLError
+else:
+    from http.client import HTTPException
+    from urllib.parse import unquote
+    from urllib.error import URLError
+
+from gridupdates.gateway import fetch
+
+# Directory caps whose listings can never change
+IMMUTABLE_DIRCAPS = ('URI:DIR2-CHK:', 'URI:DIR2-LIT:')
+# Directory caps whose listings can change, but rarely do
+READONLY_DIRCAPS = ('URI:DIR2-RO:',)
+
+
+class CheckCache(object):
+    """
+    A record of recent check results, stored in an SQLite database in the
+    node directory.
+
+    Objects that were found healthy less than 'freshness' seconds ago are
+    considered fresh and don't have to be checked again. A freshness of 0
+    disables skipping; results are still recorded.
+    """
+
+    def __init__(self, path, freshness=0, verbosity=0):
+        self.verbosity = verbosity
+        self.path = path
+        self.freshness = freshness
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS checks ('
+                        'key TEXT PRIMARY KEY, '
+                        'storage_index TEXT, '
+                        'checked REAL, '
+                        'summary TEXT, '
+                        'healthy INTEGER, '
+                        'shares_good INTEGER, '
+                        'shares_needed INTEGER, '
+                        'shares_expected INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases ('
+                        'key TEXT PRIMARY KEY, '
+                        'renewed REAL)')
+        self.db.commit()
+        if self.verbosity > 2:
+            print('DEBUG: Using check cache %s.' % path)
+
+    def lookup(self, key):
+        """Return (age in seconds, summary) of a fresh, healthy result for
+        'key' or None if it has to be checked."""
+        if self.freshness <= 0:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT checked, summary FROM checks '
+                                  'WHERE key = ? AND healthy = 1',
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[0]
+        if age < 0 or age > self.freshness:
+            return None
+        return age, row[1]
+
+    def store(self, key, result):
+        """Record a CheckResult for 'key'."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO checks VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?, ?)',
+                            (key, result.storage_index, time.time(),
+                             result.summary, int(bool(result.healthy)),
+                             result.shares_good, result.shares_needed,
+                             result.shares_expected))
+            self.db.commit()
+
+    def lease_due(self, key, interval):
+        """Check whether the leases of 'key' were last renewed more than
+        'interval' days ago (or never)."""
+        with self.lock:
+            row = self.db.execute('SELECT renewed FROM leases WHERE key = ?',
+                                  (key,)).fetchone()
+        if row is None:
+            return True
+        age = time.time() - row[0]
+        return age < 0 or age >= interval * 86400
+
+    def lease_renewed(self, key):
+        """Record that the leases of 'key' have just been renewed."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?)',
+                            (key, time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ListingCache(object):
+    """
+    A size-bounded LRU cache of Tahoe directory listings (?t=json), stored in
+    an SQLite database in the node directory.
+
+    Listings of immutable directories are kept until they are evicted;
+    listings of read-only caps are refetched once they are older than 'ttl'
+    seconds. Listings of other (i.e. writable) caps are never cached.
+    """
+
+    def __init__(self, path, ttl=3600, max_size=16 * 1024 * 1024,
+                                                        verbosity=0):
+        self.verbosity = verbosity
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS listings ('
+                        'cap TEXT PRIMARY KEY, '
+                        'listing BLOB, '
+                        'size INTEGER, '
+                        'fetched REAL, '
+                        'used REAL, '
+                        'permanent INTEGER)')
+        self.db.commit()
+        if self.verbosity > 2:
+            print('DEBUG: Using listing cache %s.' % path)
+
+    def policy(self, cap):
+        """Return 'permanent', 'ttl' or None (don't cache) for a cap."""
+        if cap.startswith(IMMUTABLE_DIRCAPS):
+            return 'permanent'
+        if cap.startswith(READONLY_DIRCAPS) and self.ttl > 0:
+            return 'ttl'
+        return None
+
+    def get_listing(self, url):
+        """Return the raw JSON listing of the directory at 'url', from the
+        cache if possible. Network errors are passed on to the caller."""
+        cap = unquote(url.split('/uri/', 1)[-1]).rstrip('/')
+        policy = self.policy(cap)
+        if policy is None:
+            return fetch(url + '?t=json')
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT listing, fetched FROM listings '
+                                  'WHERE cap = ?', (cap,)).fetchone()
+            if row is not None and (policy == 'permanent' or
+                                    0 <= now - row[1] <= self.ttl):
+                self.db.execute('UPDATE listings SET used = ? WHERE cap = ?',
+                                (now, cap))
+                self.db.commit()
+                self.hits += 1
+                if self.verbosity > 3:
+                    print('DEBUG: Using cached listing of %s.' % cap)
+                return bytes(row[0])
+        listing = fetch(url + '?t=json')
+        self.store(cap, listing, policy == 'permanent')
+        return listing
+
+    def store(self, cap, listing, permanent):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES '
+                            '(?, ?, ?, ?, ?, ?)',
+                            (cap, sqlite3.Binary(listing), len(listing),
+                             now, now, int(permanent)))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """Drop least recently used listings until the cache fits into
+        'max_size' bytes. Call with the lock held."""
+        total = self.db.execute('SELECT SUM(size) FROM listings'
+                                ).fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        rows = self.db.execute('SELECT cap, size FROM listings '
+                               'ORDER BY used').fetchall()
+        for cap, size in rows:
+            if total <= self.max_size:
+                break
+            self.db.execute('DELETE FROM listings WHERE cap = ?', (cap,))
+            total -= size
+            if self.verbosity > 3:
+                print('DEBUG: Evicted listing of %s from cache.' % cap)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SubscriptionCache(object):
+    """
+    Copies of downloaded subscription files (introducer list, repair list,
+    NEWS.tgz), kept in a directory together with an index of their content
+    hashes and read caps.
+
+    Subscriptions are addressed as '<dircap>/<name>'. Before a file is
+    downloaded again, lookup() lists the parent directory: if the child is
+    an immutable file whose read cap hasn't changed, the copy is used
+    instead. Otherwise the file is downloaded and store() tells whether its
+    content has changed.
+    """
+
+    def __init__(self, directory, verbosity=0):
+        self.verbosity = verbosity
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        self.index = self.read_index()
+        self.caps = {}
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'r') as indexfile:
+                index = json.load(indexfile)
+        except IOError:
+            return {}
+        except ValueError:
+            print('WARN: Ignoring invalid subscription index %s.' %
+                                        self.index_path, file=sys.stderr)
+            return {}
+        if not isinstance(index, dict):
+            return {}
+        return index
+
+    def key(self, url):
+        return unquote(url.split('/uri/', 1)[-1])
+
+    def path(self, key):
+        digest = hashlib.sha256(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest[:32])
+
+    def child_cap(self, url):
+        """Return the read cap of the immutable file at 'url' according to
+        its parent directory, or None if that doesn't tell."""
+        if '/' not in self.key(url):
+            return None
+        parent, name = url.rsplit('/', 1)
+        try:
+            listing = json.loads(fetch(parent + '?t=json').decode('utf8'))
+            nodetype, info = listing[1]['children'][unquote(name)]
+        except (URLError, HTTPException, IOError, ValueError, KeyError,
+                                            IndexError, TypeError) as exc:
+            if self.verbosity > 2:
+                print('DEBUG: Cannot check %s for changes: %s' % (url, exc))
+            return None
+        if nodetype != 'filenode' or info.get('mutable', True):
+            return None
+        return info.get('ro_uri')
+
+    def lookup(self, url):
+        """Return the content of the subscription at 'url' if the copy is
+        up-to-date, otherwise None."""
+        key = self.key(url)
+        cap = self.child_cap(url)
+        with self.lock:
+            # remembered for store()
+            self.caps[key] = cap
+            entry = self.index.get(key)
+        if not entry or cap is None or cap != entry.get('cap'):
+            return None
+        try:
+            with open(self.path(key), 'rb') as copy:
+                content = copy.read()
+        except IOError:
+            return None
+        if hashlib.sha256(content).hexdigest() != entry['sha256']:
+            return None
+        if self.verbosity > 1:
+            print('INFO: %s has not changed; using local copy.' % key)
+        return content
+
+    def store(self, url, content):
+        """Keep a copy of a downloaded subscription; returns False if it is
+        the same as the previous copy."""
+        key = self.key(url)
+        digest = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            cap = self.caps.pop(key, None)
+            entry = self.index.get(key)
+            changed = not entry or entry.get('sha256') != digest
+            try:
+                if changed:
+                    with open(self.path(key) + '.tmp', 'wb') as copy:
+                        copy.write(content)
+                    if os.name == 'nt' and os.path.exists(self.path(key)):
+                        os.remove(self.path(key))
+                    os.rename(self.path(key) + '.tmp', self.path(key))
+                self.index[key] = {'sha256': digest, 'cap': cap,
+                                   'fetched': time.time()}
+                self.save()
+            except (IOError, os.error) as exc:
+                print('WARN: Could not keep a copy of %s: %s' % (key, exc),
+                                                            file=sys.stderr)
+        if not changed and self.verbosity > 1:
+            print('INFO: %s has not changed.' % key)
+        return changed
+
+    def save(self):
+        """Write the index. Call with the lock held."""
+        with open(self.index_path + '.tmp', 'w') as indexfile:
+            json.dump(self.index, indexfile)
+        if os.name == 'nt' and os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(self.index_path + '.tmp', self.index_path)
+
+
+def fetch_listing(url, listing_cache=None):
+    """Return the raw JSON listing of the directory at 'url', using
+    'listing_cache' if there is one."""
+    if listing_cache is None:
+        return fetch(url + '?t=json')
+    return listing_cache.get_listing(url)
+
+def open_listing_cache(state_dir, ttl_minutes=60, verbosity=0):
+    """Open the directory listing cache in 'state_dir'; returns None if it
+    cannot be used."""
+    path = os.path.join(state_dir, 'listings.sqlite')
+    try:
+        return ListingCache(path, ttl_minutes * 60, verbosity=verbosity)
+    except sqlite3.Error as exc:
+        print('WARN: Cannot use listing cache %s: %s' % (path, exc),
+                                                    file=sys.stderr)
+        return None
+
+def open_subscription_cache(state_dir, verbosity=0):
+    """Open the subscription cache in 'state_dir'; returns None if it cannot
+    be used."""
+    directory = os.path.join(state_dir, 'subscriptions')
+    try:
+        return SubscriptionCache(directory, verbosity)
+    except (IOError, os.error) as exc:
+        print('WARN: Cannot use subscription cache %s: %s' % (directory, exc),
+                                                    file=sys.stderr)
+        return None
+
+def open_check_cache(state_dir, freshness_hours=0, verbosity=0):
+    """Open the check cache in 'state_dir'; returns None if it cannot be
+    used."""
+    path = os.path.join(state_dir, 'checks.sqlite')
+    try:
+        return CheckCache(path, freshness_hours * 3600, verbosity)
+    except sqlite3.Error as exc:
+        print('WARN: Cannot use check cache %s: %s' % (path, exc),
+                                                    file=sys.stderr)
+        return None
@@ -0,0 +1,143 @@
+"""This module records the progress of --repair runs so they can be
+resumed."""
+
+from __future__ import print_function
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Checkpoint(object):
+    """
+    Progress of a repair run, saved to a JSON state file.
+
+    The state file lists the subscription entries that have been finished and,
+    for level-checks in progress, the remaining number of levels, the current
+    frontier of the crawl, the items that have been queued for checking but
+    not checked yet, and the items that have already been checked. It is
+    written at most every 'interval' seconds and removed once the run has
+    completed.
+    """
+
+    def __init__(self, path, resume=False, verbosity=0, interval=10):
+        self.verbosity = verbosity
+        self.path = path
+        self.resume = resume
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_save = 0
+        self.state = {'subscription': None, 'done': [], 'trees': {}}
+        self.done = set()
+
+    def begin(self, subscription):
+        """Start a run for 'subscription'; picks up the saved state if
+        resuming was requested and the state belongs to the same
+        subscription."""
+        if self.resume:
+            state = self.read()
+            if state is not None and state.get('subscription') == subscription:
+                self.state = state
+                self.done = set(state['done'])
+                for tree in state['trees'].values():
+                    tree['checked'] = set(tree['checked'])
+                if self.verbosity > 0:
+                    print('Resuming interrupted repair run (%d shares done).'
+                                                            % len(self.done))
+            elif self.verbosity > 1:
+                print('INFO: No interrupted repair run to resume.')
+        self.state['subscription'] = subscription
+        self.save(force=True)
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as statefile:
+                state = json.load(statefile)
+            if not (isinstance(state.get('done'), list) and
+                    isinstance(state.get('trees'), dict)):
+                raise ValueError('unexpected format')
+        except IOError:
+            return None
+        except (ValueError, AttributeError):
+            print('WARN: Ignoring invalid state file %s.' % self.path,
+                                                            file=sys.stderr)
+            return None
+        return state
+
+    def is_done(self, key):
+        with self.lock:
+            return key in self.done
+
+    def mark_done(self, key):
+        """Record a finished subscription entry."""
+        with self.lock:
+            self.done.add(key)
+            self.state['done'].append(key)
+            self.state['trees'].pop(key, None)
+        self.save()
+
+    def tree(self, key):
+        """Return the saved crawl state of the level-check 'key' or None."""
+        with self.lock:
+            return self.state['trees'].get(key)
+
+    def save_tree(self, key, levels, frontier):
+        """Record the frontier of a level-check before it is checked."""
+        with self.lock:
+            tree = self.state['trees'].setdefault(key, {'checked': set(),
+                                                        'pending': {}})
+            tree['levels'] = levels
+            tree['frontier'] = [list(item) for item in frontier]
+        self.save()
+
+    def item_pending(self, key, item):
+        """Record an item of the level-check 'key' that has been queued for
+        checking. It stays in the state until item_done(), even once the
+        frontier has moved on to the next level."""
+        with self.lock:
+            tree = self.state['trees'].setdefault(key, {'checked': set(),
+                                                'levels': 0, 'frontier': []})
+            tree.setdefault('pending', {})[item[3] or item[1]] = list(item)
+
+    def item_done(self, key, item):
+        """Record a checked item of the level-check 'key'."""
+        with self.lock:
+            tree = self.state['trees'].setdefault(key, {'checked': set(),
+                                                'levels': 0, 'frontier': []})
+            tree['checked'].add(item)
+            tree.setdefault('pending', {}).pop(item, None)
+        self.save()
+
+    def save(self, force=False):
+        """Write the state file (atomically), unless it has been written less
+        than 'interval' seconds ago."""
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_save < self.interval:
+                return
+            self.last_save = now
+            state = dict(self.state)
+            state['trees'] = {}
+            for key, tree in self.state['trees'].items():
+                tree = dict(tree)
+                tree['checked'] = sorted(tree['checked'])
+                tree['pending'] = dict(tree.get('pending', {}))
+                state['trees'][key] = tree
+            tempfile = self.path + '.tmp'
+            try:
+                with open(tempfile, 'w') as statefile:
+                    json.dump(state, statefile)
+                if os.name == 'nt' and os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tempfile, self.path)
+            except (IOError, os.error) as exc:
+                print('WARN: Could not save repair state: %s' % exc,
+                                                        file=sys.stderr)
+
+    def finish(self):
+        """The run has completed: remove the state file."""
+        try:
+            os.remove(self.path)
+        except (IOError, os.error):
+            pass
@@ -0,0 +1,261 @@
+"""This module sends grid-updates' HTTP requests over a shared pool of
+persistent (keep-alive) connections."""
+
+from __future__ import print_function
+from io import BytesIO
+import errno
+import socket
+import sys
+import threading
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from httplib import BadStatusLine
+    from httplib import HTTPConnection
+    from httplib import HTTPSConnection
+    from httplib import HTTPException
+    from httplib import IncompleteRead
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+    from urlparse import urljoin
+    from urlparse import urlsplit
+else:
+    from http.client import BadStatusLine
+    from http.client import HTTPConnection
+    from http.client import HTTPSConnection
+    from http.client import HTTPException
+    from http.client import IncompleteRead
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+    from urllib.parse import urljoin
+    from urllib.parse import urlsplit
+
+# Seconds to wait for the gateway to send anything. Checks with repair of big
+# files over I2P can take a long time before the response starts.
+DEFAULT_TIMEOUT = 1800
+# Idle connections kept per host
+MAX_IDLE = 16
+MAX_REDIRECTS = 5
+
+
+def is_closed(exc):
+    """Check whether an exception means that the server closed the
+    connection, as opposed to a timeout or another failure."""
+    if isinstance(exc, socket.timeout):
+        return False
+    if isinstance(exc, BadStatusLine):
+        # includes RemoteDisconnected on Python 3
+        return True
+    return isinstance(exc, socket.error) and exc.errno in (errno.ECONNRESET,
+                                        errno.EPIPE, errno.ECONNABORTED)
+
+
+def read_line(response):
+    """Read a line of the body of an HTTPResponse. It has no readline() on
+    Python 2, and on Python 3 readline() doesn't close the response at the
+    end of the body, so its connection couldn't be reused. The line is read
+    from the buffered socket file; the remaining length (or chunk) is kept
+    up to date, so the rest of the body can still be read with read()."""
+    if response.fp is None:
+        return b''
+    if not response.chunked:
+        if response.length is None:
+            line = response.fp.readline()
+        else:
+            line = response.fp.readline(response.length)
+            response.length -= len(line)
+        if not line or response.length == 0:
+            response.close()
+        return line
+    parts = []
+    while True:
+        if response.chunk_left is None:
+            size = response.fp.readline()
+            try:
+                response.chunk_left = int(size.split(b';')[0], 16)
+            except ValueError:
+                response.close()
+                raise IncompleteRead(b''.join(parts))
+            if response.chunk_left == 0:
+                # the last chunk; skip the trailer
+                while True:
+                    trailer = response.fp.readline()
+                    if not trailer or trailer == b'\r\n':
+                        break
+                response.close()
+                break
+        part = response.fp.readline(response.chunk_left)
+        if not part:
+            response.close()
+            break
+        parts.append(part)
+        response.chunk_left -= len(part)
+        if response.chunk_left == 0:
+            response.fp.read(2) # CRLF after the chunk
+            response.chunk_left = None
+        if part.endswith(b'\n'):
+            break
+    return b''.join(parts)
+
+
+class Response(object):
+    """
+    A response body read from a pooled connection. The connection goes back
+    to the pool once the body has been read completely; closing the response
+    earlier discards it.
+    """
+
+    def __init__(self, client, key, connection, response, url):
+        self.client = client
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.closed = False
+
+    def info(self):
+        return self.response.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amount=None):
+        if amount is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amount)
+        if amount is None or not data:
+            self.close()
+        return data
+
+    def readline(self):
+        line = read_line(self.response)
+        if not line:
+            self.close()
+        return line
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.client.release(self.key, self.connection, self.response)
+
+
+class HTTPClient(object):
+    """
+    A thread-safe pool of HTTP/1.1 connections. Requests to the same host
+    reuse idle connections instead of opening a new one each time, which
+    saves a TCP handshake per request (and lets the gateway skip its setup
+    work).
+
+    open() behaves like urlopen(): it follows redirects and raises
+    HTTPError for error responses and URLError if the server cannot be
+    reached.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_idle=MAX_IDLE):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.requests = 0
+        self.connections = 0
+
+    def open(self, url, data=None, redirects=MAX_REDIRECTS, extra=None):
+        """Send a GET (or, with 'data', a POST) request with additional
+        headers ('extra'); returns a Response."""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise URLError('unsupported URL: %s' % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(extra or {})
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        while True:
+            connection, reused = self.connect(key)
+            try:
+                connection.request(method, path, data, headers)
+            except (socket.error, HTTPException) as exc:
+                connection.close()
+                if reused and is_closed(exc):
+                    # The server closed the idle connection meanwhile; the
+                    # request never got through.
+                    continue
+                raise URLError(exc)
+            try:
+                response = connection.getresponse()
+            except (socket.error, HTTPException) as exc:
+                connection.close()
+                if reused and method == 'GET' and is_closed(exc):
+                    # The server closed the connection before answering. A
+                    # POST may have been carried out already, so only GET
+                    # requests are sent again.
+                    continue
+                raise URLError(exc)
+            break
+        with self.lock:
+            self.requests += 1
+        result = Response(self, key, connection, response, url)
+        if response.status in (301, 302, 303, 307) and redirects > 0:
+            location = response.getheader('Location')
+            if location:
+                result.read()
+                if response.status != 307:
+                    data = None
+                return self.open(urljoin(url, location), data, redirects - 1,
+                                                                    extra)
+        if response.status >= 400:
+            body = result.read()
+            raise HTTPError(url, response.status, response.reason,
+                                        response.msg, BytesIO(body))
+        return result
+
+    def connect(self, key):
+        """Return (connection, True if it has been used before)."""
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return HTTPSConnection(host, port, timeout=self.timeout), False
+        return HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection, response):
+        """Put a connection back into the pool if it can be reused."""
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+_client = HTTPClient()
+
+def set_timeout(timeout):
+    """Set the timeout of all further connections (in seconds)."""
+    _client.timeout = timeout
+
+def urlopen(url, data=None, headers=None, redirects=MAX_REDIRECTS):
+    """Send a request through the shared HTTPClient; see HTTPClient.open()."""
+    return _client.open(url, data, redirects, headers)
+
+def stats():
+    """Return (requests, connections) sent and opened so far."""
+    return _client.requests, _client.connections
@@ -227,6 +227,165 @@ def parse_args(argv):
             help = ('Override default output directory (%s) for script '
                     'update downloads and NEWS.tgz generation.'
                     % os.getcwd()))
+    other_opts.add_argument('--action-workers',
+            action = 'store',
+            type = int,
+            dest = 'action_workers',
+            default = 4,
+            help = 'Number of actions (introducers, news, update, repair) '
+                    'to run at the same time (default: 4).')
+    other_opts.add_argument('--fleet',
+            action = 'append',
+            dest = 'fleet',
+            metavar = 'DIR',
+            help = 'Apply --merge-introducers, --sync-introducers and '
+                    '--download-news to the node directory DIR instead of '
+                    '--node-directory. DIR may be a glob pattern (e.g. '
+                    "'~/nodes/*'); the option may be repeated.")
+    other_opts.add_argument('--fleet-workers',
+            action = 'store',
+            type = int,
+            dest = 'fleet_workers',
+            default = 8,
+            help = 'Number of --fleet nodes to update at the same time '
+                    '(default: 8).')
+    other_opts.add_argument('--repair-workers',
+            action = 'store',
+            type = int,
+            dest = 'repair_workers',
+            default = 4,
+            help = 'Number of shares to repair at the same time '
+                    '(default: 4).')
+    other_opts.add_argument('--max-requests',
+            action = 'store',
+            type = int,
+            dest = 'max_requests',
+            default = 16,
+            help = 'Maximum number of simultaneous requests to the Tahoe '
+                    'gateway; the actual number adapts to how fast the '
+                    'gateway answers (default: 16).')
+    other_opts.add_argument('--node-info-ttl',
+            action = 'store',
+            type = float,
+            dest = 'node_info_ttl',
+            default = 0,
+            metavar = 'HOURS',
+            help = "Remember the node's Tahoe version and installation "
+                    'directory for HOURS hours (default: 0, look them up '
+                    'once per run).')
+    other_opts.add_argument('--timeout',
+            action = 'store',
+            type = float,
+            dest = 'timeout',
+            default = 1800,
+            metavar = 'SECONDS',
+            help = 'Give up on a request if the Tahoe gateway sends nothing '
+                    'for SECONDS seconds (default: 1800).')
+    other_opts.add_argument('--gateway-failures',
+            action = 'store',
+            type = int,
+            dest = 'gateway_failures',
+            default = 5,
+            metavar = 'N',
+            help = 'After N connection failures in a row, pause all '
+                    'requests until the Tahoe gateway answers again '
+                    '(default: 5; 0 disables this).')
+    other_opts.add_argument('--gateway-wait',
+            action = 'store',
+            type = float,
+            dest = 'gateway_wait',
+            default = 15,
+            metavar = 'MINUTES',
+            help = 'Give up if the gateway does not come back within '
+                    'MINUTES minutes (default: 15; 0 gives up at once).')
+    other_opts.add_argument('--retries',
+            action = 'store',
+            type = int,
+            dest = 'retries',
+            default = 2,
+            metavar = 'N',
+            help = 'Retry requests that failed for transient reasons up to '
+                    'N times (default: 2).')
+    other_opts.add_argument('--retry-budget',
+            action = 'store',
+            type = int,
+            dest = 'retry_budget',
+            default = 20,
+            metavar = 'N',
+            help = 'Retry at most N requests per action in total '
+                    '(default: 20).')
+    other_opts.add_argument('--crawl-workers',
+            action = 'store',
+            type = int,
+            dest = 'crawl_workers',
+            default = 4,
+            help = 'Number of directories to list at the same time during '
+                    'level-checks (default: 4).')
+    other_opts.add_argument('--listing-ttl',
+            action = 'store',
+            type = float,
+            dest = 'listing_ttl',
+            default = 60,
+            metavar = 'MINUTES',
+            help = 'Reuse cached listings of read-only directories for '
+                    'MINUTES minutes (default: 60; 0 disables caching of '
+                    'read-only directories).')
+    other_opts.add_argument('--lock-wait',
+            action = 'store',
+            type = float,
+            dest = 'lock_wait',
+            default = 0,
+            metavar = 'SECONDS',
+            help = 'If another instance is running the same action, wait '
+                    'up to SECONDS seconds for it to finish before skipping '
+                    'the action (default: 0).')
+    other_opts.add_argument('--resume',
+            action = 'store_true',
+            dest = 'resume',
+            default = False,
+            help = 'Continue an interrupted --repair run instead of '
+                    'starting over.')
+    other_opts.add_argument('--check-freshness',
+            action = 'store',
+            type = float,
+            dest = 'check_freshness',
+            default = 0,
+            metavar = 'HOURS',
+            help = 'Skip one-checks of objects that were found healthy '
+                    'within the last HOURS hours (default: 0, never skip).')
+    other_opts.add_argument('--repair-strategy',
+            action = 'store',
+            dest = 'repair_strategy',
+            choices = ['direct', 'two-phase'],
+            default = 'direct',
+            help = "'direct' repairs and renews leases with every check; "
+                    "'two-phase' only repairs unhealthy objects and renews "
+                    "leases separately (default: direct).")
+    other_opts.add_argument('--lease-interval',
+            action = 'store',
+            type = float,
+            dest = 'lease_interval',
+            default = 0,
+            metavar = 'DAYS',
+            help = "With --repair-strategy two-phase, renew each share's "
+                    'leases at most every DAYS days (default: 0, every '
+                    'run).')
+    other_opts.add_argument('--deep-check-method',
+            action = 'store',
+            dest = 'deep_check_method',
+            choices = ['stream', 'ophandle'],
+            default = 'stream',
+            help = "'stream' runs each deep-check over its own connection; "
+                    "'ophandle' starts all of them as asynchronous gateway "
+                    'operations and polls them (default: stream).')
+    other_opts.add_argument('--poll-interval',
+            action = 'store',
+            type = float,
+            dest = 'poll_interval',
+            default = 10,
+            metavar = 'SECONDS',
+            help = 'Poll asynchronous deep-checks every SECONDS seconds '
+                    '(default: 10).')
     parser.add_argument_group(other_opts)
     # remaining
     parser.add_argument('-v',
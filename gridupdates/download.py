@@ -0,0 +1,225 @@
+"""This module downloads files from the Tahoe grid straight to disk."""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from urllib2 import HTTPError
+else:
+    from urllib.error import HTTPError
+
+from gridupdates import retry
+from gridupdates.client import urlopen
+
+# Bytes read from the gateway and written to disk at a time
+CHUNK_SIZE = 64 * 1024
+# Seconds between progress messages
+PROGRESS_INTERVAL = 5
+
+
+def format_size(size):
+    """Return a human-readable file size."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GiB' % size
+
+
+class Download(object):
+    """
+    A download of 'url' to the file 'path'.
+
+    The response body is written in chunks of CHUNK_SIZE to 'path.part' and
+    hashed on the way, so memory use doesn't grow with the size of the file.
+    Once the download is complete, the partial file is renamed to 'path';
+    an interrupted download never leaves a truncated file at 'path'.
+
+    With 'resume', an interrupted download keeps its partial file and a
+    state file ('path.part.json') recording the URL and size. The next
+    attempt, in this or a later run, asks only for the missing bytes with a
+    Range request. A server that ignores Range gets a full download.
+    """
+
+    def __init__(self, url, path, verbosity=0, interval=PROGRESS_INTERVAL,
+                                                                resume=False):
+        self.verbosity = verbosity
+        self.url = url
+        self.path = path
+        self.partial = path + '.part'
+        self.state_path = self.partial + '.json'
+        self.interval = interval
+        self.resume = resume
+        self.size = None
+        self.received = 0
+        self.resumed = 0
+        self.sha256 = None
+        self.elapsed = 0
+
+    def run(self):
+        """Download the file; returns the SHA-256 hex digest of its content.
+        Network and file errors are passed on to the caller. The partial
+        file is removed, unless it is kept for resuming."""
+        digest = hashlib.sha256()
+        start = time.time()
+        try:
+            offset = self.prepare(digest)
+            if self.size is None or offset < self.size:
+                response = self.open(offset)
+                if self.resumed == 0:
+                    digest = hashlib.sha256()
+                try:
+                    self.write(response, digest, start)
+                finally:
+                    response.close()
+            if self.size is not None and self.received < self.size:
+                raise IOError('Download of %s ended after %d of %d bytes' %
+                                    (self.url, self.received, self.size))
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.partial, self.path)
+        except:
+            if not self.resume or not os.path.exists(self.partial):
+                self.discard()
+            elif self.verbosity > 1:
+                print('INFO: Keeping %s of %s for resuming.' %
+                                (format_size(self.received), self.path))
+            raise
+        self.remove(self.state_path)
+        self.elapsed = time.time() - start
+        self.sha256 = digest.hexdigest()
+        received = self.received - self.resumed
+        if self.verbosity > 1:
+            print('INFO: Downloaded %s in %.1f seconds (%s/s).' %
+                        (format_size(received), self.elapsed,
+                         format_size(received / max(self.elapsed, 0.001))))
+        if self.verbosity > 2:
+            print('DEBUG: SHA-256 of %s: %s' % (self.path, self.sha256))
+        return self.sha256
+
+    def prepare(self, digest):
+        """Pick up the partial file of an earlier attempt, adding its content
+        to 'digest'; returns the number of bytes already there."""
+        self.size = None
+        self.received = 0
+        self.resumed = 0
+        if not self.resume or not os.path.exists(self.partial):
+            return 0
+        try:
+            with open(self.state_path, 'r') as statefile:
+                state = json.load(statefile)
+            if state['url'] != self.url:
+                raise ValueError('partial file of another URL')
+            size = state['size']
+            offset = os.path.getsize(self.partial)
+            if size is not None and offset > size:
+                raise ValueError('partial file too big')
+            with open(self.partial, 'rb') as partial:
+                while True:
+                    chunk = partial.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+        except (IOError, os.error, ValueError, KeyError, TypeError) as exc:
+            if self.verbosity > 2:
+                print('DEBUG: Not resuming %s: %s' % (self.partial, exc))
+            self.discard()
+            return 0
+        self.size = size
+        self.received = self.resumed = offset
+        return offset
+
+    def open(self, offset):
+        """Request the file from 'offset' on. Sets 'resumed' to 0 if the
+        download has to start over."""
+        headers = None
+        if offset > 0:
+            headers = {'Range': 'bytes=%d-' % offset}
+            if self.verbosity > 1:
+                print('INFO: Resuming download of %s at %s.' %
+                                    (self.path, format_size(offset)))
+        try:
+            response = urlopen(self.url, headers=headers)
+        except HTTPError as exc:
+            if offset == 0 or exc.code != 416:
+                raise
+            # Range Not Satisfiable: the partial file doesn't fit the file
+            response = None
+        if offset > 0:
+            if response is not None and response.code == 206:
+                match = re.match(r'bytes (\d+)-\d+/(\d+|\*)',
+                            response.info().get('Content-Range') or '')
+                if match and int(match.group(1)) == offset:
+                    if match.group(2) != '*':
+                        self.size = int(match.group(2))
+                    return response
+            if self.verbosity > 1:
+                print('INFO: Cannot resume %s; downloading the whole file.'
+                                                                % self.path)
+            if response is None or response.code == 206:
+                if response is not None:
+                    response.close()
+                response = urlopen(self.url)
+            self.received = self.resumed = 0
+        length = response.info().get('Content-Length')
+        self.size = int(length) if length else None
+        if self.resume:
+            self.save_state()
+        return response
+
+    def write(self, response, digest, start):
+        """Append the response body to the partial file."""
+        last_report = time.time()
+        mode = 'ab' if self.resumed else 'wb'
+        with open(self.partial, mode) as output:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+                digest.update(chunk)
+                self.received += len(chunk)
+                if time.time() - last_report >= self.interval:
+                    last_report = time.time()
+                    self.progress(last_report - start)
+
+    def progress(self, elapsed):
+        if self.verbosity < 2:
+            return
+        rate = format_size((self.received - self.resumed) /
+                                                    max(elapsed, 0.001))
+        if self.size:
+            print('INFO: Downloaded %s of %s (%d%%, %s/s).' %
+                        (format_size(self.received), format_size(self.size),
+                         100 * self.received // self.size, rate))
+        else:
+            print('INFO: Downloaded %s (%s/s).' %
+                        (format_size(self.received), rate))
+
+    def save_state(self):
+        with open(self.state_path, 'w') as statefile:
+            json.dump({'url': self.url, 'size': self.size}, statefile)
+
+    def discard(self):
+        """Remove the partial file and its state."""
+        self.remove(self.partial)
+        self.remove(self.state_path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except os.error:
+            pass
+
+
+def download_file(url, path, verbosity=0, action='download', resume=False):
+    """Download 'url' to 'path' (see Download), retrying transient errors
+    according to the retry policy of 'action'. Returns the SHA-256 hex digest
+    of the file."""
+    download = Download(url, path, verbosity, resume=resume)
+    return retry.policy(action).call(download.run)
@@ -0,0 +1,188 @@
+"""This module applies the introducer list and NEWS to many Tahoe nodes."""
+
+from __future__ import print_function
+import glob
+import os
+import sys
+import tempfile
+import threading
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from httplib import HTTPException
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+else:
+    from http.client import HTTPException
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+
+from gridupdates.download import download_file
+from gridupdates.functions import find_state_dir
+from gridupdates.functions import find_web_static_dir
+from gridupdates.functions import remove_temporary_dir
+from gridupdates.functions import set_tahoe_node_url
+from gridupdates.functions import tahoe_dl_file
+from gridupdates.introducers import Introducers
+from gridupdates.lock import ActionLock
+from gridupdates.news import News
+from gridupdates.workers import run_ordered
+
+
+class NodeError(Exception):
+    """A node directory cannot be updated."""
+
+
+def expand_node_dirs(patterns, verbosity=0):
+    """Return the directories matching 'patterns' (paths or glob patterns
+    such as '~/nodes/*'), in order and without duplicates."""
+    node_dirs = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if not matches and verbosity > 0:
+            print('WARN: No node directories match %s.' % pattern,
+                                                    file=sys.stderr)
+        for path in matches:
+            if not os.path.isdir(path):
+                continue
+            real = os.path.realpath(path)
+            if real not in seen:
+                seen.add(real)
+                node_dirs.append(path)
+    return node_dirs
+
+
+class Fleet(object):
+    """
+    Applies --merge-introducers/--sync-introducers and --download-news to a
+    number of Tahoe node directories.
+
+    The introducer list and NEWS.tgz are downloaded only once; up to
+    'workers' nodes are then updated at the same time. Each node keeps its
+    own action locks, and the NEWS Atom feed of each node points to the URL
+    in its node.url file. A node that fails doesn't stop the others.
+    """
+
+    def __init__(self, node_dirs, verbosity=0, workers=8, lock_wait=0):
+        self.verbosity = verbosity
+        self.node_dirs = node_dirs
+        self.workers = workers
+        self.lock_wait = lock_wait
+        self.lock = threading.Lock()
+        self.changed = []
+        self.failed = []
+
+    def run_action(self, mode=None, list_url=None, news_url=None,
+                                                        subscriptions=None):
+        """Update all nodes: their introducers with 'mode' ('merge' or
+        'sync') from the list at 'list_url' and their NEWS from 'news_url'
+        (if given). Returns True if no node failed."""
+        if self.verbosity > 0:
+            print('-- Updating %d nodes --' % len(self.node_dirs))
+        document = None
+        if mode is not None:
+            document = tahoe_dl_file(list_url, self.verbosity, 'introducers',
+                                                    subscriptions).read()
+        tempdir = tempfile.mkdtemp()
+        try:
+            archive = None
+            if news_url is not None:
+                archive = self.download_news(news_url, tempdir, subscriptions)
+                if archive is None:
+                    return False
+            run_ordered(lambda node_dir: self.update_node(node_dir, mode,
+                                        document, news_url, archive),
+                        self.node_dirs, self.workers)
+        finally:
+            remove_temporary_dir(tempdir, self.verbosity)
+        self.print_summary()
+        return not self.failed
+
+    def download_news(self, url, tempdir, subscriptions=None):
+        """Download NEWS.tgz for all nodes; returns its path or None."""
+        path = os.path.join(tempdir, 'NEWS.tgz')
+        content = None
+        if subscriptions is not None:
+            content = subscriptions.lookup(url)
+        try:
+            if content is not None:
+                with open(path, 'wb') as archive:
+                    archive.write(content)
+            else:
+                if self.verbosity > 1:
+                    print("INFO: Downloading news from the Tahoe grid.")
+                download_file(url, path, self.verbosity, 'news')
+                if subscriptions is not None:
+                    with open(path, 'rb') as archive:
+                        subscriptions.store(url, archive.read())
+        except HTTPError:
+            print("ERROR: Couldn't find %s." % url, file=sys.stderr)
+            return None
+        except (URLError, HTTPException, IOError) as exc:
+            print("ERROR: %s while looking for %s." % (exc, url),
+                                                    file=sys.stderr)
+            return None
+        return path
+
+    def update_node(self, node_dir, mode, document, news_url, archive):
+        """Apply the introducer list and NEWS to a single node."""
+        if self.verbosity > 0:
+            print('-- Node %s --' % node_dir)
+        changes = []
+        try:
+            if not os.access(node_dir, os.W_OK):
+                raise NodeError('Need write access to %s.' % node_dir)
+            state_dir = find_state_dir(node_dir)
+            if mode is not None:
+                with ActionLock(state_dir, 'introducers', self.lock_wait,
+                                                self.verbosity) as lock:
+                    if not lock.acquired:
+                        raise NodeError('introducers are locked by another '
+                                                                'instance.')
+                    intlist = Introducers(node_dir, None, self.verbosity,
+                                                    document=document)
+                    if intlist.run_action(mode):
+                        changes.append('introducers')
+            if archive is not None:
+                web_static_dir = find_web_static_dir(node_dir)
+                if not web_static_dir:
+                    raise NodeError('No web.static directory.')
+                node_url = set_tahoe_node_url(None, node_dir)
+                with ActionLock(state_dir, 'news', self.lock_wait,
+                                                self.verbosity) as lock:
+                    if not lock.acquired:
+                        raise NodeError('news are locked by another '
+                                                                'instance.')
+                    news = News(node_dir, web_static_dir, node_url, news_url,
+                                self.verbosity, archive=archive)
+                    try:
+                        installed = news.run_action()
+                        if installed is None:
+                            raise NodeError('Could not update NEWS.')
+                        if installed:
+                            changes.append('news')
+                    finally:
+                        if os.path.isdir(news.tempdir):
+                            remove_temporary_dir(news.tempdir)
+        except SystemExit as exc:
+            self.fail(node_dir, 'exit status %s' % exc.code)
+        except Exception as exc:
+            print('ERROR: %s' % exc, file=sys.stderr)
+            self.fail(node_dir, str(exc))
+        if changes:
+            with self.lock:
+                self.changed.append((node_dir, changes))
+
+    def fail(self, node_dir, reason):
+        with self.lock:
+            self.failed.append((node_dir, reason))
+
+    def print_summary(self):
+        """Print the nodes that were changed and those that failed."""
+        if self.verbosity > 0:
+            print('Updated %d nodes: %d changed, %d failed.' %
+                    (len(self.node_dirs), len(self.changed), len(self.failed)))
+            for node_dir, changes in sorted(self.changed):
+                print('Changed: %s (%s)' % (node_dir, ', '.join(changes)))
+        for node_dir, reason in sorted(self.failed):
+            print('Failed: %s (%s)' % (node_dir, reason), file=sys.stderr)
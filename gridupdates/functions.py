@@ -1,7 +1,9 @@
 from __future__ import print_function
+from collections import namedtuple
 from shutil import copyfile
 from shutil import rmtree
 from distutils.version import LooseVersion
+from io import BytesIO
 import ctypes # TODO import only needed function?
 import imp
 import json
@@ -12,16 +14,20 @@ import sys
 if sys.version_info[0] == 2:
     import ConfigParser
     from ConfigParser import SafeConfigParser
+    from httplib import HTTPException
     from urllib2 import HTTPError
-    from urllib2 import urlopen
     from urllib2 import URLError
 else:
     import configparser as ConfigParser
     from configparser import ConfigParser as SafeConfigParser
-    from urllib.request import urlopen
+    from http.client import HTTPException
     from urllib.error import HTTPError
     from urllib.error import URLError
 
+from gridupdates import retry
+from gridupdates.client import urlopen
+from gridupdates.nodeinfo import get_node_info
+
 def is_root():
     """
     Check if grid-updates is running with root permissions.
@@ -53,23 +59,40 @@ def create_web_static_dir(web_static_dir):
     else:
         install_news_stub(web_static_dir)
 
-def tahoe_dl_file(url, verbosity=0):
-    """Download a file from the Tahoe grid; returns the raw response."""
+def read_url(url):
+    """Return the body of the document at 'url'."""
+    response = urlopen(url)
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+def tahoe_dl_file(url, verbosity=0, action='download', subscriptions=None):
+    """Download a file from the Tahoe grid; returns the raw response.
+    Transient errors are retried according to the retry policy of
+    'action'. With a SubscriptionCache, unchanged files are not downloaded
+    again."""
+    if subscriptions is not None:
+        content = subscriptions.lookup(url)
+        if content is not None:
+            return BytesIO(content)
     if verbosity > 1:
         print('INFO: Downloading subscription from the Tahoe grid.')
     if verbosity > 2:
         print("DEBUG: Downloading from: %s" % url)
     try:
-        response = urlopen(url)
+        content = retry.policy(action).call(read_url, url)
     except HTTPError as exc:
         print('ERROR: Could not download the file:', exc, file=sys.stderr)
         sys.exit(1)
-    except URLError as urlexc:
+    except (URLError, HTTPException, IOError) as urlexc:
         print("ERROR: %s while downloading %s." % (urlexc, url),
                                                file= sys.stderr)
         sys.exit(1)
     else:
-        return response
+        if subscriptions is not None:
+            subscriptions.store(url, content)
+        return BytesIO(content)
 
 def is_valid_introducer(uri):
     """Check if the introducer address has the correct format."""
@@ -87,8 +110,9 @@ def proxy_configured():
         return False
 
 def is_literal_file(result):
-    """Check for LIT files, which cannot be checked."""
-    if not json.loads(result)['storage-index']:
+    """Check for LIT files, which cannot be checked. 'result' is a parsed
+    check result record."""
+    if not result.storage_index:
         return True
     else:
         return False
@@ -137,15 +161,26 @@ def find_datadir():
 def find_tahoe_dir(tahoe_node_url):
     """Determine the location of the tahoe installation directory and included
     'web' directory by parsing the tahoe web console."""
-    webconsole = urlopen(tahoe_node_url)
-    match = re.search(r'.*\ \'(.*__init__.py)', webconsole.read().decode('utf8'))
-    if match is not None:
-        tahoe_dir = os.path.dirname(match.group(1))
+    tahoe_dir = get_node_info(tahoe_node_url).tahoe_dir
+    if tahoe_dir is not None:
         return tahoe_dir
     else:
         print('ERROR: Cannot find node directory.', file=sys.stderr)
         return False
 
+def find_state_dir(tahoe_node_dir):
+    """Return the directory in which grid-updates keeps caches and state
+    files for a node; create it if necessary. Returns False on failure."""
+    state_dir = os.path.join(tahoe_node_dir, 'grid-updates')
+    if not os.path.isdir(state_dir):
+        try:
+            os.mkdir(state_dir)
+        except (IOError, os.error) as exc:
+            print("ERROR: %s while creating %s" % (exc, state_dir),
+                                                    file=sys.stderr)
+            return False
+    return state_dir
+
 def find_web_static_dir(tahoe_node_dir):
     """Get web.static directory from tahoe.cfg."""
     tahoe_cfg_path = os.path.join(tahoe_node_dir, 'tahoe.cfg')
@@ -173,11 +208,9 @@ def find_web_static_dir(tahoe_node_dir):
 
 def get_tahoe_version(tahoe_node_url):
     """Determine Tahoe-LAFS version number from web console."""
-    webconsole = urlopen(tahoe_node_url)
-    match = re.search(r'allmydata-tahoe:\s+([A-Za-z0-9.-]+)', webconsole.read().decode('utf8'))
-    if match is not None:
-        version = match.group(1)
-        return str(version)
+    version = get_node_info(tahoe_node_url).version
+    if version is not None:
+        return version
     else:
         raise ValueError('Incompatible Tahoe-LAFS version')
         #return False
@@ -216,42 +249,67 @@ def set_tahoe_node_url(cli_node_url, tahoe_node_dir):
         sys.exit(1)
     return node_url_parsed
 
-def json_list_is_valid(json_list, verbosity=0):
-    """Investigates a JSON list's validity."""
+def load_json(json_list, verbosity=0):
+    """Parse a JSON object; returns the decoded object or None if it is
+    invalid."""
     try:
-        keys = json.loads(json_list).keys()
+        data = json.loads(json_list)
+        keys = data.keys()
     except ValueError as ve:
         print("ERROR: Can't parse JSON list:", ve)
         if verbosity > 2:
             print(json_list)
-        return False
+        return None
     except:
         print("ERROR: JSON data is invalid (Unexpected Error).")
         if verbosity > 2:
             print(json_list)
-        return False
+        return None
     else:
         if verbosity > 3:
             print('DEBUG: JSON list seems to be valid. Found %d keys.' %
                     len(keys))
-        return True
+        return data
+
+def json_list_is_valid(json_list, verbosity=0):
+    """Investigates a JSON list's validity."""
+    return load_json(json_list, verbosity) is not None
+
+class SubscriptionEntry(namedtuple('SubscriptionEntry',
+                                   'uri name mode active contact')):
+    """
+    An entry of a subscription list (introducer list or repair list).
+    'mode' is only set in repair lists and 'active' only matters in
+    introducer lists, where it defaults to True.
+    """
+    __slots__ = ()
+
+
+def load_subscription(json_list, verbosity=0):
+    """Parse and validate a subscription list; returns a list of
+    SubscriptionEntry objects in document order or None if the list is
+    invalid. The document is decoded only once."""
+    data = load_json(json_list, verbosity)
+    if data is None:
+        return None
+    entries = []
+    for uri, info in data.items():
+        try:
+            entries.append(SubscriptionEntry(uri, info['name'],
+                                             info.get('mode'),
+                                             info.get('active', True),
+                                             info.get('contact')))
+        except (TypeError, KeyError, AttributeError):
+            print("ERROR: Can't parse JSON list.", file=sys.stderr)
+            return None
+    if verbosity > 3:
+        print('DEBUG: Subscription list seems to be valid. '
+                'Found %d keys.' % len(entries))
+    return entries
 
 def subscription_list_is_valid(json_list, verbosity=0):
     """Investigates a share list's JSON validity."""
-    if json_list_is_valid(json_list):
-        keys = json.loads(json_list).keys()
-        for uri in list(keys):
-            try:
-                json.loads(json_list)[uri]['name']
-            except TypeError:
-                print("ERROR: Can't parse JSON list.", file=sys.stderr)
-                return False
-        if verbosity > 3:
-            print('DEBUG: Subscription list seems to be valid. '
-                    'Found %d keys.' % len(keys))
-        return True
-    else:
-        return False
+    return load_subscription(json_list, verbosity) is not None
 
 def install_news_stub(web_static_dir):
     """Copy a placeholder NEWS.html file to Tahoe's web.static directory to
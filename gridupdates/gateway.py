@@ -0,0 +1,420 @@
+"""This module funnels grid-updates' requests to the Tahoe gateway."""
+
+from __future__ import print_function
+import socket
+import sys
+import threading
+import time
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from httplib import HTTPException
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+    from urlparse import parse_qs
+    from urlparse import urlsplit
+else:
+    from http.client import HTTPException
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+    from urllib.parse import parse_qs
+    from urllib.parse import urlsplit
+
+from gridupdates.client import HTTPClient
+from gridupdates.client import MAX_REDIRECTS
+from gridupdates.client import urlopen
+from gridupdates.workers import check_stopped
+from gridupdates.workers import wait_until
+
+DEFAULT_MAX_REQUESTS = 16
+# Limit to start with; it grows while the gateway keeps up.
+INITIAL_REQUESTS = 4
+# Seconds between probes of a gateway that stopped answering
+PROBE_INTERVAL = 10
+MAX_PROBE_INTERVAL = 120
+
+
+class GatewayUnavailable(Exception):
+    """The gateway has stopped answering and grid-updates gave up on it."""
+
+
+class Controller(object):
+    """
+    An AIMD (additive increase, multiplicative decrease) limit on the number
+    of requests in flight to the gateway.
+
+    Every successful request raises the limit by 1/limit, i.e. by one per
+    round of requests, up to 'ceiling'. The limit is cut when a request
+    fails (connection errors and 5xx responses) or when the average latency
+    rises to more than 'tolerance' times the lowest latency seen recently,
+    which means requests are queueing up in the gateway (or in I2P). Cuts
+    happen at most once per average latency, so a burst of slow responses
+    only counts once.
+
+    Latencies are compared per kind of request (see request_kind()): a
+    directory listing and a check with repair take very different times
+    even on an idle gateway.
+    """
+
+    error_backoff = 0.5
+    latency_backoff = 0.75
+
+    def __init__(self, ceiling=DEFAULT_MAX_REQUESTS, initial=INITIAL_REQUESTS,
+                                                tolerance=2.0, verbosity=0):
+        self.verbosity = verbosity
+        self.ceiling = max(1, int(ceiling))
+        self.limit = float(max(1, min(self.ceiling, initial)))
+        self.tolerance = tolerance
+        self.inflight = 0
+        self.latency = None
+        # average and lowest recent latency per kind of request
+        self.latencies = {}
+        self.baselines = {}
+        self.last_cut = 0
+        self.requests = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until another request may be sent."""
+        with self.condition:
+            wait_until(lambda: self.inflight < int(self.limit),
+                                        self.condition.wait, stoppable=True)
+            self.inflight += 1
+
+    def release(self, latency=None, error=False, kind=None):
+        """A request (of 'kind') has finished; adjust the limit to how it
+        went."""
+        with self.condition:
+            self.inflight -= 1
+            self.requests += 1
+            before = int(self.limit)
+            if error:
+                self.errors += 1
+                self.cut(self.error_backoff)
+            elif latency is not None:
+                self.observe(latency, kind)
+            if int(self.limit) != before and self.verbosity > 1:
+                print('INFO: Gateway request limit is now %d (latency '
+                        '%.2fs).' % (self.limit, self.latency or 0))
+            self.condition.notify_all()
+
+    def observe(self, latency, kind=None):
+        average = self.latencies.get(kind)
+        if average is None:
+            average = latency
+        else:
+            average = 0.8 * average + 0.2 * latency
+        baseline = self.baselines.get(kind)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            # let the baseline follow slow changes of the network
+            baseline += (latency - baseline) * 0.01
+        self.latencies[kind] = self.latency = average
+        self.baselines[kind] = baseline
+        if average > baseline * self.tolerance:
+            self.cut(self.latency_backoff)
+        elif int(self.limit) < self.ceiling:
+            self.limit = min(self.ceiling, self.limit + 1.0 / self.limit)
+
+    def cut(self, factor):
+        now = time.time()
+        if now - self.last_cut < (self.latency or 0):
+            return
+        self.last_cut = now
+        self.limit = max(1.0, self.limit * factor)
+
+
+class Breaker(object):
+    """
+    A circuit breaker for the connection to the gateway.
+
+    After 'threshold' connection failures in a row, the breaker opens: new
+    requests are held back and the gateway is probed (at 'probe_url') with
+    growing pauses. Once it answers again, the held back requests go ahead.
+    If it doesn't answer within 'wait' seconds (or 'wait' is 0), every
+    pending and later request fails with GatewayUnavailable, so the
+    remaining work is aborted instead of waiting for each connection to
+    fail on its own. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, probe_url=None, threshold=5, wait=900, verbosity=0,
+                                                interval=PROBE_INTERVAL):
+        self.verbosity = verbosity
+        self.probe_url = probe_url
+        self.interval = interval
+        self.threshold = threshold
+        self.wait = wait
+        self.failures = 0
+        self.open = False
+        self.dead = False
+        self.condition = threading.Condition()
+
+    def check(self):
+        """Wait while the breaker is open; raise GatewayUnavailable if the
+        gateway has been given up."""
+        with self.condition:
+            wait_until(lambda: not self.open or self.dead,
+                                                        self.condition.wait)
+            if self.dead:
+                raise GatewayUnavailable('The Tahoe gateway is not '
+                                                        'responding.')
+
+    def success(self):
+        with self.condition:
+            self.failures = 0
+
+    def failure(self):
+        """Count a connection failure; the request that trips the breaker
+        waits for the gateway to come back."""
+        with self.condition:
+            if self.open or self.dead or self.threshold <= 0:
+                return
+            self.failures += 1
+            if self.failures < self.threshold:
+                return
+            self.open = True
+        self.recover()
+
+    def recover(self):
+        if self.verbosity > 0:
+            print('WARN: The Tahoe gateway failed to answer %d times in a '
+                    'row; pausing requests.' % self.failures, file=sys.stderr)
+        deadline = time.time() + self.wait
+        pause = self.interval
+        while time.time() < deadline:
+            time.sleep(max(0, min(pause, deadline - time.time())))
+            if self.probe():
+                if self.verbosity > 0:
+                    print('The Tahoe gateway is back; resuming.')
+                with self.condition:
+                    self.open = False
+                    self.failures = 0
+                    self.condition.notify_all()
+                return
+            pause = min(pause * 2, MAX_PROBE_INTERVAL)
+        with self.condition:
+            self.dead = True
+            self.condition.notify_all()
+        self.check()
+
+    def probe(self):
+        """Check whether the gateway answers at all."""
+        if self.probe_url is None:
+            return False
+        if self.verbosity > 2:
+            print('DEBUG: Probing %s.' % self.probe_url)
+        try:
+            HTTPClient(PROBE_INTERVAL, 0).open(self.probe_url).read()
+        except HTTPError:
+            return True
+        except Exception:
+            return False
+        return True
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical requests that are in flight at the same time: the
+    first caller sends the request, the others wait for it and get the same
+    response body (or exception). Nothing is kept once the request has
+    finished, so later calls send a new request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.requests = 0
+        self.hits = 0
+
+    def do(self, key, func, *args):
+        """Return func(*args), or the result of the call for 'key' that is
+        already in flight."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {'done': threading.Event()}
+                self.requests += 1
+                leader = True
+            else:
+                self.hits += 1
+                leader = False
+        if not leader:
+            wait_until(call['done'].is_set, call['done'].wait)
+            if 'error' in call:
+                raise call['error']
+            if 'body' in call:
+                return call['body']
+            # the first caller was interrupted; try again
+            return self.do(key, func, *args)
+        try:
+            call['body'] = func(*args)
+        except Exception as exc:
+            call['error'] = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['body']
+
+
+_controller = Controller()
+_breaker = Breaker(threshold=0)
+_flights = SingleFlight()
+
+def set_max_requests(limit, verbosity=0):
+    """Limit the number of requests that may be in flight to the gateway at
+    the same time to 'limit'; the actual limit adapts to the gateway below
+    that. Call this before any work is started."""
+    global _controller
+    _controller = Controller(limit, verbosity=verbosity)
+
+def set_breaker(probe_url, threshold=5, wait=900, verbosity=0,
+                                                interval=PROBE_INTERVAL):
+    """Configure the circuit breaker; see Breaker."""
+    global _breaker
+    _breaker = Breaker(probe_url, threshold, wait, verbosity, interval)
+
+def current_limit():
+    """Return the current number of requests allowed in flight."""
+    return int(_controller.limit)
+
+def coalesced():
+    """Return (requests, hits): GET requests sent through fetch() and the
+    number of calls that shared the response of another one."""
+    return _flights.requests, _flights.hits
+
+def is_failure(exc):
+    """Check whether an exception means that the gateway is struggling, as
+    opposed to a regular answer such as '404 Not Found'."""
+    if isinstance(exc, HTTPError):
+        return exc.code >= 500
+    return isinstance(exc, (IOError, HTTPException, socket.error))
+
+def is_timeout(exc):
+    """Check whether an exception is a timeout while waiting for the
+    gateway (possibly wrapped in a URLError)."""
+    if isinstance(exc, URLError) and not isinstance(exc, HTTPError):
+        exc = exc.reason
+    return isinstance(exc, socket.timeout)
+
+def is_connection_failure(exc):
+    """Check whether an exception means that the gateway could not be
+    reached at all. A timeout doesn't count: the gateway took the request
+    but is busy, e.g. with a long repair."""
+    if isinstance(exc, HTTPError) or is_timeout(exc):
+        return False
+    return isinstance(exc, (URLError, socket.error))
+
+def report(exc):
+    """Tell the breaker how a request went; may raise GatewayUnavailable.
+    Timeouts tell nothing about whether the gateway is still there."""
+    if exc is not None and is_timeout(exc):
+        return
+    if exc is not None and is_connection_failure(exc):
+        _breaker.failure()
+    else:
+        _breaker.success()
+
+def request_kind(url, data=None):
+    """Return the kind of a request, by which the Controller compares
+    latencies: the method and the 't' parameter (e.g. ('POST', 'check'))."""
+    if data is None:
+        query = urlsplit(url).query
+        method = 'GET'
+    else:
+        query = data.decode('utf8') if isinstance(data, bytes) else data
+        method = 'POST'
+    return method, parse_qs(query).get('t', [None])[0]
+
+def fetch(url, data=None, redirects=MAX_REDIRECTS):
+    """Send a request to the gateway and return the complete response body.
+
+    A request slot is held until the body has been read, so concurrent
+    callers never exceed the current limit of in-flight requests.
+    Concurrent GET requests of the same URL share one request (see
+    SingleFlight). At most 'redirects' redirects are followed; with 0, the
+    body of the redirect itself is returned. HTTPError and URLError are
+    passed on to the caller; GatewayUnavailable is raised once the gateway
+    has stopped answering."""
+    if data is None:
+        return _flights.do(url, send, url, None, redirects)
+    return send(url, data, redirects)
+
+def send(url, data=None, redirects=MAX_REDIRECTS):
+    """Send a request to the gateway; see fetch()."""
+    check_stopped()
+    _breaker.check()
+    controller = _controller
+    controller.acquire()
+    start = time.time()
+    try:
+        response = urlopen(url, data, redirects=redirects)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+    except Exception as exc:
+        controller.release(time.time() - start, is_failure(exc))
+        report(exc)
+        raise
+    except:
+        controller.release()
+        raise
+    controller.release(time.time() - start, kind=request_kind(url, data))
+    report(None)
+    return body
+
+def stream(url, data=None):
+    """Send a request to the gateway and return a LineStream of the response
+    body. Errors while opening the URL are raised right away."""
+    check_stopped()
+    _breaker.check()
+    controller = _controller
+    controller.acquire()
+    start = time.time()
+    try:
+        response = urlopen(url, data)
+    except Exception as exc:
+        controller.release(time.time() - start, is_failure(exc))
+        report(exc)
+        raise
+    except:
+        controller.release()
+        raise
+    report(None)
+    return LineStream(response, controller, time.time() - start,
+                                                request_kind(url, data))
+
+
+class LineStream(object):
+    """
+    Iterates over a response body one line at a time, so only the current
+    line is held in memory. The request slot is released once the body has
+    been consumed or the stream is closed; the time until the response
+    started counts as the request's latency.
+    """
+
+    def __init__(self, response, controller, latency=None, kind=None):
+        self.response = response
+        self.controller = controller
+        self.latency = latency
+        self.kind = kind
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            while True:
+                line = self.response.readline()
+                if not line:
+                    break
+                yield line
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.response.close()
+            self.controller.release(self.latency, kind=self.kind)
@@ -4,19 +4,28 @@ from __future__ import print_function
 import os
 import re
 import sys
-# Maybe this is better than try -> except?
-if sys.version_info[0] == 2:
-    from urllib2 import ProxyHandler, install_opener, build_opener
-else:
-    from urllib.request import ProxyHandler, install_opener, build_opener
-
 from gridupdates.version import __version__, __patch_version__
 from gridupdates.introducers import Introducers
 from gridupdates.makenews import MakeNews
 from gridupdates.news import News
 from gridupdates.patchwebui import PatchWebUI
 from gridupdates.update import Update
+from gridupdates import client
+from gridupdates import gateway
+from gridupdates import nodeinfo
 from gridupdates import repairs
+from gridupdates import retry
+from gridupdates.cache import open_check_cache
+from gridupdates.cache import open_listing_cache
+from gridupdates.cache import open_subscription_cache
+from gridupdates.checkpoint import Checkpoint
+from gridupdates.fleet import Fleet
+from gridupdates.fleet import expand_node_dirs
+from gridupdates.workers import WorkerPool
+from gridupdates.workers import resume_jobs
+from gridupdates.workers import stop_jobs
+from gridupdates.lock import ActionLock
+from gridupdates.functions import find_state_dir
 from gridupdates.functions import find_web_static_dir
 from gridupdates.functions import gen_full_tahoe_uri
 from gridupdates.functions import is_root
@@ -28,10 +37,6 @@ from gridupdates.config import parse_args
 def main():
     """Main function: run selected actions."""
 
-    proxy_support = ProxyHandler({})
-    opener = build_opener(proxy_support)
-    install_opener(opener)
-
     # Parse config files and command line arguments
     opts = parse_args(sys.argv)
 
@@ -103,6 +108,14 @@ def main():
     if proxy_configured():
         print("WARNING: Found (and unset) the 'http_proxy' variable.")
 
+    # All requests go straight to the gateway (no proxies), over shared
+    # keep-alive connections.
+    client.set_timeout(opts.timeout)
+    gateway.set_max_requests(opts.max_requests, opts.verbosity)
+    gateway.set_breaker(tahoe_node_url + '/', opts.gateway_failures,
+                        opts.gateway_wait * 60, opts.verbosity)
+    retry.configure(opts.retries + 1, opts.retry_budget, opts.verbosity)
+
     # generate URI dictionary
     uri_dict = {'list': (opts.list_uri,
                                     gen_full_tahoe_uri(
@@ -130,48 +143,229 @@ def main():
     if opts.verbosity > 2:
         print("DEBUG: Tahoe node dir is:", opts.tahoe_node_dir)
 
+    # Caches are kept in the node directory; they are optional.
+    state_dir = find_state_dir(opts.tahoe_node_dir)
+    nodeinfo.configure(state_dir, opts.node_info_ttl * 3600)
+    listing_cache = None
+    if state_dir and (opts.repair or opts.check_version or
+                                        opts.download_update):
+        listing_cache = open_listing_cache(state_dir, opts.listing_ttl,
+                                                        opts.verbosity)
+    subscriptions = None
+    if state_dir and (opts.merge or opts.sync or opts.news or opts.repair):
+        subscriptions = open_subscription_cache(state_dir, opts.verbosity)
+
     # Run actions
     # -----------
-    if opts.merge or opts.sync:
-        intlist = Introducers(opts.tahoe_node_dir,
-                        uri_dict['list'][1],
-                        opts.verbosity)
-        if opts.sync:
-            intlist.run_action('sync')
-        elif opts.merge:
-            intlist.run_action('merge')
-    if opts.news:
-        news = News(opts.tahoe_node_dir,
-                    web_static_dir,
-                    tahoe_node_url,
-                    uri_dict['news'][1],
-                    opts.verbosity)
-        news.run_action()
+    # Each action holds its own lock, so e.g. --download-news can run while
+    # another instance is busy with a long --repair. The actions that talk
+    # to the gateway run at the same time; their output is still printed
+    # one action after the other.
+    actions = []
+    if opts.fleet and (opts.merge or opts.sync or opts.news):
+        actions.append((run_fleet, opts, uri_dict['list'][1],
+                        uri_dict['news'][1], subscriptions))
+    else:
+        if opts.merge or opts.sync:
+            actions.append((run_introducers, opts, state_dir,
+                            uri_dict['list'][1], subscriptions))
+        if opts.news:
+            actions.append((run_news, opts, state_dir, web_static_dir,
+                        tahoe_node_url, uri_dict['news'][1], subscriptions))
     if opts.check_version or opts.download_update:
-        update = Update(__version__,
-                                opts.output_dir,
-                                uri_dict['script'][1],
-                                opts.verbosity)
-        if opts.check_version:
-            update.run_action('check')
-        elif opts.download_update:
-            update.run_action('download', opts.update_format)
-        webui_patch = PatchWebUI(__patch_version__, tahoe_node_url, opts.verbosity)
-        webui_patch.patch_update_available()
+        actions.append((run_update, opts, state_dir, tahoe_node_url,
+                        uri_dict['script'][1], listing_cache))
+    if opts.repair:
+        actions.append((run_repairs, opts, state_dir, tahoe_node_url,
+                        uri_dict['repairlist'][1], listing_cache,
+                        subscriptions))
+    exit_code = run_actions(actions, opts.action_workers)
+    # local actions
     if opts.patch_ui or opts.undo_patch_ui:
-        webui = PatchWebUI(__patch_version__, tahoe_node_url, opts.verbosity)
-        if opts.patch_ui:
-            webui.run_action('patch', web_static_dir)
-        elif opts.undo_patch_ui:
-            webui.run_action('undo', web_static_dir)
+        exit_code = max(exit_code, run_actions([(run_patch, opts, state_dir,
+                            tahoe_node_url, web_static_dir)]))
     if opts.news_source_file:
         mknews = MakeNews(opts.verbosity)
         mknews.run_action(opts.news_source_file, opts.output_dir)
-    if opts.repair:
-        repairlist = repairs.RepairList(tahoe_node_url,
-                                        uri_dict['repairlist'][1],
-                                        opts.verbosity)
-        repairlist.run_action()
+    if listing_cache is not None:
+        listing_cache.close()
+    retry.print_stats(opts.verbosity)
+    if opts.verbosity > 2:
+        print('DEBUG: Sent %d requests over %d connections.' % client.stats())
+        requests, hits = gateway.coalesced()
+        print('DEBUG: %d GET requests shared the response of an identical '
+                'request in flight (%d sent).' % (hits, requests))
+    if exit_code:
+        sys.exit(exit_code)
+
+
+def exit_status(exc):
+    """Return the exit status that a SystemExit stands for."""
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code
+    # sys.exit('message') prints the message and exits with 1
+    print(exc.code, file=sys.stderr)
+    return 1
+
+def run_action(func, *args):
+    """Run an action; returns its exit status instead of exiting. Unexpected
+    errors are reported and count as exit status 1, so they don't abort the
+    actions running at the same time."""
+    try:
+        func(*args)
+    except SystemExit as exc:
+        return exit_status(exc)
+    except Exception as exc:
+        print('ERROR: %s' % exc, file=sys.stderr)
+        return 1
+    return 0
+
+def run_actions(actions, workers=1):
+    """Run the actions, given as (function, arguments...) tuples, with up to
+    'workers' of them at the same time. An action that fails doesn't stop
+    the others. Returns the highest exit status of all actions.
+
+    Ctrl-C only interrupts the main thread; the actions running in other
+    threads are then stopped (see stop_jobs()) and waited for, so they
+    can save their state and release their locks."""
+    pool = WorkerPool(workers)
+    threaded = pool.workers > 1
+    try:
+        for action in actions:
+            pool.submit(run_action, *action)
+        # join() would wait for the running actions before Ctrl-C could
+        # stop them
+        pool.wait()
+        pool.join()
+    except KeyboardInterrupt:
+        if threaded:
+            print('\nStopping the running actions.', file=sys.stderr)
+            stop_jobs()
+            try:
+                pool.wait()
+            finally:
+                resume_jobs()
+        raise
+    finally:
+        pool.close()
+    return max([job.value for job in pool.jobs] or [0])
+
+def run_introducers(opts, state_dir, list_url, subscriptions=None):
+    """Run --merge-introducers or --sync-introducers."""
+    with ActionLock(state_dir, 'introducers', opts.lock_wait,
+                                        opts.verbosity) as lock:
+        if lock.acquired:
+            intlist = Introducers(opts.tahoe_node_dir,
+                            list_url,
+                            opts.verbosity,
+                            subscriptions)
+            if opts.sync:
+                intlist.run_action('sync')
+            elif opts.merge:
+                intlist.run_action('merge')
+
+def run_fleet(opts, list_url, news_url, subscriptions=None):
+    """Run the introducer and news actions on the --fleet nodes."""
+    node_dirs = expand_node_dirs(opts.fleet, opts.verbosity)
+    if not node_dirs:
+        print('ERROR: No node directories found for --fleet.',
+                                                    file=sys.stderr)
+        sys.exit(1)
+    if opts.sync:
+        mode = 'sync'
+    elif opts.merge:
+        mode = 'merge'
+    else:
+        mode = None
+    fleet = Fleet(node_dirs, opts.verbosity, opts.fleet_workers,
+                                                    opts.lock_wait)
+    if not fleet.run_action(mode, list_url, opts.news and news_url or None,
+                                                        subscriptions):
+        sys.exit(1)
+
+def run_news(opts, state_dir, web_static_dir, tahoe_node_url, news_url,
+                                                        subscriptions=None):
+    """Run --download-news."""
+    with ActionLock(state_dir, 'news', opts.lock_wait,
+                                        opts.verbosity) as lock:
+        if lock.acquired:
+            news = News(opts.tahoe_node_dir,
+                        web_static_dir,
+                        tahoe_node_url,
+                        news_url,
+                        opts.verbosity,
+                        subscriptions)
+            news.run_action()
+
+def run_update(opts, state_dir, tahoe_node_url, script_url, listing_cache):
+    """Run --check-version or --download-update."""
+    with ActionLock(state_dir, 'update', opts.lock_wait,
+                                        opts.verbosity) as lock:
+        if lock.acquired:
+            update = Update(__version__,
+                                    opts.output_dir,
+                                    script_url,
+                                    opts.verbosity,
+                                    listing_cache)
+            if opts.check_version:
+                update.run_action('check')
+            elif opts.download_update:
+                update.run_action('download', opts.update_format)
+            webui_patch = PatchWebUI(__patch_version__, tahoe_node_url,
+                                                        opts.verbosity)
+            webui_patch.patch_update_available()
+
+def run_patch(opts, state_dir, tahoe_node_url, web_static_dir):
+    """Run --patch-tahoe or --undo-patch-tahoe."""
+    with ActionLock(state_dir, 'patch', opts.lock_wait,
+                                        opts.verbosity) as lock:
+        if lock.acquired:
+            webui = PatchWebUI(__patch_version__, tahoe_node_url,
+                                                        opts.verbosity)
+            if opts.patch_ui:
+                webui.run_action('patch', web_static_dir)
+            elif opts.undo_patch_ui:
+                webui.run_action('undo', web_static_dir)
+
+
+def run_repairs(opts, state_dir, tahoe_node_url, repairlist_url,
+                                        listing_cache, subscriptions=None):
+    """Run --repair with the caches and checkpoint in 'state_dir'."""
+    with ActionLock(state_dir, 'repair', opts.lock_wait,
+                                        opts.verbosity) as lock:
+        if lock.acquired:
+            if state_dir:
+                check_cache = open_check_cache(state_dir, opts.check_freshness,
+                                                                opts.verbosity)
+                checkpoint = Checkpoint(os.path.join(state_dir,
+                                                    'repair-state.json'),
+                                        opts.resume, opts.verbosity)
+            else:
+                check_cache = None
+                checkpoint = None
+            repairlist = repairs.RepairList(tahoe_node_url,
+                                            repairlist_url,
+                                            opts.verbosity,
+                                            opts.repair_workers,
+                                            check_cache,
+                                            opts.crawl_workers,
+                                            listing_cache,
+                                            checkpoint,
+                                            opts.repair_strategy,
+                                            opts.lease_interval,
+                                            opts.deep_check_method,
+                                            opts.poll_interval,
+                                            subscriptions)
+            try:
+                repairlist.run_action()
+            except gateway.GatewayUnavailable as exc:
+                print('ERROR: %s Aborting repairs.' % exc, file=sys.stderr)
+                sys.exit(1)
+            finally:
+                if check_cache is not None:
+                    check_cache.close()
 
 
 if __name__ == "__main__":
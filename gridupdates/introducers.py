@@ -1,17 +1,18 @@
 from __future__ import print_function
-import json
+from io import BytesIO
 import os
 import sys
 
 from gridupdates.functions import tahoe_dl_file
 from gridupdates.functions import is_valid_introducer
-from gridupdates.functions import subscription_list_is_valid
+from gridupdates.functions import load_subscription
 
 class Introducers(object):
     """This class implements the introducer list related functions of
     grid-updates."""
 
-    def __init__(self, nodedir, url, verbosity=0):
+    def __init__(self, nodedir, url, verbosity=0, subscriptions=None,
+                                                            document=None):
         self.verbosity = verbosity
         self.nodedir = nodedir
         self.url = url
@@ -21,12 +22,18 @@ class Introducers(object):
         self.introducers = os.path.join(self.nodedir, 'introducers')
         self.introducers_bak = self.introducers + '.bak'
         (self.old_introducers, self.old_list) = self.read_existing_list()
-        json_response = tahoe_dl_file(self.url, verbosity)
+        if document is not None:
+            # the list has been downloaded already (--fleet)
+            json_response = BytesIO(document)
+        else:
+            json_response = tahoe_dl_file(self.url, verbosity, 'introducers',
+                                                            subscriptions)
         self.intro_dict = self.create_intro_dict(json_response)
 
     def run_action(self, mode):
         """Call this method to execute the desired action (--merge-introducers
-        or --sync-introducers)."""
+        or --sync-introducers). Returns True if the introducers file has been
+        changed."""
         if not self.intro_dict:
             if self.verbosity > 2:
                 print('DEBUG: introducer list appears to be empty. Aborting.')
@@ -40,6 +47,7 @@ class Introducers(object):
                 if self.new_intros:
                     self.backup_original()
                     self.merge_introducers()
+                    return True
                 else:
                     if self.verbosity > 0:
                         print('Introducer list already up-to-date.')
@@ -47,10 +55,12 @@ class Introducers(object):
             if self.lists_differ():
                 self.backup_original()
                 self.sync_introducers()
+                return True
+        return False
 
     def create_intro_dict(self, json_response):
-        """Compile a dictionary of introducers (uri->name,active) from a JSON
-        object."""
+        """Compile a dictionary of introducers (uri->SubscriptionEntry) from a
+        JSON object."""
         intro_dict = {}
         try:
             new_list = json_response.read().decode('utf8')
@@ -59,19 +69,18 @@ class Introducers(object):
             print("ERROR: Couldn't read introducer list.",
                     file=sys.stderr)
             return
-        if not subscription_list_is_valid(new_list, self.verbosity):
+        entries = load_subscription(new_list, self.verbosity)
+        if entries is None:
             return
-        for uri in json.loads(new_list).keys():
-            name = json.loads(new_list)[uri]['name']
-            active = json.loads(new_list)[uri]['active']
-            if is_valid_introducer(uri):
+        for entry in entries:
+            if is_valid_introducer(entry.uri):
                 if self.verbosity > 2:
-                    print('DEBUG: Valid introducer address: %s' % uri)
-                intro_dict[uri] = (name, active)
+                    print('DEBUG: Valid introducer address: %s' % entry.uri)
+                intro_dict[entry.uri] = entry
             else:
                 if self.verbosity > 0:
                     print("WARN: '%s' is not a valid Tahoe-LAFS introducer "
-                            "address. Skipping.")
+                            "address. Skipping." % entry.uri)
         return intro_dict
 
     def read_existing_list(self):
@@ -113,12 +122,12 @@ class Introducers(object):
         self.subscription_uris = []
         for introducer in list(self.intro_dict.keys()):
             # only include active introducers
-            if self.intro_dict[introducer][1]:
+            if self.intro_dict[introducer].active:
                 self.subscription_uris.append(introducer)
             else:
                 if self.verbosity > 2:
                     print('INFO: Skipping disabled introducer: %s' %
-                            self.intro_dict[introducer][0])
+                            self.intro_dict[introducer].name)
         if sorted(self.subscription_uris) == sorted(self.old_list):
             if self.verbosity > 0:
                 print('Introducer list already up-to-date.')
@@ -136,10 +145,10 @@ class Introducers(object):
         try:
             with open(self.introducers, 'a') as intlist:
                 for new_intro in self.new_intros:
-                    if self.intro_dict[new_intro][1]:
+                    if self.intro_dict[new_intro].active:
                         if self.verbosity > 0:
                             print('New introducer: %s.' %
-                                    self.intro_dict[new_intro][0])
+                                    self.intro_dict[new_intro].name)
                         intlist.write(new_intro + '\n')
         except IOError as exc:
             print('ERROR: Could not write to introducer file: %s' % exc,
@@ -165,11 +174,11 @@ class Introducers(object):
             if self.verbosity > 0:
                 for introducer in self.new_intros:
                     print('Added introducer: %s' %
-                            self.intro_dict[introducer][0])
+                            self.intro_dict[introducer].name)
                 for introducer in self.expired_intros:
                     if introducer in self.intro_dict:
                         print('Removed introducer: %s' %
-                                self.intro_dict[introducer][0])
+                                self.intro_dict[introducer].name)
                     else:
                         print('Removed unknown introducer: %s' % introducer)
                 print('Successfully updated the introducer list.'
@@ -0,0 +1,177 @@
+"""This module keeps grid-updates instances from running the same action at
+the same time."""
+
+from __future__ import print_function
+import binascii
+import ctypes
+import errno
+import os
+import socket
+import sys
+import time
+
+
+def pid_is_running(pid):
+    """Check whether a process with the given PID exists."""
+    if os.name == 'nt':
+        # os.kill() would terminate the process on Windows.
+        process_query_limited_information = 0x1000
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(process_query_limited_information,
+                                                                False, pid)
+        if not handle:
+            return False
+        kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def parse_owner(content):
+    """Return (pid, hostname) of a lock's owner or None if the content of
+    the lock file is incomplete."""
+    try:
+        fields = content.split()
+        return int(fields[0]), fields[1]
+    except (AttributeError, ValueError, IndexError):
+        return None
+
+
+class ActionLock(object):
+    """
+    A lock file ('<action>.lock' in the grid-updates state directory) held
+    while an action runs.
+
+    The lock file contains the owner's PID and host name. Locks of processes
+    that no longer exist on this host are stale and will be taken over (see
+    take_over()). If
+    the lock is held by a live process, acquire() waits up to 'wait' seconds
+    and then gives up, so the caller can skip the action.
+
+    Use it as a context manager and check 'acquired':
+
+        with ActionLock(state_dir, 'repair') as lock:
+            if lock.acquired:
+                ...
+    """
+
+    def __init__(self, state_dir, action, wait=0, verbosity=0):
+        self.verbosity = verbosity
+        self.action = action
+        self.wait = wait
+        self.acquired = False
+        if state_dir:
+            self.path = os.path.join(state_dir, action + '.lock')
+        else:
+            self.path = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        """Try to take the lock; returns True on success."""
+        if self.path is None:
+            # No place to keep lock files; don't stand in the way.
+            self.acquired = True
+            return True
+        deadline = time.time() + self.wait
+        while True:
+            if self.create():
+                self.acquired = True
+                if self.verbosity > 2:
+                    print('DEBUG: Acquired lock %s.' % self.path)
+                return True
+            content = self.read()
+            owner = parse_owner(content)
+            if self.is_stale(owner):
+                if self.take_over(content) and self.verbosity > 0:
+                    print('WARN: Removed stale lock file %s.' % self.path,
+                                                            file=sys.stderr)
+                continue
+            if time.time() >= deadline:
+                if owner is None:
+                    owner = ('?', 'unknown host')
+                print("WARN: Another grid-updates instance (PID %s on %s) "
+                        "holds the '%s' lock; skipping this action." %
+                        (owner[0], owner[1], self.action), file=sys.stderr)
+                return False
+            time.sleep(min(1, max(0, deadline - time.time())))
+
+    def create(self, content=None):
+        """Atomically create the lock file; returns False if it exists."""
+        if content is None:
+            content = '%d %s %d\n' % (os.getpid(), socket.gethostname(),
+                                                                time.time())
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, content.encode('utf8'))
+        os.close(fd)
+        return True
+
+    def read(self, path=None):
+        """Return the content of the lock file or None if it is
+        unreadable."""
+        try:
+            with open(path or self.path, 'r') as lockfile:
+                return lockfile.read()
+        except (IOError, OSError):
+            return None
+
+    def take_over(self, content):
+        """Remove the stale lock file that contained 'content'.
+
+        Several instances may find the same stale lock at once. Each of them
+        renames the lock file to a name of its own first, so only one of them
+        gets it; the others find no file and try again. If the file that was
+        renamed is not the stale lock any more (another instance has taken
+        over and created a new lock meanwhile), it is put back. Returns True
+        if the stale lock was removed by this instance."""
+        aside = '%s.%d.%s' % (self.path, os.getpid(),
+                            binascii.hexlify(os.urandom(4)).decode('ascii'))
+        try:
+            os.rename(self.path, aside)
+        except OSError:
+            return False
+        moved = self.read(aside)
+        if moved != content and moved is not None:
+            self.create(moved)
+        self.remove(aside)
+        return moved == content
+
+    def is_stale(self, owner):
+        if owner is None:
+            # Either the owner is still writing the file or it died while
+            # doing so.
+            try:
+                return time.time() - os.path.getmtime(self.path) > 10
+            except OSError:
+                return True
+        pid, hostname = owner
+        if hostname != socket.gethostname():
+            # We cannot look at processes on other hosts.
+            return False
+        return not pid_is_running(pid)
+
+    def remove(self, path=None):
+        try:
+            os.remove(path or self.path)
+        except OSError:
+            pass
+
+    def release(self):
+        if self.acquired and self.path is not None:
+            self.remove()
+            if self.verbosity > 2:
+                print('DEBUG: Released lock %s.' % self.path)
+        self.acquired = False
@@ -7,14 +7,15 @@ import tarfile
 import tempfile # use os.tmpfile()?
 # Maybe this is better than try -> except?
 if sys.version_info[0] == 2:
+    from httplib import HTTPException
     from urllib2 import HTTPError
-    from urllib2 import urlopen
     from urllib2 import URLError
 else:
-    from urllib.request import urlopen
+    from http.client import HTTPException
     from urllib.error import HTTPError
     from urllib.error import URLError
 
+from gridupdates.download import download_file
 from gridupdates.functions import remove_temporary_dir
 from gridupdates.functions import create_web_static_dir
 
@@ -22,8 +23,12 @@ class News(object):
     """This class implements the --download-news function of grid-updates."""
 
     def __init__(self, tahoe_node_dir, web_static_dir, tahoe_node_url,
-                                                    url, verbosity=0):
+                    url, verbosity=0, subscriptions=None, archive=None):
         self.verbosity = verbosity
+        self.subscriptions = subscriptions
+        # NEWS.tgz downloaded already (--fleet)
+        self.archive = archive
+        self.unchanged = False
         if self.verbosity > 0:
             print("-- Updating NEWS --")
         self.tahoe_node_dir = tahoe_node_dir
@@ -34,15 +39,21 @@ class News(object):
         self.url = url
         self.local_news = os.path.join(self.tahoe_node_dir, 'NEWS')
         self.tempdir = tempfile.mkdtemp()
-        self.local_archive = os.path.join(self.tempdir, 'NEWS.tgz')
+        self.local_archive = archive or os.path.join(self.tempdir, 'NEWS.tgz')
 
     def run_action(self):
         """Call this method to execute the desired action (--download-news). It
-        will run the necessary methods."""
+        will run the necessary methods. Returns True if new NEWS have been
+        installed, False if there are none and None on errors."""
         if self.verbosity > 2:
             print('DEBUG: Selected action: --download-news')
         if not self.download_news():
             return
+        if self.unchanged and os.path.exists(self.local_news):
+            # the same NEWS.tgz has been installed before
+            if self.verbosity > 0:
+                print('There are no news.')
+            return False
         if not self.extract_tgz():
             return
         if self.news_differ():
@@ -50,33 +61,45 @@ class News(object):
         else:
             if self.verbosity > 0:
                 print('There are no news.')
-                return False
+            return False
         # adjust Atom links to point to the configured node URL
         self.fix_atom_links()
         # Copy in any case to make easily make sure that all versions
         # (escpecially the HTML version) are always present:
-        self.install_files()
+        if not self.install_files():
+            return
         return True
 
     def download_news(self):
         """Download NEWS.tgz file to local temporary file."""
         url = self.url
+        if self.archive is not None:
+            return True
+        if self.subscriptions is not None:
+            response = self.subscriptions.lookup(url)
+            if response is not None:
+                self.unchanged = True
+                with open(self.local_archive,'wb') as output:
+                    output.write(response)
+                return True
         if self.verbosity > 1:
             print("INFO: Downloading news from the Tahoe grid.")
         if self.verbosity > 2:
             print("INFO: Downloading", url)
         try:
-            response = urlopen(url).read()
+            download_file(url, self.local_archive, self.verbosity, 'news')
         except HTTPError:
             print("ERROR: Couldn't find %s." % url, file=sys.stderr)
             return False
-        except URLError as urlexc:
+        except (URLError, HTTPException, IOError) as urlexc:
             print("ERROR: %s while looking for %s." % (urlexc, url),
                                                     file=sys.stderr)
             return False
         else:
-            with open(self.local_archive,'wb') as output:
-                output.write(response)
+            if self.subscriptions is not None:
+                with open(self.local_archive, 'rb') as archive:
+                    self.unchanged = not self.subscriptions.store(url,
+                                                            archive.read())
             return True
 
     def extract_tgz(self):
@@ -153,8 +176,10 @@ class News(object):
         except (IOError, os.error):
             print("ERROR: Couldn't copy one or more NEWS files into the "
                   "node directory.", file=sys.stderr)
+            return False
         else:
             if self.verbosity > 2:
                 print('DEBUG: Copied NEWS files into the node directory.')
+            return True
         finally:
             remove_temporary_dir(self.tempdir, self.verbosity)
@@ -0,0 +1,115 @@
+"""This module collects facts about the Tahoe node from its welcome page."""
+
+from __future__ import print_function
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from gridupdates.client import urlopen
+
+
+class NodeInfo(object):
+    """
+    What the welcome page of a Tahoe node tells about it: the Tahoe-LAFS
+    version and the installation directory of the 'allmydata' package.
+    Facts the page doesn't show are None.
+    """
+
+    __slots__ = ('url', 'version', 'tahoe_dir', 'fetched')
+
+    def __init__(self, url, version=None, tahoe_dir=None, fetched=None):
+        self.url = url
+        self.version = version
+        self.tahoe_dir = tahoe_dir
+        self.fetched = fetched
+
+    @classmethod
+    def from_page(cls, url, page):
+        """Parse a welcome page."""
+        version = re.search(r'allmydata-tahoe:\s+([A-Za-z0-9.-]+)', page)
+        init = re.search(r'.*\ \'(.*__init__.py)', page)
+        return cls(url,
+                   version and str(version.group(1)),
+                   init and os.path.dirname(init.group(1)),
+                   time.time())
+
+    def to_json(self):
+        return {'version': self.version, 'tahoe_dir': self.tahoe_dir,
+                'fetched': self.fetched}
+
+
+_memo = {}
+_settings = {'state_dir': None, 'ttl': 0}
+_lock = threading.Lock()
+
+def configure(state_dir, ttl=0):
+    """Keep node information in 'state_dir' for 'ttl' seconds, so later
+    runs don't have to fetch the welcome page. A ttl of 0 keeps it in
+    memory only."""
+    _settings.update(state_dir=state_dir, ttl=ttl)
+
+def get_node_info(tahoe_node_url, verbosity=0):
+    """Return the NodeInfo of the node at 'tahoe_node_url'. The welcome page
+    is fetched at most once per process (and TTL if persisted). Network
+    errors are passed on to the caller."""
+    with _lock:
+        info = _memo.get(tahoe_node_url)
+        if info is None:
+            info = load(tahoe_node_url)
+        if info is None:
+            if verbosity > 2:
+                print('DEBUG: Reading welcome page of %s.' % tahoe_node_url)
+            page = urlopen(tahoe_node_url).read().decode('utf8')
+            info = NodeInfo.from_page(tahoe_node_url, page)
+            save(info)
+        _memo[tahoe_node_url] = info
+        return info
+
+def state_file():
+    if not _settings['state_dir'] or _settings['ttl'] <= 0:
+        return None
+    return os.path.join(_settings['state_dir'], 'nodeinfo.json')
+
+def read_state(path):
+    try:
+        with open(path, 'r') as statefile:
+            state = json.load(statefile)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(state, dict):
+        return {}
+    return state
+
+def load(tahoe_node_url):
+    """Return persisted, still fresh NodeInfo of the node or None."""
+    path = state_file()
+    if path is None:
+        return None
+    entry = read_state(path).get(tahoe_node_url)
+    try:
+        age = time.time() - entry['fetched']
+        if age < 0 or age > _settings['ttl']:
+            return None
+        return NodeInfo(tahoe_node_url, entry['version'], entry['tahoe_dir'],
+                                                        entry['fetched'])
+    except (TypeError, KeyError):
+        return None
+
+def save(info):
+    path = state_file()
+    if path is None:
+        return
+    state = read_state(path)
+    state[info.url] = info.to_json()
+    try:
+        with open(path + '.tmp', 'w') as statefile:
+            json.dump(state, statefile)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    except (IOError, os.error) as exc:
+        print('WARN: Could not save node information: %s' % exc,
+                                                        file=sys.stderr)
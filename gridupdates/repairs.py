@@ -1,51 +1,85 @@
 from __future__ import print_function
+import binascii
 import json
+import os
 import random
 import re
 import sys
+import threading
+import time
 # Maybe this is better than try -> except?
 if sys.version_info[0] == 2:
+    from httplib import HTTPException
+    from urllib import quote
     from urllib import urlencode
     from urllib2 import HTTPError
-    from urllib2 import urlopen
     from urllib2 import URLError
 else:
-    from urllib.request import urlopen
+    from http.client import HTTPException
+    from urllib.parse import quote
     from urllib.parse import urlencode
     from urllib.error import HTTPError
     from urllib.error import URLError
 
+from gridupdates import retry
+from gridupdates.cache import fetch_listing
 from gridupdates.functions import gen_full_tahoe_uri
 from gridupdates.functions import is_literal_file
 from gridupdates.functions import tahoe_dl_file
-from gridupdates.functions import json_list_is_valid
-from gridupdates.functions import subscription_list_is_valid
+from gridupdates.functions import load_json
+from gridupdates.functions import load_subscription
+from gridupdates.gateway import GatewayUnavailable
+from gridupdates.gateway import current_limit
+from gridupdates.gateway import fetch
+from gridupdates.gateway import stream
+from gridupdates.workers import WorkerPool
+from gridupdates.workers import run_ordered
+from gridupdates.workers import wait_until
 
-def repair_share(sharename, repair_uri, mode, verbosity=0):
-    """Run (deep-)checks including repair and add-lease on a Tahoe share;
-    returns response in JSON format."""
+def repair_share(sharename, repair_uri, mode, verbosity=0, repair=True,
+                                                add_lease=True, ophandle=None):
+    """Run (deep-)checks on a Tahoe share, by default including repair and
+    add-lease; returns response in JSON format.
+
+    If an 'ophandle' is given, a deep-check is only started as an
+    asynchronous operation; see poll_operation()."""
     if verbosity > 0:
-        print("Repairing '%s' share (%s)." % (sharename, mode))
-    if mode == 'deep-check':
-        params = urlencode({'t': 'stream-deep-check',
-                            'repair': 'true',
-                            'add-lease': 'true',
-                            'output': 'json'}
-                            ).encode('utf8')
+        if repair:
+            print("Repairing '%s' share (%s)." % (sharename, mode))
+        elif add_lease:
+            print("Renewing leases of '%s' share (%s)." % (sharename, mode))
+        else:
+            print("Checking '%s' share (%s)." % (sharename, mode))
+    if mode == 'deep-check' and ophandle is not None:
+        fields = [('t', 'start-deep-check'), ('ophandle', ophandle),
+                  ('release-after-complete', 'true')]
+    elif mode == 'deep-check':
+        fields = [('t', 'stream-deep-check')]
     elif mode == 'one-check':
-        params = urlencode({'t': 'check',
-                            'repair': 'true',
-                            'add-lease': 'true',
-                            'output': 'json'}
-                            ).encode('utf8')
+        fields = [('t', 'check')]
     else:
         print("ERROR: 'mode' must either be 'one-check' or 'deep-check'.",
                                                         file=sys.stderr)
         sys.exit(1)
+    if repair:
+        fields.append(('repair', 'true'))
+    if add_lease:
+        fields.append(('add-lease', 'true'))
+    fields.append(('output', 'json'))
+    params = urlencode(fields).encode('utf8')
     if verbosity > 2:
         print('DEBUG: Running urlopen(%s, %s).' % (repair_uri, params))
     try:
-        response = urlopen(repair_uri, params)
+        if mode == 'deep-check' and ophandle is None:
+            response = retry.policy('repair').call(stream, repair_uri, params)
+        elif mode == 'deep-check':
+            # The gateway redirects to the operation's status page. Fetching
+            # it would release the handle once the operation has completed,
+            # before poll_operation() gets the results.
+            response = retry.policy('repair').call(fetch, repair_uri, params,
+                                                                        0)
+        else:
+            response = retry.policy('repair').call(fetch, repair_uri, params)
     except HTTPError as exc:
         print('ERROR: Could not run %s for %s: %s' % (mode, sharename, exc),
                                                         file=sys.stderr)
@@ -56,57 +90,214 @@ def repair_share(sharename, repair_uri, mode, verbosity=0):
         return
     except KeyboardInterrupt:
         sys.exit(1)
+    except GatewayUnavailable:
+        raise
     except:
         print("ERROR: Could not run %s on %s." % (mode, sharename),
                                                     file=sys.stderr)
         return
     else:
-        if mode == 'deep-check':
-            # deep-check returns multiple JSON objects, 1 per line
-            result = response.readlines()
-        elif mode == 'one-check':
-            # one-check returns a single JSON object
-            result = response.read()
-        return result
+        # deep-check returns multiple JSON objects, 1 per line, which are read
+        # as the gateway produces them; one-check returns a single JSON object.
+        return response
+
+def new_ophandle():
+    """Generate a random handle for an asynchronous gateway operation."""
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+def poll_operation(tahoe_node_url, ophandle, verbosity=0):
+    """Ask the gateway for the status of the operation 'ophandle'. Returns
+    the decoded JSON status (with a 'finished' key), an HTTPError if the
+    gateway does not know the operation, or None on other errors."""
+    url = '%s/operations/%s?t=status&output=JSON' % (tahoe_node_url,
+                                                        ophandle)
+    if verbosity > 3:
+        print('DEBUG: Polling %s.' % url)
+    try:
+        status = fetch(url)
+    except HTTPError as exc:
+        return exc
+    except (URLError, HTTPException, IOError) as exc:
+        print('WARN: Could not poll operation %s: %s' % (ophandle, exc),
+                                                        file=sys.stderr)
+        return None
+    return load_json(status.decode('utf8'), verbosity)
+
+def iter_operation_results(status):
+    """Yield a CheckResult for each unhealthy object listed in the final
+    status of a deep-check operation."""
+    for path, results in status.get('list-unhealthy-files', []):
+        data = {'path': path, 'type': 'file',
+                'storage-index': results.get('storage-index', ''),
+                'check-and-repair-results': results}
+        result = CheckResult.from_json(data)
+        if result is not None:
+            yield result
+
+class CheckResult(object):
+    """
+    The parts of a Tahoe check result grid-updates cares about. Built once
+    per JSON object so consumers don't have to dig through the raw data
+    again.
+    """
+
+    __slots__ = ('path', 'type', 'storage_index', 'summary', 'healthy',
+                 'shares_good', 'shares_needed', 'shares_expected',
+                 'repaircap', 'verifycap')
+
+    def __init__(self, path, uritype, storage_index, summary, healthy,
+                        shares_good=None, shares_needed=None,
+                        shares_expected=None, repaircap=None, verifycap=None):
+        self.path = path
+        self.type = uritype
+        self.storage_index = storage_index
+        self.summary = summary
+        self.healthy = healthy
+        self.shares_good = shares_good
+        self.shares_needed = shares_needed
+        self.shares_expected = shares_expected
+        self.repaircap = repaircap
+        self.verifycap = verifycap
+
+    @classmethod
+    def from_json(cls, data):
+        """Create a record from a decoded check or deep-check result; returns
+        None for objects that are not results (e.g. deep-check's final
+        'stats' line)."""
+        #   [u'check-and-repair-results', u'cap', u'repaircap',
+        #   u'verifycap', u'path', u'type', u'storage-index']
+        if 'check-and-repair-results' in data:
+            results = data['check-and-repair-results']
+        elif 'check-results' in data:
+            results = data['check-results']
+        elif 'storage-index' in data:
+            results = data
+        else:
+            return None
+        if 'post-repair-results' in results:
+            results = results['post-repair-results']
+        summary = results.get('summary', '')
+        counts = results.get('results', {})
+        healthy = counts.get('healthy', not summary.startswith('Unhealthy'))
+        return cls(tuple(data.get('path', ())),
+                   data.get('type'),
+                   data.get('storage-index', ''),
+                   summary,
+                   healthy,
+                   counts.get('count-shares-good'),
+                   counts.get('count-shares-needed'),
+                   counts.get('count-shares-expected'),
+                   data.get('repaircap'),
+                   data.get('verifycap'))
+
+class _IndexEntry(object):
+    """A check in the CheckIndex; 'record' is set once it has finished."""
+
+    __slots__ = ('record', 'finished')
+
+    def __init__(self):
+        self.record = None
+        self.finished = threading.Event()
+
+
+class CheckIndex(object):
+    """
+    The objects checked during a repair run, by storage index and verify
+    cap, so objects that appear in several places (overlapping subscription
+    entries, files linked more than once) are only checked once.
+
+    claim() hands a check to the first caller asking for it; everybody else
+    gets its result, waiting for it if the check is still running.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.saved = 0
+
+    def claim(self, keys):
+        """Return (entry, True) if the caller has to check the object known
+        by 'keys' and report its result with finish(entry, record); return
+        (record, False) if it has already been checked."""
+        keys = [key for key in keys if key]
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    break
+            else:
+                entry = _IndexEntry()
+                for key in keys:
+                    self.entries[key] = entry
+                return entry, True
+        wait_until(entry.finished.is_set, entry.finished.wait)
+        if entry.record is None:
+            # the first check failed; try again
+            return _IndexEntry(), True
+        with self.lock:
+            self.saved += 1
+        return entry.record, False
+
+    def finish(self, entry, record):
+        """Record the result of a claimed check (None if it failed)."""
+        with self.lock:
+            entry.record = record
+            if record is not None:
+                for key in (record.storage_index, record.verifycap):
+                    if key:
+                        self.entries.setdefault(key, entry)
+        entry.finished.set()
+
+    def add(self, record):
+        """Record an object checked without claiming it first (e.g. by a
+        streamed deep-check)."""
+        self.finish(_IndexEntry(), record)
+
+
+def load_result(json_result, verbosity=0):
+    """Decode a single JSON check result into a CheckResult; returns None if
+    the data is invalid or not a check result."""
+    data = load_json(json_result, verbosity)
+    if data is None:
+        return None
+    return CheckResult.from_json(data)
+
+def iter_results(lines, verbosity=0):
+    """Decode a stream of deep-check result lines; yields a CheckResult for
+    each line as soon as it has been received."""
+    for line in lines:
+        line = line.decode('utf8').strip()
+        if not line:
+            continue
+        result = load_result(line, verbosity)
+        if result is not None:
+            yield result
 
 def parse_result(result, mode, unhealthy, verbosity=0):
-    """Parse JSON response from Tahoe deep-check operation.
+    """Evaluate a CheckResult from a Tahoe (deep-)check operation.
     Optionally prints status output; returns number of unhealthy shares.
     """
-    #   [u'check-and-repair-results', u'cap', u'repaircap',
-    #   u'verifycap', u'path', u'type', u'storage-index']
     if mode == 'deep-check':
-        # Check for expected result line
-        if not ('check-and-repair-results' in
-                list(json.loads(result).keys())):
-            # This would be the final 'stats' line.
-            return 'unchecked', unhealthy
         if is_literal_file(result):
-            print('  %s: (literal file)' %
-                    ('/'.join(json.loads(result)['path'])))
+            print('  %s: (literal file)' % ('/'.join(result.path)))
             return 'unchecked', unhealthy
-        path    = json.loads(result)['path']
-        uritype = json.loads(result)['type']
-        status  = (json.loads(result)
-                    ['check-and-repair-results']
-                    ['post-repair-results']
-                    ['summary'])
+        status = result.summary
         # Print
         if verbosity > 1:
-            if uritype == 'directory' and not path:
+            if result.type == 'directory' and not result.path:
                 print('  <root>: %s' % status)
             else:
-                print('  %s: %s' % ('/'.join(path), status))
+                print('  %s: %s' % ('/'.join(result.path), status))
         # Count unhealthy
-        if status.startswith('Unhealthy'):
+        if not result.healthy:
             unhealthy += 1
         return status, unhealthy
     elif mode == 'one-check':
         if is_literal_file(result):
             return 'unchecked (literal file)', unhealthy
-        status = json.loads(result)['post-repair-results']['summary']
+        status = result.summary
         # Count unhealthy
-        if status.startswith('Unhealthy'):
+        if not result.healthy:
             unhealthy += 1
         return status, unhealthy
 
@@ -117,112 +308,636 @@ class RepairList(object):
 
     This will download a json file and repair the included shares. The json
     file must include the repair mode to be used.  Known modes are one-check,
-    deep-check and level-check.
+    deep-check, parallel-deep-check and level-check.
 
     level-check is a custom mode that tries to be a limited version of
     deep-check. It will repair a directory structure as far as the configured
     number of levels allows.
+
+    parallel-deep-check fetches the tree's manifest once and checks each
+    object (storage index) separately, 'workers' at a time, instead of
+    letting the gateway walk the tree one object after the other.
+
+    Up to 'workers' shares are repaired at the same time; their output is
+    printed in list order. If a CheckCache is given, one-checks of objects
+    that were recently found healthy are skipped; a ListingCache saves
+    directory listings between runs. A Checkpoint records the progress so
+    an interrupted run can be resumed. Within a run, every storage index is
+    checked only once (see CheckIndex). A SubscriptionCache saves
+    downloading an unchanged subscription file.
+
+    With the 'two-phase' strategy, objects are first checked without repair
+    and only the unhealthy ones are repaired. Leases are then renewed in a
+    separate batch, for each share at most every 'lease_interval' days (if
+    a CheckCache keeps track of them).
+
+    With the 'ophandle' deep-check method, all deep-checks are started as
+    asynchronous gateway operations at once and polled every
+    'poll_interval' seconds, instead of holding a connection open for each.
     """
 
-    def __init__(self, tahoe_node_url, subscription_uri, verbosity=0):
+    def __init__(self, tahoe_node_url, subscription_uri, verbosity=0,
+                        workers=1, check_cache=None, crawl_workers=1,
+                        listing_cache=None, checkpoint=None,
+                        strategy='direct', lease_interval=0,
+                        deep_check_method='stream', poll_interval=10,
+                        subscriptions=None):
         self.verbosity = verbosity
         self.tahoe_node_url = tahoe_node_url
         self.subscription_uri = subscription_uri
+        self.workers = workers
+        self.crawl_workers = crawl_workers
+        self.check_cache = check_cache
+        self.listing_cache = listing_cache
+        self.checkpoint = checkpoint
+        self.strategy = strategy
+        self.lease_interval = lease_interval
+        self.leases = []
+        self.deep_check_method = deep_check_method
+        self.poll_interval = poll_interval
+        self.operations = []
+        self.index = CheckIndex()
+        self.subscriptions = subscriptions
         if verbosity > 0:
             print("-- Repairing Tahoe shares. --")
         self.unhealthy = 0
+        self.lock = threading.Lock()
 
     def run_action(self):
-        shares = self.dl_sharelist()
-        sharelist = json.loads(shares).keys()
+        sharelist = self.dl_sharelist()
+        if not sharelist:
+            return
         # shuffle() to even out chances of all shares to get repaired
-        random.shuffle(list(sharelist))
-        for uri in sharelist:
-            sharename  = json.loads(shares)[uri]['name']
-            repair_uri = gen_full_tahoe_uri(self.tahoe_node_url, uri)
-            mode  = json.loads(shares)[uri]['mode']
-            if mode == 'deep-check':
-                self.deep_check(sharename, repair_uri, mode)
+        random.shuffle(sharelist)
+        jobs = []
+        operations = []
+        for entry in sharelist:
+            sharename = entry.name
+            repair_uri = gen_full_tahoe_uri(self.tahoe_node_url, entry.uri)
+            mode = entry.mode
+            if mode == 'deep-check' and self.deep_check_method == 'ophandle':
+                operations.append((sharename, repair_uri, mode))
+            elif mode == 'deep-check':
+                jobs.append((self.deep_check, sharename, repair_uri, mode))
             elif mode == 'one-check':
-                self.one_check(sharename, repair_uri, mode)
-            elif mode.startswith('level-check '):
-                self.level_check(sharename, repair_uri, mode)
+                jobs.append((self.one_check, sharename, repair_uri, mode))
+            elif mode == 'parallel-deep-check':
+                jobs.append((self.parallel_deep_check, sharename, repair_uri,
+                                                                    mode))
+            elif mode and mode.startswith('level-check '):
+                jobs.append((self.level_check, sharename, repair_uri, mode))
             else:
                 print("ERROR: Unknown repair mode: '%s'." % mode, file=sys.stderr)
                 return
+        if self.checkpoint is not None:
+            self.checkpoint.begin(self.subscription_uri)
+        if self.verbosity > 2 and self.workers > 1:
+            print('DEBUG: Repairing up to %d shares at a time.' % self.workers)
+        try:
+            # the gateway works on the operations while the pool runs
+            for operation in operations:
+                self.run_job(self.start_deep_check, *operation)
+            with WorkerPool(self.workers) as pool:
+                for job in jobs:
+                    pool.submit(self.run_job, *job)
+            self.wait_for_operations()
+        except BaseException:
+            if self.checkpoint is not None:
+                self.checkpoint.save(force=True)
+                print('Repair state saved; continue with --resume.',
+                                                    file=sys.stderr)
+            raise
+        self.renew_leases()
+        if self.checkpoint is not None:
+            self.checkpoint.finish()
         if self.verbosity > 0:
             print('Repairs have completed (unhealthy: %d).' % self.unhealthy)
+            if self.index.saved:
+                print('Skipped %d checks of objects that had already been '
+                        'checked in this run.' % self.index.saved)
+        if self.verbosity > 1:
+            print('INFO: Gateway request limit at the end of the run: %d.'
+                                                        % current_limit())
+
+    def run_job(self, method, sharename, repair_uri, mode):
+        """Run the repair of a subscription entry unless a resumed run has
+        already finished it. The repair methods return True if the entry
+        has been checked completely."""
+        if self.checkpoint is None:
+            return method(sharename, repair_uri, mode)
+        if self.checkpoint.is_done(repair_uri):
+            if self.verbosity > 1:
+                print("INFO: Skipping '%s' (already repaired)." % sharename)
+            return
+        # entries that failed are repeated by a resumed run
+        if method(sharename, repair_uri, mode):
+            self.checkpoint.mark_done(repair_uri)
 
     def dl_sharelist(self):
         """
         Attempt to retrieve sharelist from the grid. If the sharelist is determined to
-        be valid, the sharelist is returned.
+        be valid, its entries are returned (see load_subscription).
         """
-        shares = tahoe_dl_file(self.subscription_uri, self.verbosity).read().decode('utf8')
-        if subscription_list_is_valid(shares, self.verbosity):
-            return shares
-        else:
-            return
+        shares = tahoe_dl_file(self.subscription_uri, self.verbosity, 'repair',
+                            self.subscriptions).read().decode('utf8')
+        return load_subscription(shares, self.verbosity)
+
+    def count_unhealthy(self, unhealthy):
+        """Add to the run's number of unhealthy shares (thread-safe)."""
+        with self.lock:
+            self.unhealthy += unhealthy
 
-    def add_subdir_items(self, repair_uris, sharename):
+    def list_subdir_items(self, sharename, shareuri):
         """
-        This function checks if a given item is a directory and adds its contents
-        to the directory.
+        List a directory and return its children as a list of (name, uri,
+        type, verifycap) tuples, taken from the directory's own metadata.
+        Children are addressed by their read-only cap if the listing
+        includes one. Returns None if the directory could not be listed.
         """
-        shareuri = repair_uris[sharename]
-        dir_req = urlopen(shareuri + '?t=json').read().decode('utf8')
-        if not json.loads(dir_req)[0] == 'dirnode':
+        try:
+            dir_req = json.loads(fetch_listing(shareuri,
+                                    self.listing_cache).decode('utf8'))
+        except (HTTPError, URLError) as exc:
+            print("ERROR: %s while listing %s." % (exc, sharename),
+                                                    file=sys.stderr)
+            return None
+        except ValueError as exc:
+            print("ERROR: Can't parse directory listing of %s: %s" %
+                                        (sharename, exc), file=sys.stderr)
+            return None
+        if not dir_req[0] == 'dirnode':
             if self.verbosity > 2:
                 print('DEBUG: Skipping %s' % sharename)
-            return repair_uris
-        for child in json.loads(dir_req)[1]['children']:
+            return []
+        items = []
+        children = dir_req[1]['children']
+        for child in sorted(children):
+            nodetype, info = children[child]
             childname = sharename + '/' + child
             if self.verbosity > 2:
                 print('DEBUG: Adding %s to repair list' % childname)
-            repair_uris[childname] = shareuri + '/' + child
-        return repair_uris
-
-    def one_check(self, sharename, repair_uri, mode):
-        """Performs a shallow repair on 'repair_uri'"""
-        result = repair_share(sharename, repair_uri, mode, self.verbosity)
-        if re.match(r'^HTTP\ Error\ 410:\ Gone$', result.decode('utf8')):
-            status = 'not retrievable'
-            self.unhealthy += 1
-        elif json_list_is_valid(result.decode('utf8'), self.verbosity):
-            status, self.unhealthy = parse_result(result.decode('utf8'), mode,
-                                                self.unhealthy, self.verbosity)
-        else:
-            status = 'unknown: Errors occured. Check this file manually to investigate.'
+            cap = info.get('ro_uri') or info.get('rw_uri')
+            if cap:
+                childuri = gen_full_tahoe_uri(self.tahoe_node_url, cap)
+            else:
+                childuri = shareuri + '/' + quote(child.encode('utf8'))
+            items.append((childname, childuri, nodetype,
+                          info.get('verify_uri')))
+        return items
+
+    def one_check(self, sharename, repair_uri, mode, verifycap=None):
+        """Performs a shallow repair on 'repair_uri'; returns False if the
+        check failed."""
+        cache_key = verifycap or repair_uri.split('/uri/', 1)[-1]
+        if self.is_fresh(sharename, cache_key):
+            return True
+        entry, first = self.index.claim((verifycap,
+                                        repair_uri.split('/uri/', 1)[-1]))
+        if not first:
+            self.report_duplicate(sharename, entry)
+            return True
+        status, record, gone = None, None, False
+        try:
+            status, record, gone = self.check_object(sharename, repair_uri,
+                                                            cache_key)
+        finally:
+            self.index.finish(entry, record)
+        if (self.strategy == 'two-phase' and record is not None and
+                not is_literal_file(record)):
+            self.schedule_lease(sharename, repair_uri, mode, cache_key)
+        if gone:
+            self.count_unhealthy(1)
+        elif record is not None:
+            status, unhealthy = parse_result(record, mode, 0, self.verbosity)
+            self.count_unhealthy(unhealthy)
+            if self.check_cache is not None and not is_literal_file(record):
+                self.check_cache.store(cache_key, record)
         if self.verbosity > 1:
             print("  Status: %s" % status)
+        return gone or record is not None
+
+    def report_duplicate(self, sharename, record):
+        """Report an object whose result is taken from an earlier check in
+        this run. Unhealthy objects have been counted already."""
+        if self.verbosity > 1:
+            print("Skipping '%s' (checked before in this run: %s)." %
+                                                (sharename, record.summary))
+
+    def is_fresh(self, sharename, cache_key):
+        """Check whether the check cache allows skipping 'cache_key'."""
+        if self.check_cache is None:
+            return False
+        cached = self.check_cache.lookup(cache_key)
+        if cached is None:
+            return False
+        if self.verbosity > 1:
+            print("Skipping '%s' (%s %d minutes ago)." %
+                    (sharename, cached[1], cached[0] // 60))
+        return True
+
+    def check_object(self, sharename, repair_uri, cache_key):
+        """One-check (and repair) a single object according to the repair
+        strategy; returns the same as run_check()."""
+        mode = 'one-check'
+        if self.strategy == 'two-phase':
+            status, record, gone = self.run_check(sharename, repair_uri, mode,
+                                                            False, False)
+            if (record is not None and not record.healthy and
+                    not is_literal_file(record)):
+                status, record, gone = self.run_check(sharename, repair_uri,
+                                                        mode, True, False)
+        else:
+            status, record, gone = self.run_check(sharename, repair_uri, mode,
+                                                            True, True)
+            if (self.check_cache is not None and record is not None and
+                    not is_literal_file(record)):
+                self.check_cache.lease_renewed(cache_key)
+        return status, record, gone
+
+    def run_check(self, sharename, repair_uri, mode, repair, add_lease):
+        """Send a single check; returns (status, CheckResult or None, True if
+        the object is gone)."""
+        result = repair_share(sharename, repair_uri, mode, self.verbosity,
+                                                        repair, add_lease)
+        status = 'unknown: Errors occured. Check this file manually to investigate.'
+        if isinstance(result, HTTPError):
+            if re.match(r'^HTTP\ Error\ 410:\ Gone$', str(result)):
+                return 'not retrievable', None, True
+        elif result is not None:
+            record = load_result(result.decode('utf8'), self.verbosity)
+            if record is not None:
+                return record.summary, record, False
+        return status, None, False
 
     def deep_check(self, sharename, repair_uri, mode):
-        """Performs a deep recursive check on 'repair_uri'"""
-        results = repair_share(sharename, repair_uri, mode, self.verbosity)
+        """Performs a deep recursive check on 'repair_uri'; returns False if
+        the check failed or was interrupted."""
+        two_phase = self.strategy == 'two-phase'
+        results = repair_share(sharename, repair_uri, mode, self.verbosity,
+                                        not two_phase, not two_phase)
         if results is None:
             print('WARN: Received no results.')
+            return False
+        if isinstance(results, HTTPError):
+            return False
+        unhealthy = 0
+        broken = []
+        complete = True
+        try:
+            for result in iter_results(results, self.verbosity):
+                if (two_phase and not result.healthy and result.repaircap
+                        and not is_literal_file(result)):
+                    # repaired (and counted) below
+                    if self.verbosity > 1:
+                        print('  %s: %s' % ('/'.join(result.path),
+                                                    result.summary))
+                    broken.append(result)
+                    continue
+                self.index.add(result)
+                status, unhealthy = parse_result(result, mode, unhealthy,
+                                                        self.verbosity)
+        except (IOError, HTTPException) as exc:
+            print('ERROR: deep-check of %s was interrupted: %r' %
+                                    (sharename, exc), file=sys.stderr)
+            complete = False
+        finally:
+            results.close()
+        self.count_unhealthy(unhealthy)
+        if not two_phase:
+            if self.check_cache is not None and complete:
+                self.check_cache.lease_renewed(
+                                        repair_uri.split('/uri/', 1)[-1])
+            return complete
+        if broken and self.verbosity > 0:
+            print('Repairing %d unhealthy objects of %s.' %
+                                            (len(broken), sharename))
+        with WorkerPool(self.workers) as repairs:
+            for result in broken:
+                name = '/'.join((sharename,) + result.path)
+                repairs.submit(self.repair_object, name,
+                    gen_full_tahoe_uri(self.tahoe_node_url, result.repaircap),
+                    (result.storage_index, result.verifycap))
+        self.schedule_lease(sharename, repair_uri, mode,
+                            repair_uri.split('/uri/', 1)[-1])
+        return complete and all(job.value for job in repairs.jobs)
+
+    def start_deep_check(self, sharename, repair_uri, mode):
+        """Start a deep-check as an asynchronous gateway operation; returns
+        False so the entry isn't considered done before it has finished."""
+        two_phase = self.strategy == 'two-phase'
+        ophandle = new_ophandle()
+        result = repair_share(sharename, repair_uri, mode, self.verbosity,
+                                not two_phase, not two_phase, ophandle)
+        if result is not None and not isinstance(result, HTTPError):
+            self.operations.append((sharename, repair_uri, mode, ophandle))
+            if self.verbosity > 2:
+                print('DEBUG: Started operation %s.' % ophandle)
+        return False
+
+    def wait_for_operations(self):
+        """Poll the started deep-check operations until all of them have
+        finished and evaluate their results."""
+        if self.operations and self.verbosity > 0:
+            print('Waiting for %d deep-checks to finish.' %
+                                                len(self.operations))
+        while self.operations:
+            pending = []
+            for operation in self.operations:
+                status = poll_operation(self.tahoe_node_url, operation[3],
+                                                        self.verbosity)
+                if isinstance(status, HTTPError):
+                    print('ERROR: Lost deep-check of %s: %s' %
+                                    (operation[0], status), file=sys.stderr)
+                elif status is not None and status.get('finished'):
+                    self.finish_deep_check(operation, status)
+                else:
+                    pending.append(operation)
+            self.operations = pending
+            if pending:
+                if self.verbosity > 2:
+                    print('DEBUG: %d deep-checks still running.' %
+                                                            len(pending))
+                time.sleep(self.poll_interval)
+
+    def finish_deep_check(self, operation, status):
+        """Evaluate the final status of a deep-check operation."""
+        sharename, repair_uri, mode, ophandle = operation
+        two_phase = self.strategy == 'two-phase'
+        if self.verbosity > 0:
+            print("Deep-check of '%s' has finished (%d objects checked)." %
+                        (sharename, status.get('count-objects-checked', 0)))
+        unhealthy = 0
+        broken = []
+        for result in iter_operation_results(status):
+            if two_phase and not is_literal_file(result):
+                broken.append(result)
+                if self.verbosity > 1:
+                    print('  %s: %s' % ('/'.join(result.path),
+                                                    result.summary))
+                continue
+            self.index.add(result)
+            status_line, unhealthy = parse_result(result, mode, unhealthy,
+                                                        self.verbosity)
+        self.count_unhealthy(unhealthy)
+        repaired = True
+        if two_phase:
+            with WorkerPool(self.workers) as repairs:
+                for result in broken:
+                    path = '/'.join(quote(part.encode('utf8'))
+                                                for part in result.path)
+                    repairs.submit(self.repair_object,
+                                   '/'.join((sharename,) + result.path),
+                                   repair_uri + '/' + path,
+                                   (result.storage_index,))
+            repaired = all(job.value for job in repairs.jobs)
+            self.schedule_lease(sharename, repair_uri, mode,
+                                repair_uri.split('/uri/', 1)[-1])
+        elif self.check_cache is not None:
+            self.check_cache.lease_renewed(repair_uri.split('/uri/', 1)[-1])
+        if self.checkpoint is not None and repaired:
+            self.checkpoint.mark_done(repair_uri)
+
+    def parallel_deep_check(self, sharename, repair_uri, mode):
+        """Performs a deep check on 'repair_uri' by fetching its manifest once
+        and checking the objects in it concurrently; returns False if any
+        of them failed."""
+        items = self.read_manifest(sharename, repair_uri)
+        if items is None:
+            return False
+        if self.verbosity > 1:
+            print('INFO: Checking %d objects of %s.' % (len(items), sharename))
+        with WorkerPool(self.workers) as checks:
+            for item in items:
+                checks.submit(self.check_manifest_item, sharename, *item)
+        if self.strategy == 'two-phase':
+            self.schedule_lease(sharename, repair_uri, 'deep-check',
+                                repair_uri.split('/uri/', 1)[-1])
+        return all(job.value for job in checks.jobs)
+
+    def read_manifest(self, sharename, repair_uri):
+        """Stream the manifest of 'repair_uri'; returns a list of (path,
+        type, cap, verifycap, storage index) tuples with one entry per
+        storage index, or None on errors."""
+        if self.verbosity > 0:
+            print("Reading manifest of '%s' share." % sharename)
+        params = urlencode([('t', 'stream-manifest')]).encode('utf8')
+        try:
+            manifest = stream(repair_uri, params)
+        except (HTTPError, URLError) as exc:
+            print('ERROR: Could not read manifest of %s: %s' %
+                                    (sharename, exc), file=sys.stderr)
+            return None
+        items = []
+        seen = set()
+        try:
+            for line in manifest:
+                line = line.decode('utf8').strip()
+                if not line:
+                    continue
+                data = load_json(line, self.verbosity)
+                if data is None or 'cap' not in data:
+                    continue # e.g. the final 'stats' line
+                path = tuple(data.get('path', ()))
+                storage_index = data.get('storage-index')
+                if not storage_index:
+                    # literal files have no storage index and no shares
+                    print('  %s: (literal file)' % '/'.join(path))
+                    continue
+                if storage_index in seen:
+                    if self.verbosity > 2:
+                        print('DEBUG: Skipping %s (seen before)' %
+                                                        '/'.join(path))
+                    continue
+                seen.add(storage_index)
+                items.append((path, data.get('type'),
+                              data.get('repaircap') or data['cap'],
+                              data.get('verifycap'), storage_index))
+        except (IOError, HTTPException) as exc:
+            print('ERROR: manifest of %s was interrupted: %r' %
+                                    (sharename, exc), file=sys.stderr)
+            return None
+        finally:
+            manifest.close()
+        return items
+
+    def check_manifest_item(self, sharename, path, nodetype, cap, verifycap,
+                                                            storage_index):
+        """Check an object of a parallel deep-check; reports like a streamed
+        deep-check. Returns False if the check failed."""
+        name = '/'.join((sharename,) + path)
+        cache_key = verifycap or cap
+        if self.is_fresh(name, cache_key):
+            return True
+        entry, first = self.index.claim((storage_index, verifycap, cap))
+        if not first:
+            self.report_duplicate(name, entry)
+            return True
+        status, record, gone = None, None, False
+        try:
+            status, record, gone = self.check_object(name,
+                        gen_full_tahoe_uri(self.tahoe_node_url, cap), cache_key)
+        finally:
+            self.index.finish(entry, record)
+        if gone:
+            self.count_unhealthy(1)
+        if record is None:
+            if self.verbosity > 1:
+                print('  %s: %s' % ('/'.join(path), status))
+            return gone
+        record.path = path
+        record.type = nodetype
+        status, unhealthy = parse_result(record, 'deep-check', 0,
+                                                        self.verbosity)
+        self.count_unhealthy(unhealthy)
+        if self.check_cache is not None:
+            self.check_cache.store(cache_key, record)
+        return True
+
+    def repair_object(self, name, repair_uri, keys=()):
+        """Repair a single object found unhealthy by a deep-check; returns
+        False if the repair failed."""
+        entry, first = self.index.claim(keys)
+        if not first:
+            self.report_duplicate(name, entry)
+            return True
+        status, record, gone = None, None, False
+        try:
+            status, record, gone = self.run_check(name, repair_uri,
+                                                'one-check', True, False)
+        finally:
+            self.index.finish(entry, record)
+        if gone:
+            self.count_unhealthy(1)
+        elif record is not None:
+            status, unhealthy = parse_result(record, 'one-check', 0,
+                                                        self.verbosity)
+            self.count_unhealthy(unhealthy)
+        if self.verbosity > 1:
+            print("  Status: %s" % status)
+        return gone or record is not None
+
+    def schedule_lease(self, sharename, repair_uri, mode, key):
+        """Queue an add-lease operation if the lease of 'key' is due."""
+        if (self.check_cache is not None and
+                not self.check_cache.lease_due(key, self.lease_interval)):
+            return
+        with self.lock:
+            self.leases.append((sharename, repair_uri, mode, key))
+
+    def renew_leases(self):
+        """Run the add-lease operations queued by a two-phase run."""
+        if not self.leases:
             return
-        for result in results:
-            if json_list_is_valid(result.decode('utf8'), self.verbosity):
-                status, self.unhealthy = parse_result(result.decode('utf8'),
-                                        mode, self.unhealthy, self.verbosity)
+        if self.verbosity > 0:
+            print('-- Renewing leases of %d shares. --' % len(self.leases))
+        with WorkerPool(self.workers) as pool:
+            for lease in self.leases:
+                pool.submit(self.renew_lease, *lease)
+        self.leases = []
+
+    def renew_lease(self, sharename, repair_uri, mode, key):
+        result = repair_share(sharename, repair_uri, mode, self.verbosity,
+                                                            False, True)
+        if result is None or isinstance(result, HTTPError):
+            return
+        if mode == 'deep-check':
+            # the leases are renewed as the gateway walks the tree
+            try:
+                for line in result:
+                    pass
+            except (IOError, HTTPException) as exc:
+                print('ERROR: add-lease of %s was interrupted: %r' %
+                                        (sharename, exc), file=sys.stderr)
+                return
+            finally:
+                result.close()
+        if self.check_cache is not None:
+            self.check_cache.lease_renewed(key)
 
     def level_check(self, sharename, repair_uri, mode):
-        """Performs a custom repair of 'repair_uri' %d levels deep."""
+        """Performs a custom repair of 'repair_uri' %d levels deep.
+
+        The tree is crawled breadth-first. The directories of each level are
+        listed concurrently (up to 'crawl_workers' at a time) while the items
+        found so far are already being checked. Returns False if a check or
+        listing failed."""
         levels = int(re.sub(r'level-check\ (\d+)', r'\1', mode))
         if self.verbosity > 1:
             print('INFO: Will check %d levels deep.' % levels)
         mode = 'one-check' # all item will be one-checked
-        repair_uris = {}
-        repair_uris[sharename] = repair_uri # add root dir
-        added = []
-        while levels > 0: # keep adding items of subdirectories
-            for item in list(repair_uris.keys()):
-                if not item in added:
-                    repair_uris = self.add_subdir_items(repair_uris, item)
-                added.append(item)
-            levels = levels - 1
-        for item in sorted(list(repair_uris.keys())):
-            if self.verbosity > 2:
-                print('Will repair %s.' % sorted(list(repair_uris.keys())))
-            self.one_check(item, repair_uris[item], mode)
+        visited = set([repair_uri])
+        # (name, uri, type, verifycap); the root's type is not known yet
+        frontier = [(sharename, repair_uri, None, None)] # add root dir
+        checked = set()
+        listed = True
+        # items of earlier levels that were queued but not checked when the
+        # run was interrupted
+        pending = []
+        if self.checkpoint is not None:
+            tree = self.checkpoint.tree(repair_uri)
+            if tree is not None and (tree.get('frontier') or
+                                     tree.get('pending')):
+                levels = tree['levels']
+                frontier = [tuple(item) for item in tree['frontier']]
+                queued = set(item[3] or item[1] for item in frontier)
+                pending = [tuple(item) for key, item in
+                           sorted(tree.get('pending', {}).items())
+                           if key not in queued]
+                checked = tree['checked']
+                if self.verbosity > 1:
+                    print('INFO: Resuming level-check with %d items.' %
+                                            (len(frontier) + len(pending)))
+        with WorkerPool(self.workers) as checks:
+            for item in pending:
+                self.submit_level_item(checks, repair_uri, item, mode,
+                                                                checked)
+            while frontier:
+                if self.checkpoint is not None:
+                    self.checkpoint.save_tree(repair_uri, levels, frontier)
+                for item in frontier:
+                    self.submit_level_item(checks, repair_uri, item, mode,
+                                                                checked)
+                if levels == 0:
+                    break
+                levels = levels - 1
+                # keep adding items of subdirectories; the parent listings
+                # already tell which children are directories
+                subdirs = [item for item in frontier
+                                if item[2] in (None, 'dirnode')]
+                listings = run_ordered(self.list_level_item, subdirs,
+                                                    self.crawl_workers)
+                frontier = []
+                for items in listings:
+                    if items is None:
+                        listed = False
+                        continue
+                    for item in items:
+                        key = item[3] or item[1]
+                        if key not in visited:
+                            visited.add(key)
+                            frontier.append(item)
+        return listed and all(job.value for job in checks.jobs)
+
+    def submit_level_item(self, pool, tree, item, mode, checked):
+        """Queue the check of a level_check() item unless a resumed run has
+        already checked it. Queued items are kept in the checkpoint until
+        they have been checked."""
+        if (item[3] or item[1]) in checked:
+            return
+        if self.checkpoint is not None:
+            self.checkpoint.item_pending(tree, item)
+        pool.submit(self.check_level_item, tree, item, mode)
+
+    def check_level_item(self, tree, item, mode):
+        """One-check an item found by level_check() and record it in the
+        checkpoint of 'tree' if the check succeeded."""
+        name, uri, nodetype, verifycap = item
+        if not self.one_check(name, uri, mode, verifycap):
+            return False
+        if self.checkpoint is not None:
+            self.checkpoint.item_done(tree, verifycap or uri)
+        return True
+
+    def list_level_item(self, item):
+        """Helper for run_ordered(): list a frontier item."""
+        return self.list_subdir_items(item[0], item[1])
@@ -0,0 +1,139 @@
+"""This module retries requests that failed for passing reasons, such as I2P
+tunnel rebuilds or a busy gateway."""
+
+from __future__ import print_function
+import random
+import socket
+import sys
+import threading
+import time
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from httplib import HTTPException
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+else:
+    from http.client import HTTPException
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+
+# HTTP status codes of a gateway that may answer properly next time
+RETRYABLE_CODES = (500, 502, 503, 504)
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BUDGET = 20
+# Seconds before the first retry; doubled for every further one
+BASE_DELAY = 2.0
+MAX_DELAY = 60.0
+
+
+def is_retryable(exc):
+    """Check whether a request that failed with 'exc' may succeed if it is
+    sent again. Answers like '404 Not Found' or '410 Gone' won't change."""
+    if isinstance(exc, HTTPError):
+        return exc.code in RETRYABLE_CODES
+    return isinstance(exc, (URLError, HTTPException, socket.error, IOError))
+
+
+class RetryPolicy(object):
+    """
+    Retries of the requests of one action (e.g. 'repair').
+
+    Each request is tried up to 'attempts' times, as long as its errors are
+    retryable. All requests of the action share a 'budget' of retries, so a
+    grid that is down for good doesn't multiply the duration of a run. The
+    pauses between attempts grow exponentially from 'base' up to 'cap'
+    seconds and are jittered, so concurrent workers don't retry in
+    lockstep.
+    """
+
+    def __init__(self, action, attempts=DEFAULT_ATTEMPTS, budget=DEFAULT_BUDGET,
+                            base=BASE_DELAY, cap=MAX_DELAY, verbosity=0):
+        self.verbosity = verbosity
+        self.action = action
+        self.attempts = max(1, attempts)
+        self.budget = budget
+        self.base = base
+        self.cap = cap
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.recovered = 0
+        self.failed = 0
+
+    def call(self, func, *args):
+        """Call func(*args) and retry it on retryable errors; the last error
+        is passed on."""
+        with self.lock:
+            self.requests += 1
+        attempt = 1
+        while True:
+            try:
+                result = func(*args)
+            except Exception as exc:
+                if (not is_retryable(exc) or attempt >= self.attempts or
+                        not self.spend()):
+                    with self.lock:
+                        self.failed += 1
+                    raise
+                delay = self.delay(attempt)
+                if self.verbosity > 1:
+                    print('INFO: %s; retrying in %.1f seconds.' %
+                                                        (exc, delay))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                if attempt > 1:
+                    with self.lock:
+                        self.recovered += 1
+                return result
+
+    def spend(self):
+        """Take a retry from the budget; returns False if it is used up."""
+        with self.lock:
+            if self.retries >= self.budget:
+                if self.retries == self.budget and self.verbosity > 0:
+                    print("WARN: No retries left for '%s'." % self.action,
+                                                            file=sys.stderr)
+                return False
+            self.retries += 1
+            return True
+
+    def delay(self, attempt):
+        """Return a random pause before the given attempt ("full jitter")."""
+        return random.uniform(0, min(self.cap,
+                                     self.base * 2 ** (attempt - 1)))
+
+    def stats(self):
+        return ('%d requests, %d retries, %d recovered, %d failed' %
+                (self.requests, self.retries, self.recovered, self.failed))
+
+
+_policies = {}
+_settings = {'attempts': DEFAULT_ATTEMPTS, 'budget': DEFAULT_BUDGET,
+             'base': BASE_DELAY, 'verbosity': 0}
+_lock = threading.Lock()
+
+def configure(attempts=DEFAULT_ATTEMPTS, budget=DEFAULT_BUDGET, verbosity=0,
+                                                            base=BASE_DELAY):
+    """Set up the retry policies of all actions; forgets earlier stats."""
+    with _lock:
+        _settings.update(attempts=attempts, budget=budget, base=base,
+                                                    verbosity=verbosity)
+        _policies.clear()
+
+def policy(action):
+    """Return the RetryPolicy of 'action'."""
+    with _lock:
+        if action not in _policies:
+            _policies[action] = RetryPolicy(action, _settings['attempts'],
+                                    _settings['budget'], _settings['base'],
+                                    verbosity=_settings['verbosity'])
+        return _policies[action]
+
+def print_stats(verbosity=0):
+    """Print the request statistics of each action; with little verbosity
+    only for actions that had to retry."""
+    for action in sorted(_policies):
+        stats = _policies[action]
+        if (stats.retries and verbosity > 0) or verbosity > 1:
+            print('Requests (%s): %s.' % (action, stats.stats()))
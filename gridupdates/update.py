@@ -5,22 +5,28 @@ import re
 import sys
 # Maybe this is better than try -> except?
 if sys.version_info[0] == 2:
+    from httplib import HTTPException
     from urllib2 import HTTPError
-    from urllib2 import urlopen
     from urllib2 import URLError
 else:
-    from urllib.request import urlopen
+    from http.client import HTTPException
     from urllib.error import HTTPError
     from urllib.error import URLError
 
+from gridupdates.cache import fetch_listing
+from gridupdates.download import download_file
+from gridupdates.workers import WorkerPool
+
 class Update(object):
     """This class implements the update functions of grid-updates."""
 
-    def __init__(self, current_version, output_dir, url, verbosity=0):
+    def __init__(self, current_version, output_dir, url, verbosity=0,
+                                                    listing_cache=None):
         self.verbosity = verbosity
         self.version = current_version
         self.output_dir = output_dir
         self.url = url
+        self.listing_cache = listing_cache
         if self.verbosity > 0:
             print("-- Looking for script updates --")
         if self.url is not None:
@@ -38,8 +44,11 @@ class Update(object):
                 self.print_versions()
             elif mode == 'download':
                 download_filename = self.gen_download_filename(requested_dist)
-                self.download(download_filename, 'update')
-                self.download(download_filename + '.sig', 'signature')
+                # the update and its signature are fetched at the same time
+                with WorkerPool(2) as pool:
+                    pool.submit(self.download, download_filename, 'update')
+                    pool.submit(self.download, download_filename + '.sig',
+                                                                'signature')
             return True
         else:
             if self.verbosity > 0:
@@ -74,7 +83,8 @@ class Update(object):
         if self.url is None:  # will only happen when testing
             return
         try:
-            json_dir = urlopen(self.dir_url).read().decode('utf8')
+            json_dir = fetch_listing(self.url,
+                                     self.listing_cache).decode('utf8')
         except HTTPError as exc:
             print('ERROR: Could not access the Tahoe directory:', exc,
                     file=sys.stderr)
@@ -123,28 +133,27 @@ class Update(object):
                                                              self.version)
 
     def download(self, download_filename, filetype):
-        """Download script tarball and/or signature."""
+        """Download script tarball and/or signature. An interrupted download
+        is resumed by the next attempt."""
         download_url = (self.url + '/' + download_filename)
         if self.verbosity > 1:
             print("INFO: Downloading", download_url)
+        local_file = os.path.join(self.output_dir, download_filename)
+        if not os.access(self.output_dir, os.W_OK):
+            print('ERROR: Could not write to local file: %s is not writable.'
+                                    % self.output_dir, file=sys.stderr)
+            sys.exit(1)
         try:
-            remote_file = urlopen(download_url)
+            download_file(download_url, local_file, self.verbosity, 'update',
+                                                                    True)
         except HTTPError as exc:
             print('ERROR: Could not download', download_filename, ': ', exc,
                     file=sys.stderr)
             sys.exit(1)
-        except URLError as urlexc:
+        except (URLError, HTTPException, IOError) as urlexc:
             print("ERROR: %s trying to download %s from  %s." %
                             (download_filename, urlexc, download_url), file=sys.stderr)
             sys.exit(1)
-        local_file = os.path.join(self.output_dir, download_filename)
-        try:
-            with open(local_file,'wb') as output:
-                output.write(remote_file.read())
-        except IOError as exc:
-            print('ERROR: Could not write to local file:', exc,
-                    file=sys.stderr)
-            sys.exit(1)
         else:
             if self.verbosity > 0:
                 print('Success: Saved %s file to %s.' %
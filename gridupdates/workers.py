@@ -0,0 +1,296 @@
+"""This module runs jobs concurrently while keeping their output in order."""
+
+from __future__ import print_function
+import sys
+import threading
+# Maybe this is better than try -> except?
+if sys.version_info[0] == 2:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+# Output of jobs is routed through per-job slots. The slot at the head of an
+# OrderedOutput writes straight through (i.e. live); all others are buffered
+# until every job submitted before them has finished.
+_local = threading.local()
+_lock = threading.RLock()
+_proxies = {'count': 0, 'stdout': None, 'stderr': None}
+# Set by stop_jobs(); KeyboardInterrupt reaches only the main thread.
+_stopping = threading.Event()
+
+
+def stop_jobs():
+    """Ask the jobs running in worker threads to stop, as if they had been
+    interrupted with Ctrl-C: check_stopped() raises KeyboardInterrupt in
+    them from now on."""
+    _stopping.set()
+
+
+def resume_jobs():
+    """Allow jobs to run again after stop_jobs()."""
+    _stopping.clear()
+
+
+def check_stopped():
+    """Raise KeyboardInterrupt if stop_jobs() has been called."""
+    if _stopping.is_set():
+        raise KeyboardInterrupt
+
+
+def wait_until(done, wait, stoppable=False):
+    """Call wait(timeout) (e.g. Event.wait, Condition.wait or Thread.join)
+    until done() is true. Waiting without a timeout cannot be interrupted on
+    Python 2, so this waits half a second at a time. If 'stoppable', raise
+    KeyboardInterrupt after stop_jobs() instead of waiting on."""
+    while not done():
+        wait(0.5)
+        if stoppable:
+            check_stopped()
+
+
+def _write(stream, text):
+    """Final sink: write to a real stream."""
+    stream.write(text)
+
+
+class _StreamProxy(object):
+    """Stand-in for sys.stdout/sys.stderr while worker pools are active."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        slot = getattr(_local, 'slot', None)
+        if slot is None:
+            with _lock:
+                self.stream.write(text)
+        else:
+            slot.write(self.stream, text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _install_proxies():
+    with _lock:
+        if _proxies['count'] == 0:
+            _proxies['stdout'] = sys.stdout
+            _proxies['stderr'] = sys.stderr
+            sys.stdout = _StreamProxy(sys.stdout)
+            sys.stderr = _StreamProxy(sys.stderr)
+        _proxies['count'] += 1
+
+
+def _remove_proxies():
+    with _lock:
+        _proxies['count'] -= 1
+        if _proxies['count'] == 0:
+            sys.stdout = _proxies['stdout']
+            sys.stderr = _proxies['stderr']
+
+
+class _Slot(object):
+    """The output buffer of a single job."""
+
+    __slots__ = ('output', 'index', 'buffer', 'done')
+
+    def __init__(self, output, index):
+        self.output = output
+        self.index = index
+        self.buffer = []
+        self.done = False
+
+    def write(self, stream, text):
+        self.output.emit(self, stream, text)
+
+
+class OrderedOutput(object):
+    """Hands out output slots and releases their contents in the order the
+    slots were created. Groups created inside a job write into that job's
+    slot, so nested pools stay ordered as well."""
+
+    def __init__(self):
+        parent = getattr(_local, 'slot', None)
+        if parent is not None:
+            self.sink = parent.write
+        else:
+            self.sink = _write
+        self.slots = []
+        self.head = 0
+
+    def slot(self):
+        """Reserve the next output slot."""
+        with _lock:
+            slot = _Slot(self, len(self.slots))
+            self.slots.append(slot)
+            return slot
+
+    def emit(self, slot, stream, text):
+        with _lock:
+            if slot.index == self.head:
+                self.sink(stream, text)
+            else:
+                slot.buffer.append((stream, text))
+
+    def finish(self, slot):
+        """Mark a slot as complete and flush the slots queued behind it."""
+        with _lock:
+            slot.done = True
+            while (self.head < len(self.slots) and
+                    self.slots[self.head].done):
+                self.head += 1
+                if self.head < len(self.slots):
+                    pending = self.slots[self.head]
+                    for stream, text in pending.buffer:
+                        self.sink(stream, text)
+                    pending.buffer = []
+
+
+class Job(object):
+    """A function call submitted to a WorkerPool."""
+
+    def __init__(self, func, args, slot, pool=None):
+        self.func = func
+        self.args = args
+        self.slot = slot
+        self.pool = pool
+        self.value = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self):
+        previous = getattr(_local, 'slot', None)
+        _local.slot = self.slot
+        try:
+            check_stopped()
+            self.value = self.func(*self.args)
+        except BaseException:
+            self.error = sys.exc_info()[1]
+            if self.pool is not None:
+                self.pool.failed(self)
+        finally:
+            _local.slot = previous
+            self.slot.output.finish(self.slot)
+            self.finished.set()
+
+    def skip(self):
+        """Finish the job without running it."""
+        self.slot.output.finish(self.slot)
+        self.finished.set()
+
+    def result(self):
+        """Wait for the job to finish; return its value or re-raise its
+        exception."""
+        wait_until(self.finished.is_set, self.finished.wait)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class WorkerPool(object):
+    """
+    A bounded pool of worker threads.
+
+    Jobs are started in the order they were submitted and up to 'workers'
+    of them run at the same time. Whatever a job prints is released in
+    submission order. With a single worker, jobs run inline in the calling
+    thread, and KeyboardInterrupt and SystemExit are raised right away.
+    Once a job has failed, the pool doesn't accept new jobs, and the jobs
+    that are still queued are skipped (their value is None).
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers))
+        self.jobs = []
+        self.error = None
+        self.closed = False
+        self.threads = []
+        self.queue = Queue()
+        self.output = OrderedOutput()
+        if self.workers > 1:
+            _install_proxies()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.join()
+        else:
+            self.close()
+
+    def submit(self, func, *args):
+        """Schedule func(*args); returns a Job. Raises the first failure of
+        an earlier job instead, if there was one."""
+        if self.error is not None:
+            raise self.error
+        job = Job(func, args, self.output.slot(), self)
+        self.jobs.append(job)
+        if self.workers == 1:
+            job.run()
+            if isinstance(job.error, (KeyboardInterrupt, SystemExit)):
+                raise job.error
+        else:
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.queue.put(job)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is not None or self.closed:
+                job.skip()
+            else:
+                job.run()
+
+    def failed(self, job):
+        """Remember the first job that failed."""
+        with _lock:
+            if self.error is None:
+                self.error = job.error
+
+    def close(self):
+        """Stop the worker threads: jobs that haven't started yet are
+        skipped, and those that are running are waited for, so their output
+        still goes to the right place."""
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+        try:
+            for thread in self.threads:
+                wait_until(lambda: not thread.is_alive(), thread.join)
+        finally:
+            self.threads = []
+            if self.workers > 1:
+                self.workers = 1
+                _remove_proxies()
+
+    def wait(self):
+        """Wait for all jobs to finish, whether they fail or not."""
+        for job in self.jobs:
+            wait_until(job.finished.is_set, job.finished.wait)
+
+    def join(self):
+        """Wait for all jobs; re-raises the first failure in submission
+        order."""
+        try:
+            for job in self.jobs:
+                job.result()
+        finally:
+            self.close()
+        return [job.value for job in self.jobs]
+
+
+def run_ordered(func, items, workers=1):
+    """Call func(item) for each item concurrently; returns the results in
+    the order of 'items'."""
+    with WorkerPool(workers) as pool:
+        for item in items:
+            pool.submit(func, item)
+    return [job.value for job in pool.jobs]
@@ -2,21 +2,40 @@
 
 import unittest
 from gridupdates import functions, config, update, version, news, introducers, repairs
+from gridupdates import workers, cache, checkpoint, lock, gateway, retry
+from gridupdates import client, nodeinfo, download, grid_updates, fleet
 #from gridupdates.news import News
 from gridupdates.functions import gen_full_tahoe_uri
+import hashlib
 import os
 import re
 import sys
 import tempfile
+import threading
+import time
 import platform
+import json
+import socket
+import subprocess
+import tarfile
+from argparse import Namespace
+from io import BytesIO
 if sys.version_info[0] == 2:
     import ConfigParser as ConfigParser
     from ConfigParser import SafeConfigParser
     from StringIO import StringIO
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from thread import interrupt_main
+    from urlparse import urlparse, parse_qs
 else:
     import configparser as ConfigParser
     from configparser import ConfigParser as SafeConfigParser
     from io import StringIO
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from _thread import interrupt_main
+    from urllib.parse import urlparse, parse_qs
 
 operating_system = platform.system()
 if operating_system == 'Windows':
@@ -27,6 +46,99 @@ else:
 
 
 
+class FakeGateway(ThreadingMixIn, HTTPServer):
+    """A minimal stand-in for a Tahoe gateway. 'routes' maps request paths
+    to functions(method, query, body) returning (status, body) or (status,
+    body, headers). The request headers are collected in 'headers', with
+    lower-case names."""
+    daemon_threads = True
+
+    def __init__(self, routes):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGatewayHandler)
+        self.routes = routes
+        self.requests = []
+        self.headers = []
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf8')
+        query = parse_qs(url.query)
+        query.update(parse_qs(body))
+        query = dict((k, v[0]) for k, v in query.items())
+        self.server.requests.append((method, url.path, query))
+        self.server.headers.append(dict((name.lower(), value)
+                                    for name, value in self.headers.items()))
+        headers = {}
+        if url.path in self.server.routes:
+            response = self.server.routes[url.path](method, query, body)
+            if len(response) == 3:
+                status, content, headers = response
+            else:
+                status, content = response
+        else:
+            status, content = 404, 'Not Found'
+        if not isinstance(content, bytes):
+            content = content.encode('utf8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+def check_response(healthy, storage_index='aaaa'):
+    """A Tahoe t=check&repair=true JSON response."""
+    if healthy:
+        summary = 'Healthy'
+    else:
+        summary = 'Unhealthy: 3 shares (enc 3-of-10)'
+    results = {'summary': summary,
+               'results': {'healthy': healthy,
+                           'count-shares-good': healthy and 10 or 3,
+                           'count-shares-needed': 3,
+                           'count-shares-expected': 10}}
+    return json.dumps({'storage-index': storage_index,
+                       'repair-attempted': not healthy,
+                       'pre-repair-results': results,
+                       'post-repair-results': results})
+
+def tahoe_node(children=None, healthy=True):
+    """A gateway route serving a file (children is None) or a directory
+    listing on GET and a check result on POST."""
+    def route(method, query, body):
+        if method == 'POST':
+            return 200, check_response(healthy)
+        if children is None:
+            return 200, json.dumps(['filenode', {'mutable': False}])
+        listing = {}
+        for name, node in children.items():
+            listing[name] = [node, {'mutable': False}]
+        return 200, json.dumps(['dirnode', {'children': listing}])
+    return route
+
 class TestWithoutNetwork(unittest.TestCase):
     def setUp(self):
         self.tahoe_node_uri = 'http://127.0.0.1:3456'
@@ -73,6 +185,31 @@ class TestWithoutNetwork(unittest.TestCase):
         self.assertFalse(functions.subscription_list_is_valid(badsubfile))
         self.assertTrue(functions.subscription_list_is_valid(goodsubfile))
 
+    def test_load_subscription(self):
+        """load_subscription should return immutable entries of valid lists
+        and None for invalid ones"""
+        oldstdout, oldstderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.capture
+        try:
+            entries = functions.load_subscription(json.dumps({
+                'URI:CHK:a': {'name': 'a', 'mode': 'one-check'},
+                'pb://b@c.b32.i2p/introducer': {'name': 'b', 'active': False,
+                                                'contact': 'b@mail.i2p'}}))
+            self.assertEqual(sorted(entries), [
+                ('URI:CHK:a', 'a', 'one-check', True, None),
+                ('pb://b@c.b32.i2p/introducer', 'b', None, False,
+                                                        'b@mail.i2p')])
+            entry = sorted(entries)[0]
+            self.assertEqual((entry.name, entry.mode), ('a', 'one-check'))
+            self.assertRaises(AttributeError, setattr, entry, 'mode',
+                                                            'deep-check')
+            self.assertEqual(functions.load_subscription('{}'), [])
+            for invalid in ('[', '{"URI:CHK:a": "a"}',
+                            '{"URI:CHK:a": {"mode": "one-check"}}'):
+                self.assertIsNone(functions.load_subscription(invalid))
+        finally:
+            sys.stdout, sys.stderr = oldstdout, oldstderr
+
     def test_http_proxy_configured(self):
         """proxy_configured should be able to determine when a proxy is set."""
         os.environ['http_proxy'] = 'http://blah:666'
@@ -142,6 +279,1233 @@ repairlist_uri = URI:DIR2-RO:ysxswonidme22ireuqrsrkcv4y:nqxg7ihxnx7eqoqeqoy7xxjm
         self.assertFalse(check('1.2.0', '1.2.0'))
         self.assertTrue(check('1.2.0', '2.0'))
 
+    def test_worker_pool_output_order(self):
+        """WorkerPool should run jobs concurrently but print in order"""
+        capture = StringIO()
+        oldstdout = sys.stdout
+        sys.stdout = capture
+        def job(num):
+            # later jobs finish first
+            time.sleep(0.01 * (5 - num))
+            print('job %d start' % num)
+            print('job %d end' % num)
+            return num * 2
+        try:
+            results = workers.run_ordered(job, range(5), 5)
+        finally:
+            sys.stdout = oldstdout
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        expected = ''.join(['job %d start\njob %d end\n' % (i, i)
+                            for i in range(5)])
+        self.assertEqual(capture.getvalue(), expected)
+
+    def test_worker_pool_errors(self):
+        """WorkerPool should pass on exceptions raised by jobs"""
+        def job(num):
+            if num == 2:
+                sys.exit(1)
+            return num
+        with self.assertRaises(SystemExit):
+            workers.run_ordered(job, range(4), 2)
+
+    def test_worker_pool_stops(self):
+        """WorkerPool should not take new jobs after a failure and should
+        raise KeyboardInterrupt right away when jobs run inline"""
+        started = []
+        def job(num, error=None):
+            started.append(num)
+            if error is not None:
+                raise error
+        for error in (KeyboardInterrupt, ValueError):
+            del started[:]
+            with self.assertRaises(error):
+                workers.run_ordered(lambda num: job(num, num == 1 and
+                                                error() or None), range(4))
+            self.assertEqual(started, [0, 1])
+        del started[:]
+        pool = workers.WorkerPool(2)
+        with self.assertRaises(ValueError):
+            pool.submit(job, 0, ValueError()).result()
+        with self.assertRaises(ValueError):
+            pool.submit(job, 1)
+        pool.close()
+        self.assertEqual(started, [0])
+        # queued jobs are skipped once one has failed
+        del started[:]
+        def slow(num):
+            started.append(num)
+            time.sleep(0.05)
+            if num == 0:
+                raise ValueError()
+        oldstdout = sys.stdout
+        with self.assertRaises(ValueError):
+            workers.run_ordered(slow, range(20), 2)
+        self.assertTrue(sys.stdout is oldstdout)
+        count = len(started)
+        time.sleep(0.2)
+        self.assertEqual(len(started), count)
+        self.assertTrue(count < 5)
+
+    def test_wait_until(self):
+        """wait_until should wait until done, and stop waiting after
+        stop_jobs() only if stoppable"""
+        event = threading.Event()
+        timer = threading.Timer(0.1, event.set)
+        timer.start()
+        workers.wait_until(event.is_set, event.wait)
+        self.assertTrue(event.is_set())
+        waits = []
+        workers.stop_jobs()
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                workers.wait_until(lambda: False, waits.append,
+                                                            stoppable=True)
+            workers.wait_until(lambda: len(waits) > 2, waits.append)
+        finally:
+            workers.resume_jobs()
+        self.assertEqual(waits, [0.5] * 3)
+
+    def test_concurrent_actions(self):
+        """run_actions should run actions at the same time, keep their
+        output together and combine their exit status"""
+        capture = StringIO()
+        oldstdout = sys.stdout
+        sys.stdout = capture
+        def action(name, seconds, status=None):
+            print('-- %s --' % name)
+            time.sleep(seconds)
+            print('%s done' % name)
+            if status is not None:
+                sys.exit(status)
+        try:
+            start = time.time()
+            status = grid_updates.run_actions([(action, 'news', 0.3),
+                                               (action, 'update', 0.2, 2),
+                                               (action, 'repair', 0.3, 1)], 4)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = oldstdout
+        self.assertEqual(status, 2)
+        self.assertTrue(elapsed < 0.6)
+        self.assertEqual(capture.getvalue(), '-- news --\nnews done\n'
+                                '-- update --\nupdate done\n'
+                                '-- repair --\nrepair done\n')
+        self.assertEqual(grid_updates.run_actions([]), 0)
+
+    def test_failing_action(self):
+        """an action that raises an unexpected error should not keep the
+        other actions from finishing"""
+        finished = []
+        def broken():
+            raise ValueError('broken action')
+        def action():
+            time.sleep(0.2)
+            finished.append(1)
+        oldstderr = sys.stderr
+        sys.stderr = self.capture
+        try:
+            status = grid_updates.run_actions([(broken,), (action,)], 2)
+        finally:
+            sys.stderr = oldstderr
+        self.assertEqual(status, 1)
+        self.assertEqual(finished, [1])
+        self.assertTrue('ERROR: broken action' in self.capture.getvalue())
+
+    def test_concurrent_repairs(self):
+        """RepairList should count the same unhealthy shares with several
+        workers"""
+        sharelist = {}
+        for num in range(8):
+            sharelist['URI:CHK:file%d' % num] = {'name': 'file%d' % num,
+                                                 'mode': 'one-check'}
+        def share(method, query, body):
+            return 200, json.dumps(sharelist)
+        def check(num):
+            return lambda method, query, body: (200,
+                    check_response(num % 3 != 0, 'si%d' % num))
+        routes = {'/uri/URI:LIT:list': share}
+        for num in range(8):
+            routes['/uri/URI:CHK:file%d' % num] = check(num)
+        gateway = FakeGateway(routes)
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            for count in (1, 4):
+                repairlist = repairs.RepairList(gateway.url,
+                        gateway.url + '/uri/URI:LIT:list', 0, count)
+                repairlist.run_action()
+                self.assertEqual(repairlist.unhealthy, 3)
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+
+    def test_interrupted_actions(self):
+        """Ctrl-C should stop a repair running in another thread and let it
+        save its state"""
+        sharelist = {}
+        routes = {'/uri/URI:LIT:list':
+                        lambda m, q, b: (200, json.dumps(sharelist))}
+        def slow(method, query, body):
+            time.sleep(0.2)
+            return 200, check_response(True)
+        for num in range(5):
+            sharelist['URI:CHK:file%d' % num] = {'name': 'file%d' % num,
+                                                 'mode': 'one-check'}
+            routes['/uri/URI:CHK:file%d' % num] = slow
+        server = FakeGateway(routes)
+        statefile = os.path.join(self.tempdir, 'repair-state.json')
+        def repair():
+            state = checkpoint.Checkpoint(statefile)
+            repairs.RepairList(server.url, server.url + '/uri/URI:LIT:list',
+                                0, 1, checkpoint=state).run_action()
+        oldstderr = sys.stderr
+        sys.stderr = self.capture
+        timer = threading.Timer(0.3, interrupt_main)
+        timer.start()
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                grid_updates.run_actions([(repair,), (time.sleep, 1)], 2)
+        finally:
+            sys.stderr = oldstderr
+            timer.cancel()
+            server.stop()
+        self.assertTrue('continue with --resume' in self.capture.getvalue())
+        with open(statefile, 'r') as state:
+            self.assertTrue(0 < len(json.load(state)['done']) < 5)
+
+    def test_streaming_deep_check(self):
+        """deep-check results should be parsed line by line"""
+        lines = []
+        for num in range(20):
+            lines.append(json.dumps({'path': ['dir', 'file%d' % num],
+                'type': 'file',
+                'storage-index': 'si%d' % num,
+                'check-and-repair-results': json.loads(
+                    check_response(num % 4 != 0, 'si%d' % num))}))
+        lines.append(json.dumps({'path': ['lit'], 'type': 'file',
+                                 'storage-index': '',
+                                 'check-and-repair-results': {}}))
+        lines.append(json.dumps({'type': 'stats', 'stats': {}}))
+        gateway = FakeGateway({'/uri/URI:DIR2-RO:deep':
+                    lambda method, query, body: (200, '\n'.join(lines))})
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            results = repairs.repair_share('deep', gateway.url +
+                            '/uri/URI:DIR2-RO:deep', 'deep-check')
+            first = next(iter(repairs.iter_results(results)))
+            self.assertEqual(first.path, ('dir', 'file0'))
+            results.close()
+            repairlist = repairs.RepairList(gateway.url, None, 0)
+            repairlist.deep_check('deep', gateway.url +
+                            '/uri/URI:DIR2-RO:deep', 'deep-check')
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        self.assertEqual(repairlist.unhealthy, 5)
+
+    def test_check_result(self):
+        """CheckResult should extract the same data from all result types"""
+        one = repairs.load_result(check_response(False, 'si1'))
+        self.assertEqual(one.storage_index, 'si1')
+        self.assertFalse(one.healthy)
+        self.assertEqual((one.shares_good, one.shares_needed,
+                          one.shares_expected), (3, 3, 10))
+        deep = repairs.load_result(json.dumps({'path': ['a', 'b'],
+                'type': 'file', 'storage-index': 'si2',
+                'check-and-repair-results': json.loads(check_response(True,
+                                                                'si2'))}))
+        self.assertEqual(deep.path, ('a', 'b'))
+        self.assertTrue(deep.healthy)
+        self.assertEqual(deep.summary, 'Healthy')
+        literal = repairs.load_result(json.dumps({'storage-index': '',
+                                                  'results': {}}))
+        self.assertTrue(functions.is_literal_file(literal))
+        self.assertEqual(repairs.parse_result(literal, 'one-check', 0),
+                         ('unchecked (literal file)', 0))
+        self.assertIsNone(repairs.load_result('{"type": "stats"}'))
+
+    def test_check_cache(self):
+        """recently healthy objects should not be checked again"""
+        gateway = FakeGateway({
+            '/uri/URI:CHK:good': lambda m, q, b: (200, check_response(True)),
+            '/uri/URI:CHK:bad': lambda m, q, b: (200, check_response(False))})
+        checks = cache.open_check_cache(self.tempdir, 1)
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            for run in range(2):
+                repairlist = repairs.RepairList(gateway.url, None, 0, 1,
+                                                checks)
+                for name in ('good', 'bad'):
+                    repairlist.one_check(name, gateway.url +
+                                '/uri/URI:CHK:' + name, 'one-check')
+                self.assertEqual(repairlist.unhealthy, 1)
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+            checks.close()
+        paths = [request[1] for request in gateway.requests]
+        self.assertEqual(paths.count('/uri/URI:CHK:good'), 1)
+        self.assertEqual(paths.count('/uri/URI:CHK:bad'), 2)
+
+    def test_level_check(self):
+        """level-check should crawl and check the configured number of
+        levels"""
+        root = '/uri/URI:DIR2-RO:root'
+        gateway = FakeGateway({
+            root: tahoe_node({'a': 'dirnode', 'b': 'filenode'}),
+            root + '/a': tahoe_node({'c': 'dirnode', 'd': 'filenode'}),
+            root + '/b': tahoe_node(healthy=False),
+            root + '/a/c': tahoe_node({'e': 'filenode'}),
+            root + '/a/d': tahoe_node(healthy=False),
+            root + '/a/c/e': tahoe_node()})
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            repairlist = repairs.RepairList(gateway.url, None, 2, 3, None, 3)
+            repairlist.level_check('root', gateway.url + root,
+                                                    'level-check 2')
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        checked = [request[1] for request in gateway.requests
+                                if request[0] == 'POST']
+        self.assertEqual(sorted(checked), sorted([root, root + '/a',
+                root + '/b', root + '/a/c', root + '/a/d']))
+        self.assertEqual(repairlist.unhealthy, 2)
+        # only directories are listed
+        listed = [request[1] for request in gateway.requests
+                                if request[0] == 'GET']
+        self.assertEqual(sorted(listed), [root, root + '/a'])
+        output = self.capture.getvalue()
+        self.assertLess(output.index("'root/a'"), output.index("'root/a/c'"))
+
+    def test_level_check_caps(self):
+        """level-check should check children by the caps in the parent's
+        listing and visit each of them once"""
+        def root(method, query, body):
+            if method == 'POST':
+                return 200, check_response(True)
+            info = {'ro_uri': 'URI:CHK:file', 'verify_uri':
+                                            'URI:CHK-Verifier:file'}
+            return 200, json.dumps(['dirnode', {'children': {
+                                        'one': ['filenode', info],
+                                        'two': ['filenode', info]}}])
+        gateway = FakeGateway({'/uri/URI:DIR2-RO:root': root,
+                            '/uri/URI:CHK:file': tahoe_node(healthy=False)})
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            repairlist = repairs.RepairList(gateway.url, None, 0)
+            repairlist.level_check('root', gateway.url +
+                            '/uri/URI:DIR2-RO:root', 'level-check 2')
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        self.assertEqual([request[:2] for request in gateway.requests], [
+                            ('POST', '/uri/URI:DIR2-RO:root'),
+                            ('GET', '/uri/URI:DIR2-RO:root'),
+                            ('POST', '/uri/URI:CHK:file')])
+        self.assertEqual(repairlist.unhealthy, 1)
+
+    def test_listing_cache(self):
+        """ListingCache should keep immutable listings, expire read-only ones
+        and evict the least recently used"""
+        listing = tahoe_node({'file': 'filenode'})
+        gateway = FakeGateway({'/uri/URI:DIR2-CHK:imm': listing,
+                               '/uri/URI:DIR2-CHK:other': listing,
+                               '/uri/URI:DIR2-RO:ro': listing,
+                               '/uri/URI:DIR2:rw': listing})
+        path = os.path.join(self.tempdir, 'listings.sqlite')
+        listings = cache.ListingCache(path, ttl=3600)
+        try:
+            for run in range(2):
+                for cap in ('URI:DIR2-CHK:imm', 'URI:DIR2-RO:ro',
+                                                'URI:DIR2:rw'):
+                    data = listings.get_listing(gateway.url + '/uri/' + cap)
+                    self.assertEqual(json.loads(data.decode('utf8'))[0],
+                                     'dirnode')
+            self.assertEqual(listings.hits, 2)
+            listings.ttl = 0
+            listings.get_listing(gateway.url + '/uri/URI:DIR2-RO:ro')
+            self.assertEqual(len(gateway.requests), 5)
+            # room for only one listing
+            listings.max_size = len(data)
+            listings.get_listing(gateway.url + '/uri/URI:DIR2-CHK:other')
+            listings.get_listing(gateway.url + '/uri/URI:DIR2-CHK:imm')
+            self.assertEqual(len(gateway.requests), 7)
+        finally:
+            listings.close()
+            gateway.stop()
+
+    def test_resume_repairs(self):
+        """an interrupted repair run should continue where it stopped"""
+        sharelist = {}
+        routes = {}
+        for num in range(4):
+            sharelist['URI:CHK:file%d' % num] = {'name': 'file%d' % num,
+                                                 'mode': 'one-check'}
+            routes['/uri/URI:CHK:file%d' % num] = tahoe_node()
+        routes['/uri/URI:LIT:list'] = lambda m, q, b: (200,
+                                                json.dumps(sharelist))
+        gateway = FakeGateway(routes)
+        statefile = os.path.join(self.tempdir, 'repair-state.json')
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            state = checkpoint.Checkpoint(statefile)
+            repairlist = repairs.RepairList(gateway.url,
+                    gateway.url + '/uri/URI:LIT:list', 0, checkpoint=state)
+            calls = []
+            def interrupted(sharename, repair_uri, mode):
+                calls.append(sharename)
+                if len(calls) == 3:
+                    raise KeyboardInterrupt
+                return repairs.RepairList.one_check(repairlist, sharename,
+                                                    repair_uri, mode)
+            repairlist.one_check = interrupted
+            with self.assertRaises(KeyboardInterrupt):
+                repairlist.run_action()
+            self.assertTrue(os.path.exists(statefile))
+            state = checkpoint.Checkpoint(statefile, resume=True)
+            repairlist = repairs.RepairList(gateway.url,
+                    gateway.url + '/uri/URI:LIT:list', 0, checkpoint=state)
+            repairlist.run_action()
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        self.assertFalse(os.path.exists(statefile))
+        checked = [request[1] for request in gateway.requests
+                                if request[0] == 'POST']
+        self.assertEqual(sorted(checked), sorted(routes.keys())[:4])
+
+    def test_failed_repairs_not_done(self):
+        """entries and level-check items whose check failed should be
+        repeated by a resumed run"""
+        root = '/uri/URI:DIR2-RO:root'
+        sharelist = {'URI:CHK:good': {'name': 'good', 'mode': 'one-check'},
+                     'URI:CHK:busy': {'name': 'busy', 'mode': 'one-check'},
+                     'URI:DIR2-RO:root': {'name': 'root',
+                                          'mode': 'level-check 1'}}
+        busy = lambda m, q, b: (503, 'Service Unavailable')
+        gateway = FakeGateway({
+            '/uri/URI:LIT:list': lambda m, q, b: (200, json.dumps(sharelist)),
+            '/uri/URI:CHK:good': tahoe_node(),
+            '/uri/URI:CHK:busy': busy,
+            root: tahoe_node({'a': 'filenode', 'b': 'filenode'}),
+            root + '/a': tahoe_node(),
+            root + '/b': busy})
+        statefile = os.path.join(self.tempdir, 'repair-state.json')
+        oldstdout = sys.stdout
+        oldstderr = sys.stderr
+        sys.stdout = sys.stderr = self.capture
+        retry.configure(attempts=1)
+        try:
+            state = checkpoint.Checkpoint(statefile)
+            repairlist = repairs.RepairList(gateway.url,
+                    gateway.url + '/uri/URI:LIT:list', 0, checkpoint=state)
+            repairlist.run_job(repairlist.one_check, 'good',
+                                gateway.url + '/uri/URI:CHK:good', 'one-check')
+            repairlist.run_job(repairlist.one_check, 'busy',
+                                gateway.url + '/uri/URI:CHK:busy', 'one-check')
+            repairlist.run_job(repairlist.level_check, 'root',
+                                gateway.url + root, 'level-check 1')
+            state.save(force=True)
+        finally:
+            sys.stdout = oldstdout
+            sys.stderr = oldstderr
+            retry.configure()
+            gateway.stop()
+        with open(statefile, 'r') as saved:
+            saved = json.load(saved)
+        self.assertEqual(saved['done'], [gateway.url + '/uri/URI:CHK:good'])
+        tree = saved['trees'][gateway.url + root]
+        self.assertTrue(gateway.url + root + '/a' in tree['checked'])
+        self.assertEqual(list(tree['pending'].keys()),
+                                            [gateway.url + root + '/b'])
+
+    def test_resume_level_check(self):
+        """a resumed level-check should start from the saved frontier"""
+        root = '/uri/URI:DIR2-RO:root'
+        gateway = FakeGateway({
+            root: tahoe_node({'a': 'dirnode', 'b': 'filenode'}),
+            root + '/a': tahoe_node({'c': 'filenode'}),
+            root + '/b': tahoe_node(),
+            root + '/a/c': tahoe_node()})
+        statefile = os.path.join(self.tempdir, 'repair-state.json')
+        with open(statefile, 'w') as state:
+            json.dump({'subscription': 'list', 'done': [], 'trees': {
+                gateway.url + root: {'levels': 1, 'checked': [
+                                            gateway.url + root + '/a'],
+                    'frontier': [['root/a', gateway.url + root + '/a',
+                                  'dirnode', None],
+                                 ['root/b', gateway.url + root + '/b',
+                                  'filenode', None]]}}}, state)
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            state = checkpoint.Checkpoint(statefile, resume=True)
+            state.begin('list')
+            repairlist = repairs.RepairList(gateway.url, 'list', 0,
+                                            checkpoint=state)
+            repairlist.level_check('root', gateway.url + root,
+                                                        'level-check 2')
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        self.assertEqual([request[:2] for request in gateway.requests], [
+                            ('POST', root + '/b'),
+                            ('GET', root + '/a'),
+                            ('POST', root + '/a/c')])
+
+    def test_level_check_checkpoint_pending(self):
+        """items of a level-check that are still being checked while the
+        crawl goes on should stay in the state file and be checked when the
+        run is resumed"""
+        root = '/uri/URI:DIR2-RO:root'
+        statefile = os.path.join(self.tempdir, 'repair-state.json')
+        saved = []
+        def slow(method, query, body):
+            if method == 'POST':
+                time.sleep(0.5)
+                with open(statefile, 'r') as state:
+                    saved.append(state.read())
+            return tahoe_node()(method, query, body)
+        routes = {
+            root: tahoe_node({'a': 'dirnode', 'b': 'filenode'}),
+            root + '/a': tahoe_node({'c': 'filenode'}),
+            root + '/b': slow,
+            root + '/a/c': tahoe_node()}
+        server = FakeGateway(routes)
+        # the crawl must not wait for the slow check
+        gateway.set_max_requests(4)
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            state = checkpoint.Checkpoint(statefile, interval=0)
+            state.begin('list')
+            repairlist = repairs.RepairList(server.url, 'list', 0, 4,
+                                            checkpoint=state)
+            repairlist.level_check('root', server.url + root,
+                                                        'level-check 2')
+        finally:
+            sys.stdout = oldstdout
+            server.stop()
+        # the crawl has moved on to the next level while 'b' was being checked
+        tree = json.loads(saved[0])['trees'][server.url + root]
+        self.assertEqual([item[0] for item in tree['frontier']],
+                                                        ['root/a/c'])
+        self.assertEqual(list(tree['pending'].keys()),
+                                                [server.url + root + '/b'])
+        # resume a run that was interrupted at that point
+        old_url = server.url
+        routes[root + '/b'] = tahoe_node()
+        server = FakeGateway(routes)
+        with open(statefile, 'w') as state:
+            state.write(saved[0].replace(old_url, server.url))
+        sys.stdout = self.capture
+        try:
+            state = checkpoint.Checkpoint(statefile, resume=True)
+            state.begin('list')
+            repairlist = repairs.RepairList(server.url, 'list', 0,
+                                            checkpoint=state)
+            repairlist.level_check('root', server.url + root,
+                                                        'level-check 2')
+        finally:
+            sys.stdout = oldstdout
+            server.stop()
+        expected = [('POST', root + '/b')]
+        if old_url + root + '/a/c' not in tree['checked']:
+            expected.append(('POST', root + '/a/c'))
+        self.assertEqual(sorted(request[:2] for request in server.requests),
+                                                            sorted(expected))
+
+    def test_two_phase_repairs(self):
+        """two-phase repairs should only repair unhealthy objects and renew
+        leases in a separate batch, at most every --lease-interval days"""
+        def broken(method, query, body):
+            return 200, check_response(query.get('repair') == 'true', 'bbbb')
+        sharelist = {'URI:CHK:good': {'name': 'good', 'mode': 'one-check'},
+                     'URI:CHK:bad': {'name': 'bad', 'mode': 'one-check'}}
+        gateway = FakeGateway({
+            '/uri/URI:CHK:good': tahoe_node(),
+            '/uri/URI:CHK:bad': broken,
+            '/uri/URI:LIT:list': lambda m, q, b: (200, json.dumps(sharelist))})
+        checks = cache.CheckCache(os.path.join(self.tempdir, 'checks.sqlite'))
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            for run in range(2):
+                repairlist = repairs.RepairList(gateway.url,
+                        gateway.url + '/uri/URI:LIT:list', 0, 2, checks,
+                        strategy='two-phase', lease_interval=1)
+                repairlist.run_action()
+                self.assertEqual(repairlist.unhealthy, 0)
+        finally:
+            sys.stdout = oldstdout
+            checks.close()
+            gateway.stop()
+        posts = [(request[1].split(':')[-1], request[2].get('repair', ''),
+                  request[2].get('add-lease', ''))
+                    for request in gateway.requests if request[0] == 'POST']
+        # run 1: check both, repair 'bad', then renew both leases
+        self.assertEqual(sorted(posts[:3]), [('bad', '', ''),
+                                             ('bad', 'true', ''),
+                                             ('good', '', '')])
+        self.assertEqual(sorted(posts[3:5]), [('bad', '', 'true'),
+                                              ('good', '', 'true')])
+        # run 2: the leases are still fresh
+        self.assertEqual(sorted(posts[5:]), [('bad', '', ''),
+                                             ('bad', 'true', ''),
+                                             ('good', '', '')])
+
+    def test_async_deep_check(self):
+        """ophandle deep-checks should all be started before they are polled
+        until they have finished"""
+        operations = {}
+        def share(method, query, body):
+            if method == 'POST' and query.get('t') == 'start-deep-check':
+                operations[query['ophandle']] = 2 # polls until finished
+                # like Tahoe, with a handle that is released once its
+                # results have been fetched
+                return 302, 'started', {'Location':
+                                        '/operations/' + query['ophandle']}
+            return 200, check_response(True)
+        def operation(method, query, body, handle):
+            if handle not in operations:
+                return 404, 'unknown handle'
+            operations[handle] -= 1
+            if operations[handle] > 0:
+                return 200, json.dumps({'finished': False})
+            del operations[handle]
+            broken = json.loads(check_response(False, 'cccc'))
+            return 200, json.dumps({'finished': True,
+                                    'count-objects-checked': 3,
+                                    'list-unhealthy-files': [[['f'], broken]]})
+        class Routes(dict):
+            def __getitem__(self, path):
+                if path.startswith('/operations/'):
+                    handle = path.split('/')[-1]
+                    return lambda m, q, b: operation(m, q, b, handle)
+                return dict.__getitem__(self, path)
+            def __contains__(self, path):
+                return (path.startswith('/operations/') or
+                        dict.__contains__(self, path))
+        sharelist = {'URI:DIR2:a': {'name': 'a', 'mode': 'deep-check'},
+                     'URI:DIR2:b': {'name': 'b', 'mode': 'deep-check'}}
+        gateway = FakeGateway(Routes({
+            '/uri/URI:DIR2:a': share,
+            '/uri/URI:DIR2:b': share,
+            '/uri/URI:LIT:list': lambda m, q, b: (200, json.dumps(sharelist))}))
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            repairlist = repairs.RepairList(gateway.url,
+                    gateway.url + '/uri/URI:LIT:list', 0,
+                    deep_check_method='ophandle', poll_interval=0.01)
+            repairlist.run_action()
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        self.assertEqual(operations, {})
+        self.assertEqual(repairlist.unhealthy, 2)
+        requests = [(request[0], request[1].split('/')[1])
+                                    for request in gateway.requests]
+        self.assertEqual(requests[1:3], [('POST', 'uri'), ('POST', 'uri')])
+        self.assertEqual(requests[3:], [('GET', 'operations')] * 4)
+        for request in gateway.requests[3:]:
+            self.assertEqual(request[2], {'t': 'status', 'output': 'JSON'})
+
+    def test_parallel_deep_check(self):
+        """parallel-deep-check should check each storage index of the
+        manifest once"""
+        manifest = [{'path': [], 'type': 'directory', 'cap': 'URI:DIR2:root',
+                     'storage-index': 'root'},
+                    {'path': ['a'], 'type': 'file', 'cap': 'URI:CHK:a',
+                     'storage-index': 'aaaa'},
+                    {'path': ['link'], 'type': 'file', 'cap': 'URI:CHK:a',
+                     'storage-index': 'aaaa'},
+                    {'path': ['b'], 'type': 'file', 'cap': 'URI:CHK:b',
+                     'storage-index': 'bbbb'},
+                    {'path': ['tiny'], 'type': 'file', 'cap': 'URI:LIT:c',
+                     'storage-index': None},
+                    {'type': 'stats', 'stats': {}}]
+        def root(method, query, body):
+            if query.get('t') == 'stream-manifest':
+                return 200, '\n'.join(json.dumps(line)
+                                        for line in manifest) + '\n'
+            return 200, check_response(True, 'root')
+        sharelist = {'URI:DIR2:root': {'name': 'root',
+                                       'mode': 'parallel-deep-check'}}
+        gateway = FakeGateway({
+            '/uri/URI:DIR2:root': root,
+            '/uri/URI:CHK:a': tahoe_node(),
+            '/uri/URI:CHK:b': tahoe_node(healthy=False),
+            '/uri/URI:LIT:list': lambda m, q, b: (200, json.dumps(sharelist))})
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            repairlist = repairs.RepairList(gateway.url,
+                    gateway.url + '/uri/URI:LIT:list', 2, 3)
+            repairlist.run_action()
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        self.assertEqual(repairlist.unhealthy, 1)
+        checks = [request[1] for request in gateway.requests
+                        if request[0] == 'POST' and request[2]['t'] == 'check']
+        self.assertEqual(sorted(checks), ['/uri/URI:CHK:a', '/uri/URI:CHK:b',
+                                          '/uri/URI:DIR2:root'])
+        output = self.capture.getvalue()
+        self.assertTrue('  b: Unhealthy' in output)
+        self.assertTrue('  tiny: (literal file)' in output)
+
+    def test_check_index(self):
+        """objects that appear in several subscription entries should only
+        be checked once per run"""
+        manifest = [{'path': [], 'type': 'directory', 'cap': 'URI:DIR2:one',
+                     'storage-index': 'one'},
+                    {'path': ['a'], 'type': 'file', 'cap': 'URI:CHK:a',
+                     'verifycap': 'URI:CHK-Verifier:a', 'storage-index': 'aaaa'}]
+        def one(method, query, body):
+            if query.get('t') == 'stream-manifest':
+                return 200, '\n'.join(json.dumps(line)
+                                        for line in manifest) + '\n'
+            return 200, check_response(True, 'one')
+        def two(method, query, body):
+            if method == 'POST':
+                return 200, check_response(True, 'two')
+            child = {'ro_uri': 'URI:CHK:a',
+                     'verify_uri': 'URI:CHK-Verifier:a'}
+            return 200, json.dumps(['dirnode',
+                                    {'children': {'a': ['filenode', child]}}])
+        sharelist = {'URI:DIR2:one': {'name': 'one',
+                                      'mode': 'parallel-deep-check'},
+                     'URI:DIR2:two': {'name': 'two', 'mode': 'level-check 1'}}
+        gateway = FakeGateway({
+            '/uri/URI:DIR2:one': one,
+            '/uri/URI:DIR2:two': two,
+            '/uri/URI:CHK:a': tahoe_node(healthy=False),
+            '/uri/URI:LIT:list': lambda m, q, b: (200, json.dumps(sharelist))})
+        oldstdout = sys.stdout
+        sys.stdout = self.capture
+        try:
+            repairlist = repairs.RepairList(gateway.url,
+                    gateway.url + '/uri/URI:LIT:list', 1, 2)
+            repairlist.run_action()
+        finally:
+            sys.stdout = oldstdout
+            gateway.stop()
+        checks = [request[1] for request in gateway.requests
+                        if request[0] == 'POST' and request[2]['t'] == 'check']
+        self.assertEqual(checks.count('/uri/URI:CHK:a'), 1)
+        self.assertEqual(repairlist.index.saved, 1)
+        self.assertEqual(repairlist.unhealthy, 1)
+        self.assertTrue('Skipped 1 checks' in self.capture.getvalue())
+
+    def test_request_controller(self):
+        """the gateway request limit should grow while requests succeed
+        quickly and shrink on errors and rising latency"""
+        controller = gateway.Controller(ceiling=8, initial=2)
+        for _ in range(40):
+            controller.acquire()
+            controller.release(0.1)
+        self.assertEqual(int(controller.limit), 8)
+        controller.acquire()
+        controller.release(0.1, error=True)
+        self.assertEqual(int(controller.limit), 4)
+        controller.last_cut = 0
+        for _ in range(20):
+            controller.acquire()
+            controller.release(1.0)
+        self.assertTrue(controller.limit < 4)
+        self.assertTrue(controller.limit >= 1)
+        self.assertEqual(controller.errors, 1)
+
+    def test_request_controller_kinds(self):
+        """fast listings and slow checks should not make each other look
+        like a congested gateway"""
+        listing = gateway.request_kind('http://gw/uri/URI:DIR2:a?t=json')
+        check = gateway.request_kind('http://gw/uri/URI:CHK:a',
+                                        b't=check&repair=true&output=json')
+        self.assertEqual(listing, ('GET', 'json'))
+        self.assertEqual(check, ('POST', 'check'))
+        controller = gateway.Controller(ceiling=8, initial=8)
+        for num in range(100):
+            controller.acquire()
+            if num % 4:
+                controller.release(2.0, kind=listing)
+            else:
+                controller.release(30.0 + num % 3 * 15, kind=check)
+        self.assertEqual(int(controller.limit), 8)
+        # a check that slows down still cuts the limit
+        controller.last_cut = 0
+        for _ in range(20):
+            controller.acquire()
+            controller.release(300.0, kind=check)
+        self.assertTrue(controller.limit < 8)
+
+    def test_single_flight(self):
+        """identical GET requests in flight should share one request"""
+        def slow(method, query, body):
+            time.sleep(0.2)
+            return 200, 'listing'
+        def missing(method, query, body):
+            time.sleep(0.2)
+            return 404, 'Not Found'
+        server = FakeGateway({'/uri/URI:DIR2:dir': slow,
+                              '/uri/URI:DIR2:gone': missing})
+        results = []
+        def get(path):
+            try:
+                results.append(gateway.fetch(server.url + path))
+            except client.HTTPError as exc:
+                results.append(exc.code)
+        try:
+            before = gateway.coalesced()
+            workers.run_ordered(get, ['/uri/URI:DIR2:dir'] * 4 +
+                                     ['/uri/URI:DIR2:gone'] * 3, 8)
+            self.assertEqual(sorted(results, key=str),
+                             [404] * 3 + [b'listing'] * 4)
+            self.assertEqual(len(server.requests), 2)
+            requests, hits = gateway.coalesced()
+            self.assertEqual((requests - before[0], hits - before[1]), (2, 5))
+            # finished requests are not cached
+            gateway.fetch(server.url + '/uri/URI:DIR2:dir')
+            self.assertEqual(len(server.requests), 3)
+        finally:
+            server.stop()
+
+    def test_gateway_breaker(self):
+        """the circuit breaker should hold requests back while the gateway
+        is gone and fail fast once it gives up"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+        sock.close()
+        server = FakeGateway({'/': lambda m, q, b: (200, 'OK')})
+        oldstderr = sys.stderr
+        oldstdout = sys.stdout
+        sys.stderr = sys.stdout = self.capture
+        try:
+            # the gateway comes back (the probe URL answers)
+            gateway.set_breaker(server.url + '/', 2, 5, 1, 0.01)
+            for _ in range(2):
+                self.assertRaises(IOError, gateway.fetch, dead)
+            self.assertEqual(gateway.fetch(server.url + '/'), b'OK')
+            # the gateway stays away
+            gateway.set_breaker(dead, 2, 0.05, 1, 0.01)
+            self.assertRaises(IOError, gateway.fetch, dead)
+            self.assertRaises(gateway.GatewayUnavailable, gateway.fetch, dead)
+            self.assertRaises(gateway.GatewayUnavailable, gateway.fetch,
+                                                        server.url + '/')
+        finally:
+            sys.stderr = oldstderr
+            sys.stdout = oldstdout
+            gateway.set_breaker(None, 0)
+            server.stop()
+        self.assertEqual(len(server.requests), 2)
+        self.assertTrue('pausing requests' in self.capture.getvalue())
+
+    def test_breaker_timeouts(self):
+        """requests that time out on a busy gateway should not trip the
+        circuit breaker"""
+        def slow(method, query, body):
+            time.sleep(0.5)
+            return 200, 'OK'
+        server = FakeGateway({'/slow': slow})
+        self.assertFalse(gateway.is_connection_failure(
+                                client.URLError(socket.timeout('timed out'))))
+        self.assertTrue(gateway.is_connection_failure(
+                                client.URLError(socket.error('refused'))))
+        oldstderr = sys.stderr
+        sys.stderr = self.capture
+        client.set_timeout(0.1)
+        try:
+            gateway.set_breaker(None, 2, 0.05, 1, 0.01)
+            for num in range(3):
+                self.assertRaises(IOError, gateway.fetch,
+                                        server.url + '/slow?n=%d' % num)
+        finally:
+            sys.stderr = oldstderr
+            client.set_timeout(client.DEFAULT_TIMEOUT)
+            gateway.set_breaker(None, 0)
+            server.stop()
+        self.assertFalse('pausing requests' in self.capture.getvalue())
+
+    def test_retry_policy(self):
+        """transient errors should be retried within the action's budget;
+        others should fail right away"""
+        answers = {'/flaky': [503, 502, 200], '/gone': [410, 200],
+                   '/down': [503] * 10}
+        def route(method, query, body, path):
+            status = answers[path].pop(0)
+            return status, 'content'
+        gateway = FakeGateway(dict((path, lambda m, q, b, path=path:
+                                    route(m, q, b, path)) for path in answers))
+        retry.configure(attempts=3, budget=3, base=0)
+        oldstderr = sys.stderr
+        sys.stderr = self.capture
+        try:
+            self.assertEqual(functions.tahoe_dl_file(gateway.url + '/flaky',
+                                        0, 'test').read(), b'content')
+            with self.assertRaises(SystemExit):
+                functions.tahoe_dl_file(gateway.url + '/gone', 0, 'test')
+            # one retry is left in the budget
+            with self.assertRaises(SystemExit):
+                functions.tahoe_dl_file(gateway.url + '/down', 0, 'test')
+        finally:
+            sys.stderr = oldstderr
+            gateway.stop()
+        stats = retry.policy('test')
+        retry.configure()
+        self.assertEqual(answers['/gone'], [200])
+        self.assertEqual(len(answers['/down']), 8)
+        self.assertEqual((stats.requests, stats.retries, stats.recovered,
+                          stats.failed), (3, 3, 1, 2))
+        self.assertFalse(retry.is_retryable(retry.HTTPError('', 404, '',
+                                                            {}, None)))
+        self.assertTrue(retry.is_retryable(retry.URLError('refused')))
+
+    def test_keepalive_client(self):
+        """HTTPClient should reuse connections and raise urllib's errors"""
+        lines = '\n'.join(str(num) for num in range(100)) + '\n'
+        # lines split across chunks, as the gateway streams them
+        chunked = ''.join('%x\r\n%s\r\n' % (len(part), part)
+                        for part in ('0\n1', '\n2\n', '3\n')) + '0\r\n\r\n'
+        gateway = FakeGateway({
+            '/file': lambda m, q, b: (200, 'content'),
+            '/lines': lambda m, q, b: (200, lines),
+            '/chunked': lambda m, q, b: (200, chunked,
+                                    {'Transfer-Encoding': 'chunked'})})
+        connections = []
+        get_request = gateway.get_request
+        def count_connections():
+            connections.append(1)
+            return get_request()
+        gateway.get_request = count_connections
+        http = client.HTTPClient(timeout=10)
+        try:
+            for _ in range(5):
+                self.assertEqual(http.open(gateway.url + '/file').read(),
+                                                                b'content')
+            self.assertEqual(http.open(gateway.url + '/file',
+                                        b'a=1').read(), b'content')
+            with self.assertRaises(client.HTTPError) as error:
+                http.open(gateway.url + '/missing')
+            self.assertEqual(error.exception.code, 404)
+            self.assertEqual(len(connections), 1)
+            # a response that is closed early takes its connection along
+            response = http.open(gateway.url + '/lines')
+            self.assertEqual(response.readline(), b'0\n')
+            response.close()
+            self.assertEqual(http.open(gateway.url + '/file').read(),
+                                                                b'content')
+            self.assertEqual(len(connections), 2)
+            response = http.open(gateway.url + '/lines')
+            self.assertEqual(list(iter(response.readline, b'')),
+                        [line.encode('ascii') + b'\n'
+                                    for line in lines.split()])
+            response = http.open(gateway.url + '/chunked')
+            self.assertEqual(list(iter(response.readline, b'')),
+                                        [b'0\n', b'1\n', b'2\n', b'3\n'])
+            self.assertEqual(http.open(gateway.url + '/file').read(),
+                                                                b'content')
+            self.assertEqual(len(connections), 2)
+            self.assertEqual((http.requests, http.connections), (12, 2))
+            http.close()
+        finally:
+            gateway.stop()
+        with self.assertRaises(client.URLError):
+            http.open(gateway.url + '/file')
+
+    def test_keepalive_no_replay(self):
+        """HTTPClient should not send a request again after a timeout on a
+        reused connection"""
+        def slow(method, query, body):
+            time.sleep(1)
+            return 200, 'slow'
+        gateway = FakeGateway({
+            '/file': lambda m, q, b: (200, 'content'),
+            '/slow': slow})
+        http = client.HTTPClient(timeout=0.5)
+        try:
+            for data in (None, b'a=1'):
+                self.assertEqual(http.open(gateway.url + '/file').read(),
+                                                                b'content')
+                with self.assertRaises(client.URLError):
+                    http.open(gateway.url + '/slow', data)
+            http.close()
+        finally:
+            gateway.stop()
+        paths = [request[:2] for request in gateway.requests]
+        self.assertEqual(paths.count(('GET', '/slow')), 1)
+        self.assertEqual(paths.count(('POST', '/slow')), 1)
+
+    def test_node_info(self):
+        """the welcome page should be read once per run and, if configured,
+        reused by later runs until it expires"""
+        page = ("<td>allmydata-tahoe: 1.10.0</td> "
+                "<td>from '/usr/lib/python2.7/dist-packages/allmydata/__init__.py'"
+                "</td>")
+        gateway = FakeGateway({'/': lambda m, q, b: (200, page)})
+        url = gateway.url + '/'
+        try:
+            nodeinfo.configure(self.tempdir, 3600)
+            for _ in range(2):
+                self.assertEqual(functions.get_tahoe_version(url), '1.10.0')
+                self.assertEqual(functions.find_tahoe_dir(url),
+                            '/usr/lib/python2.7/dist-packages/allmydata')
+            self.assertEqual(len(gateway.requests), 1)
+            # a new run
+            nodeinfo._memo.clear()
+            self.assertEqual(functions.get_tahoe_version(url), '1.10.0')
+            self.assertEqual(len(gateway.requests), 1)
+            # the saved information has expired
+            nodeinfo._memo.clear()
+            nodeinfo.configure(self.tempdir, 0.001)
+            time.sleep(0.01)
+            self.assertEqual(functions.get_tahoe_version(url), '1.10.0')
+            self.assertEqual(len(gateway.requests), 2)
+        finally:
+            nodeinfo.configure(None)
+            nodeinfo._memo.clear()
+            gateway.stop()
+
+    def test_subscription_cache(self):
+        """unchanged immutable subscriptions should be read from the local
+        copy, changed ones downloaded again"""
+        state = {'cap': 'URI:CHK:aaa', 'content': '{"introducers": {}}'}
+        def listing(method, query, body):
+            return 200, json.dumps(['dirnode', {'children': {
+                'list.json': ['filenode', {'mutable': False,
+                                           'ro_uri': state['cap']}]}}])
+        dirpath = '/uri/URI:DIR2-RO:dir'
+        gateway = FakeGateway({
+            dirpath: listing,
+            dirpath + '/list.json': lambda m, q, b: (200, state['content'])})
+        url = gateway.url + dirpath + '/list.json'
+        def downloads():
+            return len([r for r in gateway.requests if r[1].endswith('.json')])
+        try:
+            subscriptions = cache.open_subscription_cache(self.tempdir)
+            self.assertEqual(functions.tahoe_dl_file(url, 0, 'download',
+                            subscriptions).read(), b'{"introducers": {}}')
+            self.assertEqual(downloads(), 1)
+            # a new run
+            subscriptions = cache.open_subscription_cache(self.tempdir)
+            self.assertEqual(functions.tahoe_dl_file(url, 0, 'download',
+                            subscriptions).read(), b'{"introducers": {}}')
+            self.assertEqual(downloads(), 1)
+            # the file has been replaced
+            state.update(cap='URI:CHK:bbb', content='{"introducers": 1}')
+            self.assertEqual(functions.tahoe_dl_file(url, 0, 'download',
+                            subscriptions).read(), b'{"introducers": 1}')
+            self.assertEqual(downloads(), 2)
+            # the same content under a new cap counts as unchanged
+            state['cap'] = 'URI:CHK:ccc'
+            self.assertIsNone(subscriptions.lookup(url))
+            self.assertFalse(subscriptions.store(url, b'{"introducers": 1}'))
+            self.assertIsNotNone(subscriptions.lookup(url))
+        finally:
+            gateway.stop()
+
+    def test_streaming_download(self):
+        """downloads should be written to disk in chunks and only appear
+        under their name once complete"""
+        content = os.urandom(download.CHUNK_SIZE * 3 + 100)
+        gateway = FakeGateway({
+            '/uri/URI:CHK:big': lambda m, q, b: (200, content),
+            '/uri/URI:CHK:gone': lambda m, q, b: (404, 'Not Found')})
+        path = os.path.join(self.tempdir, 'update.tar.gz')
+        try:
+            digest = download.download_file(gateway.url + '/uri/URI:CHK:big',
+                                                                        path)
+            self.assertEqual(digest, hashlib.sha256(content).hexdigest())
+            with open(path, 'rb') as result:
+                self.assertEqual(result.read(), content)
+            self.assertFalse(os.path.exists(path + '.part'))
+            # a failed download leaves the previous file alone
+            self.assertRaises(client.HTTPError, download.download_file,
+                              gateway.url + '/uri/URI:CHK:gone', path)
+            with open(path, 'rb') as result:
+                self.assertEqual(result.read(), content)
+            self.assertFalse(os.path.exists(path + '.part'))
+        finally:
+            gateway.stop()
+
+    def test_resumed_download(self):
+        """interrupted downloads should be resumed with a Range request, or
+        downloaded in full if the server ignores it"""
+        content = os.urandom(download.CHUNK_SIZE * 2)
+        state = {'ranges': True}
+        def artifact(method, query, body):
+            match = re.match(r'bytes=(\d+)-', gateway.headers[-1].get('range', ''))
+            if not match or not state['ranges']:
+                return 200, content
+            offset = int(match.group(1))
+            return 206, content[offset:], {'Content-Range': 'bytes %d-%d/%d'
+                                    % (offset, len(content) - 1, len(content))}
+        gateway = FakeGateway({'/uri/URI:CHK:update': artifact})
+        url = gateway.url + '/uri/URI:CHK:update'
+        path = os.path.join(self.tempdir, 'grid-updates-1.0.tar.gz')
+        def interrupted(received):
+            """leave a partial download as an interrupted attempt would"""
+            with open(path + '.part', 'wb') as partial:
+                partial.write(content[:received])
+            with open(path + '.part.json', 'w') as statefile:
+                json.dump({'url': url, 'size': len(content)}, statefile)
+        try:
+            for ranges in (True, False):
+                state['ranges'] = ranges
+                interrupted(1000)
+                digest = download.download_file(url, path, resume=True)
+                self.assertEqual(digest, hashlib.sha256(content).hexdigest())
+                self.assertEqual(gateway.headers[-1].get('range'),
+                                                            'bytes=1000-')
+                with open(path, 'rb') as result:
+                    self.assertEqual(result.read(), content)
+                self.assertFalse(os.path.exists(path + '.part'))
+                self.assertFalse(os.path.exists(path + '.part.json'))
+            # a partial file of another URL is not resumed
+            interrupted(1000)
+            with open(path + '.part.json', 'w') as statefile:
+                json.dump({'url': url + '/old', 'size': 1}, statefile)
+            download.download_file(url, path, resume=True)
+            self.assertNotIn('range', gateway.headers[-1])
+            with open(path, 'rb') as result:
+                self.assertEqual(result.read(), content)
+        finally:
+            gateway.stop()
+
+    def test_fleet(self):
+        """Fleet should download the subscriptions once, update every node
+        and report failed ones"""
+        introducer = ('pb://md2tltfmdjvzptg4mznha5zktaxatpmz@5nrsgknvztikjxnp'
+                      'vidlokquojjlsudf7xlnrnyobj7e7trdmuta.b32.i2p/introducer')
+        intro_list = json.dumps({introducer: {'name': 'intro',
+                                              'active': True}})
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name in ('NEWS', 'NEWS.html', 'NEWS.atom'):
+                content = ('%s at TAHOENODEURL\n' % name).encode('utf8')
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, BytesIO(content))
+        server = FakeGateway({
+            '/uri/URI:DIR2-RO:a/introducers.json':
+                                lambda m, q, b: (200, intro_list),
+            '/uri/URI:DIR2-RO:b/NEWS.tgz':
+                                lambda m, q, b: (200, archive.getvalue())})
+        node_dirs = []
+        for num in range(3):
+            node_dir = os.path.join(self.tempdir, 'nodes', 'node%d' % num)
+            os.makedirs(os.path.join(node_dir, 'public_html'))
+            with open(os.path.join(node_dir, 'node.url'), 'w') as nodeurl:
+                nodeurl.write('http://127.0.0.1:%d/\n' % (3456 + num))
+            if num < 2:
+                with open(os.path.join(node_dir, 'tahoe.cfg'), 'w') as cfg:
+                    cfg.write('[node]\nnickname = node%d\n' % num)
+            node_dirs.append(node_dir)
+        oldstdout, oldstderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.capture
+        try:
+            self.assertEqual(fleet.expand_node_dirs([
+                os.path.join(self.tempdir, 'nodes', 'node*'), node_dirs[0]]),
+                node_dirs)
+            nodes = fleet.Fleet(node_dirs, 1, 3)
+            self.assertFalse(nodes.run_action('sync',
+                    server.url + '/uri/URI:DIR2-RO:a/introducers.json',
+                    server.url + '/uri/URI:DIR2-RO:b/NEWS.tgz'))
+        finally:
+            sys.stdout, sys.stderr = oldstdout, oldstderr
+            server.stop()
+        self.assertEqual(len(server.requests), 2)
+        for node_dir in node_dirs:
+            with open(os.path.join(node_dir, 'introducers')) as intlist:
+                self.assertEqual(intlist.read(), introducer + '\n')
+        with open(os.path.join(node_dirs[1], 'public_html',
+                                            'NEWS.atom')) as atom:
+            self.assertEqual(atom.read(), 'NEWS.atom at http://127.0.0.1:3457\n')
+        self.assertEqual(sorted(nodes.changed),
+                         [(node_dirs[0], ['introducers', 'news']),
+                          (node_dirs[1], ['introducers', 'news']),
+                          (node_dirs[2], ['introducers'])])
+        self.assertEqual([node for node, reason in nodes.failed],
+                         [node_dirs[2]])
+
+    def test_action_lock(self):
+        """ActionLock should keep out a second instance, but take over stale
+        locks and leave other actions alone"""
+        first = lock.ActionLock(self.tempdir, 'repair')
+        self.assertTrue(first.acquire())
+        oldstderr = sys.stderr
+        sys.stderr = self.capture
+        try:
+            second = lock.ActionLock(self.tempdir, 'repair', wait=0.2)
+            self.assertFalse(second.acquire())
+            with lock.ActionLock(self.tempdir, 'news') as news:
+                self.assertTrue(news.acquired)
+            first.release()
+            self.assertTrue(second.acquire())
+            second.release()
+            # a lock left behind by a process that has exited
+            dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+            dead.wait()
+            with open(os.path.join(self.tempdir, 'repair.lock'), 'w') as stale:
+                stale.write('%d %s 0\n' % (dead.pid, socket.gethostname()))
+            with lock.ActionLock(self.tempdir, 'repair') as third:
+                self.assertTrue(third.acquired)
+        finally:
+            sys.stderr = oldstderr
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                    'repair.lock')))
+
+    def test_repair_lock(self):
+        """run_repairs should skip --repair while another instance holds
+        the repair lock"""
+        server = FakeGateway({})
+        opts = Namespace(lock_wait=0, verbosity=1, check_freshness=0,
+                         resume=False, repair_workers=1, crawl_workers=1)
+        other = lock.ActionLock(self.tempdir, 'repair')
+        self.assertTrue(other.acquire())
+        oldstderr = sys.stderr
+        sys.stderr = self.capture
+        try:
+            grid_updates.run_repairs(opts, self.tempdir, server.url,
+                                server.url + '/uri/URI:LIT:list', None)
+        finally:
+            sys.stderr = oldstderr
+            other.release()
+            server.stop()
+        self.assertEqual(server.requests, [])
+        self.assertTrue("holds the 'repair' lock" in self.capture.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                    'repair-state.json')))
+
+    def test_stale_lock_race(self):
+        """only one instance should take over a stale lock, and a late one
+        must not remove the new lock"""
+        path = os.path.join(self.tempdir, 'repair.lock')
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        stale = '%d %s 0\n' % (dead.pid, socket.gethostname())
+        with open(path, 'w') as lockfile:
+            lockfile.write(stale)
+        first = lock.ActionLock(self.tempdir, 'repair')
+        second = lock.ActionLock(self.tempdir, 'repair')
+        # both have read the stale lock; the first one takes it over
+        self.assertTrue(first.take_over(stale))
+        self.assertTrue(first.acquire())
+        fresh = first.read()
+        self.assertFalse(second.take_over(stale))
+        self.assertEqual(first.read(), fresh)
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertEqual([name for name in os.listdir(self.tempdir)
+                                if name.startswith('repair.lock')], [])
+
 class TestNetwork(unittest.TestCase):
     def setUp(self):
         self.tahoe_node_uri = 'http://127.0.0.1:3456'